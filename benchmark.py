@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""Offline load test for the /webhook path.
+
+Starts local stand-ins for the Telegram Bot API and OpenAI chat completions,
+points the bot at them, replays a generated mix of Telegram updates through
+the Flask app and reports throughput, webhook latency, outbound calls per
+update and state growth. Nothing leaves the machine.
+
+    python benchmark.py --updates 2000 --concurrency 8 --openai-latency 0.8
+    python benchmark.py --mix chatter=40,raid=40,mention=20 --error-rate 0.05 --json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import tracemalloc
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_MIX = {"chatter": 55, "mention": 15, "start": 5, "callback": 10, "raid": 10, "join": 5}
+
+CHATTER = [
+    "Merhaba arkadaşlar, bugün nasılsınız?",
+    "Presale ne zaman bitiyor acaba",
+    "gm everyone, what a day",
+    "Bu hafta piyasa çok sakin",
+    "Staking ödülleri ne zaman dağıtılıyor?",
+    "I think the roadmap looks solid",
+    "Anyone here from Istanbul?",
+    "Bugün hava çok güzel, yürüyüşe çıktım",
+]
+MENTIONS = [
+    "Rose, Solium'un toplam arzı ne kadar?",
+    "Admin bana bir espri yapar mısın",
+    "Rose what chains does Solium run on?",
+    "Admin, presale oranı nedir?",
+    "Rose bana hikaye anlat",
+]
+RAID_MESSAGES = [
+    "🚀 Join the best crypto signals group now! 100x guaranteed, DM me",
+    "FREE AIRDROP!!! Claim your $PEPE at pepe-airdrop.xyz before it ends",
+    "Buy Ethereum now, it's going to the moon",
+]
+CALLBACKS = ["what_is_solium", "fun_fact", "ask_question", "try_fun", "take_challenge"]
+
+
+class Recorder:
+    """Thread-safe counters shared by the fake servers."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self.errors = defaultdict(int)
+
+    def count(self, name, error=False):
+        with self.lock:
+            self.calls[name] += 1
+            if error:
+                self.errors[name] += 1
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.errors.clear()
+
+
+class FakeServer:
+    """ThreadingHTTPServer running a handler class on a free localhost port."""
+
+    def __init__(self, handler):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def make_handler(recorder, latency, jitter, error_rate, respond):
+    """Build a JSON-over-HTTP handler with injected latency and errors."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            name = self.path.rstrip("/").rsplit("/", 1)[-1]
+            time.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+            if error_rate and random.random() < error_rate:
+                recorder.count(name, error=True)
+                if random.random() < 0.5:
+                    self.send_json(429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                         "parameters": {"retry_after": 1}, "error": {"message": "rate limited"}},
+                                   {"Retry-After": "1"})
+                else:
+                    self.send_json(500, {"ok": False, "error_code": 500, "error": {"message": "injected failure"}})
+                return
+            recorder.count(name)
+            respond(self, name, body)
+
+    return Handler
+
+
+def telegram_response(handler, method, body):
+    """Answer a Bot API call the way Telegram would for a healthy bot."""
+    if method in ("sendMessage", "editMessageText"):
+        result = {"message_id": random.randint(1000, 10 ** 9), "chat": {"id": body.get("chat_id")},
+                  "text": body.get("text", "")}
+    elif method == "getChatMember":
+        result = {"status": "member", "user": {"id": body.get("user_id")}}
+    elif method == "getChatAdministrators":
+        result = [{"status": "creator", "user": {"id": 1}}, {"status": "administrator", "user": {"id": 2}}]
+    else:
+        # deleteMessage, deleteMessages, banChatMember, restrictChatMember, answerCallbackQuery, ...
+        result = True
+    handler.send_json(200, {"ok": True, "result": result})
+
+
+def openai_response(handler, name, body):
+    """Answer a chat completion: YES/NO or JSON verdicts for moderation, canned text for replies."""
+    system = body["messages"][0]["content"]
+    last = body["messages"][-1]["content"]
+    if system.startswith("You moderate"):
+        items = json.loads(last)
+        content = json.dumps({"verdicts": [{"id": item["id"], "violation": is_spam(item["text"])} for item in items]})
+    elif system.startswith("Does the following"):
+        content = "YES" if is_spam(last) else "NO"
+    else:
+        content = "Tabii kanka! Solium (SLM) toplam arzı 100,000,000 SLM. (Solium is not available in some regions, including the USA.)"
+    usage = {"prompt_tokens": sum(len(m["content"]) for m in body["messages"]) // 4,
+             "completion_tokens": len(content) // 4, "total_tokens": 0, "prompt_tokens_details": {"cached_tokens": 0}}
+    if body.get("stream"):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        for word in content.split(" "):
+            chunk = {"id": "bench", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                     "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+            handler.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        handler.wfile.write(b"data: [DONE]\n\n")
+        handler.close_connection = True
+        return
+    handler.send_json(200, {
+        "id": "bench", "object": "chat.completion", "created": 0, "model": body["model"],
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+        "usage": usage,
+    })
+
+
+def is_spam(text):
+    lowered = text.lower()
+    return any(word in lowered for word in ("signals", "airdrop", "buy ethereum", "100x"))
+
+
+class UpdateGenerator:
+    """Produces a realistic stream of Telegram updates from a weighted scenario mix."""
+
+    def __init__(self, mix, chats=20, users=500, seed=1):
+        self.random = random.Random(seed)
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.chats = [-1000000000000 - i for i in range(chats)]
+        self.users = [10000 + i for i in range(users)]
+        self.update_id = 0
+        self.message_id = 0
+        self.raid_chat = self.chats[0]
+
+    def _base(self):
+        self.update_id += 1
+        self.message_id += 1
+        return self.update_id, self.message_id
+
+    def _message(self, text, chat_id=None, user_id=None):
+        update_id, message_id = self._base()
+        return {"update_id": update_id, "message": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id or self.random.choice(self.chats), "type": "supergroup"},
+            "from": {"id": user_id or self.random.choice(self.users), "is_bot": False, "first_name": "Bench"},
+            "text": text,
+        }}
+
+    def chatter(self):
+        return self._message(self.random.choice(CHATTER))
+
+    def mention(self):
+        return self._message(self.random.choice(MENTIONS))
+
+    def start(self):
+        return self._message("/start")
+
+    def raid(self):
+        # Many fresh accounts posting the same few messages into one chat
+        return self._message(self.random.choice(RAID_MESSAGES), chat_id=self.raid_chat,
+                             user_id=self.random.randint(10 ** 9, 2 * 10 ** 9))
+
+    def join(self):
+        update = self._message("", chat_id=self.raid_chat)
+        message = update["message"]
+        del message["text"]
+        message["new_chat_members"] = [{"id": message["from"]["id"], "is_bot": False, "first_name": "New"}]
+        return update
+
+    def callback(self):
+        update_id, message_id = self._base()
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id),
+            "from": {"id": self.random.choice(self.users), "is_bot": False, "first_name": "Bench"},
+            "message": {"message_id": message_id, "chat": {"id": self.random.choice(self.chats), "type": "supergroup"}},
+            "data": self.random.choice(CALLBACKS),
+        }}
+
+    def next(self):
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        return kind, getattr(self, kind)()
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if not hasattr(UpdateGenerator, kind.strip()):
+            raise argparse.ArgumentTypeError(f"unknown update kind: {kind}")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def wait_for_drain(bot, timeout):
+    """Wait until every queued update has been processed (or the timeout passes)."""
+    deadline = time.monotonic() + timeout
+    dispatcher = bot.update_dispatcher
+    while time.monotonic() < deadline:
+        stats = dispatcher.stats
+        if dispatcher.depth() == 0 and stats["processed"] + stats["failed"] >= stats["enqueued"]:
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def run(args):
+    telegram_calls, openai_calls = Recorder(), Recorder()
+    telegram = FakeServer(make_handler(telegram_calls, args.telegram_latency, args.telegram_latency / 2,
+                                       args.error_rate, telegram_response)).start()
+    openai = FakeServer(make_handler(openai_calls, args.openai_latency, args.openai_latency / 4,
+                                     args.error_rate, openai_response)).start()
+
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "123456:BENCHMARK",
+        "OPENAI_API_KEY": "sk-benchmark",
+        "TELEGRAM_API_URL": telegram.url,
+        "OPENAI_BASE_URL": openai.url + "/v1",
+    })
+    if not args.telegram_limits:
+        # Measure the bot, not Telegram's per-group send limits (20 messages/minute)
+        os.environ.update({"TELEGRAM_GLOBAL_RATE": "100000", "TELEGRAM_CHAT_RATE": "100000",
+                           "TELEGRAM_GROUP_RATE": "100000", "TELEGRAM_CHAT_BURST": "100000"})
+    os.environ.update({"LOG_LEVEL": args.log_level, "LOG_FORMAT": "text", "UPDATE_RUNTIME": args.runtime})
+    tracemalloc.start()
+    import main as bot
+    state_before = bot.state_store.stats()
+    memory_before = tracemalloc.get_traced_memory()[0]
+
+    generator = UpdateGenerator(args.mix, chats=args.chats, users=args.users, seed=args.seed)
+    updates = [generator.next() for _ in range(args.updates)]
+    kinds = defaultdict(int)
+    for kind, _ in updates:
+        kinds[kind] += 1
+
+    latencies = []
+    statuses = defaultdict(int)
+    lock = threading.Lock()
+    cursor = iter(updates)
+    interval = 1.0 / args.rate if args.rate else 0.0
+
+    def client_loop():
+        client = bot.app.test_client()
+        local_latencies, local_statuses = [], defaultdict(int)
+        while True:
+            with lock:
+                item = next(cursor, None)
+            if item is None:
+                break
+            started = time.perf_counter()
+            response = client.post("/webhook", json=item[1])
+            local_latencies.append(time.perf_counter() - started)
+            local_statuses[response.status_code] += 1
+            if interval:
+                time.sleep(interval * args.concurrency)
+        with lock:
+            latencies.extend(local_latencies)
+            for status, count in local_statuses.items():
+                statuses[status] += count
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client_loop) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ingest_seconds = time.perf_counter() - started
+    drained = wait_for_drain(bot, args.drain_timeout)
+    total_seconds = time.perf_counter() - started
+
+    memory_after = tracemalloc.get_traced_memory()[0]
+    report = {
+        "updates": args.updates,
+        "mix": dict(kinds),
+        "drained": drained,
+        "webhook_status": dict(statuses),
+        "ingest_updates_per_sec": args.updates / ingest_seconds,
+        "processed_updates_per_sec": args.updates / total_seconds,
+        "webhook_latency_ms": {
+            "p50": percentile(latencies, 50) * 1000,
+            "p95": percentile(latencies, 95) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+            "max": max(latencies) * 1000 if latencies else 0.0,
+        },
+        "dispatcher": dict(bot.update_dispatcher.stats),
+        "telegram_calls": dict(telegram_calls.calls),
+        "telegram_errors": dict(telegram_calls.errors),
+        "openai_calls": dict(openai_calls.calls),
+        "openai_errors": dict(openai_calls.errors),
+        "telegram_calls_per_update": sum(telegram_calls.calls.values()) / args.updates,
+        "openai_calls_per_update": sum(openai_calls.calls.values()) / args.updates,
+        "llm_governor": dict(bot.llm_governor.stats),
+        "raid_guard": dict(bot.raid_guard.stats),
+        "moderation_batcher": dict(bot.moderation_batcher.stats),
+        "state_before": state_before,
+        "state_after": bot.state_store.stats(),
+        "traced_memory_growth_kib": (memory_after - memory_before) / 1024,
+    }
+    telegram.stop()
+    openai.stop()
+    return report
+
+
+def print_report(report):
+    latency = report["webhook_latency_ms"]
+    print(f"Updates:               {report['updates']} {report['mix']}")
+    print(f"Drained:               {report['drained']}  webhook status {report['webhook_status']}")
+    print(f"Ingest throughput:     {report['ingest_updates_per_sec']:.0f} updates/s")
+    print(f"End-to-end throughput: {report['processed_updates_per_sec']:.1f} updates/s")
+    print(f"Webhook latency (ms):  p50 {latency['p50']:.2f}  p95 {latency['p95']:.2f}  "
+          f"p99 {latency['p99']:.2f}  max {latency['max']:.2f}")
+    print(f"Dispatcher:            {report['dispatcher']}")
+    print(f"Telegram calls/update: {report['telegram_calls_per_update']:.2f} {report['telegram_calls']}")
+    print(f"OpenAI calls/update:   {report['openai_calls_per_update']:.3f} {report['openai_calls']}")
+    print(f"LLM governor:          {report['llm_governor']}")
+    print(f"Raid guard:            {report['raid_guard']}")
+    print(f"Moderation batches:    {report['moderation_batcher']}")
+    if report["telegram_errors"] or report["openai_errors"]:
+        print(f"Injected errors:       telegram {report['telegram_errors']} openai {report['openai_errors']}")
+    print(f"State:                 {report['state_before']} -> {report['state_after']}")
+    print(f"Traced memory growth:  {report['traced_memory_growth_kib']:.0f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=2000, help="number of updates to replay")
+    parser.add_argument("--concurrency", type=int, default=8, help="parallel webhook clients")
+    parser.add_argument("--rate", type=float, default=0, help="target updates/sec across clients (0 = as fast as possible)")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help="weighted update kinds, e.g. chatter=50,raid=30")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="seconds per fake Bot API call")
+    parser.add_argument("--openai-latency", type=float, default=0.8, help="seconds per fake completion")
+    parser.add_argument("--runtime", default="threads", choices=["threads", "asyncio"], help="UPDATE_RUNTIME of the bot")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the bot's Telegram send rate limits on")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of fake calls failing with 429/500")
+    parser.add_argument("--drain-timeout", type=float, default=300, help="seconds to wait for queued updates")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,125 @@
 # -*- coding: utf-8 -*-
 import os
+import asyncio
+import contextlib
+import atexit
+import functools
+from abc import ABC, abstractmethod
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import threading
+import time
+import sqlite3
 import requests
+import httpx
 from flask import Flask, request, jsonify
-from collections import defaultdict, deque
+from collections import Counter, defaultdict, deque, OrderedDict
+import re
 import json
+import math
+import hashlib
+import unicodedata
 import random
-from datetime import datetime
-from openai import OpenAI
+import signal
+from concurrent.futures import Future, ThreadPoolExecutor
+import queue
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+import openai
+from openai import AsyncOpenAI
 from collections import namedtuple
 
-# Logging setup
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Logging setup (records are queued on the calling thread and written by a background listener)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")  # json | text
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", 0.1))  # share of DEBUG records kept
+LOG_REDACT = os.environ.get("LOG_REDACT", "1") != "0"  # hide user/model text in log lines
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+SECRET_REGEX = re.compile(r"\d{5,}:[A-Za-z0-9_-]{30,}\b|\bsk-[A-Za-z0-9_-]{16,}")  # bot tokens, OpenAI keys
+
+class Redacted:
+    """Lazy log argument for user or model text; only rendered if the record is written."""
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        text = self.text if isinstance(self.text, str) else str(self.text)
+        if LOG_REDACT:
+            return f"<{len(text)} chars>"
+        return text
+
+def redact(text):
+    return Redacted(text)
+
+class DebugSampler(logging.Filter):
+    """Keep a random share of DEBUG records; INFO and above always pass."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue records without formatting them; the listener thread does that.
+
+    Log arguments must not be mutated after the call, which holds for the
+    strings, numbers and Redacted wrappers passed in this module.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return SECRET_REGEX.sub("<secret>", json.dumps(entry, ensure_ascii=False, default=str))
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        return SECRET_REGEX.sub("<secret>", super().format(record))
+
+def configure_logging():
+    """Route root logging through a bounded queue to a stdout writer thread."""
+    root = logging.getLogger()
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(TextFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    queue_handler = DeferredQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(DebugSampler(LOG_DEBUG_SAMPLE_RATE))
+    listener = QueueListener(queue_handler.queue, stream_handler)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    listener.start()
+    atexit.register(listener.stop)
+    return queue_handler
+
+log_handler = configure_logging()
 logger = logging.getLogger(__name__)
 
 logger.debug("Starting application initialization...")
@@ -31,20 +139,895 @@ logger.debug("Environment variables loaded successfully.")
 # Initialize OpenAI client
 logger.debug("Initializing OpenAI client...")
 try:
-    client = OpenAI(api_key=OPENAI_API_KEY)
+    # OPENAI_BASE_URL points the client at a compatible endpoint (e.g. the benchmark stand-in)
+    # Retries are left to the LLM governor (see complete_chat), which keeps them within a deadline
+    async_client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=os.environ.get("OPENAI_BASE_URL") or None, max_retries=0)
     logger.debug("OpenAI client initialized successfully.")
 except Exception as e:
-    logger.error(f"Failed to initialize OpenAI client: {e}")
+    logger.error("Failed to initialize OpenAI client: %s", e)
     raise
 
+# Metrics (in-process counters/histograms, served in Prometheus format on /metrics)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192)
+HISTOGRAM_BUCKETS = {"llm_tokens": TOKEN_BUCKETS}
+
+class Metrics:
+    """Minimal metrics registry; updates are a dict lookup and an add under one lock.
+
+    Stats the components already keep (caches, queues, batchers) are read by
+    collectors at scrape time, so they cost nothing on the request path.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._collectors = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = HISTOGRAM_BUCKETS.get(name, LATENCY_BUCKETS)
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def timed(self, name, **labels):
+        """Decorator observing the wrapped function's wall time into histogram `name`."""
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    started = time.perf_counter()
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        self.observe(name, time.perf_counter() - started, **labels)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - started, **labels)
+            return wrapper
+        return decorator
+
+    def register_collector(self, collector):
+        """Add a callable returning [(name, type, labels dict, value)] evaluated on every scrape."""
+        self._collectors.append(collector)
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v)}"' for k, v in labels) + "}"
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(series)) for key, series in self._histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{self.format_labels(labels)} {value}")
+        for (name, labels), series in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(HISTOGRAM_BUCKETS.get(name, LATENCY_BUCKETS), series):
+                cumulative += count
+                lines.append(f"{name}_bucket{self.format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{self.format_labels(labels + (('le', '+Inf'),))} {series[-1]}")
+            lines.append(f"{name}_sum{self.format_labels(labels)} {series[-2]}")
+            lines.append(f"{name}_count{self.format_labels(labels)} {series[-1]}")
+        for collector in self._collectors:
+            try:
+                samples = collector()
+            except Exception as e:
+                logger.error("Metrics collector failed: %s", e)
+                continue
+            for name, metric_type, labels, value in samples:
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} {metric_type}")
+                lines.append(f"{name}{self.format_labels(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class BackgroundLoop:
+    """An asyncio event loop on a daemon thread, started lazily so forked gunicorn workers get their own.
+
+    Update handling is written once, as coroutines; both runtimes run it on
+    this loop, and thread-based code (the worker pool, summaries, moderation
+    batches) hands its coroutines over with `run` or `spawn`.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.loop = None
+        self._lock = threading.Lock()
+        self._tasks = set()  # spawned tasks, referenced until they finish
+
+    def start(self):
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name=self.name, daemon=True).start()
+        return self.loop
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the loop from another thread and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.start()).result(timeout)
+
+    def spawn(self, coro):
+        """Schedule a coroutine on the loop from any thread without waiting for it."""
+        loop = self.start()
+
+        def create():
+            task = loop.create_task(coro)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        loop.call_soon_threadsafe(create)
+
+core_loop = BackgroundLoop("core-loop")
+
+# Telegram Bot API client (pooled keep-alive connections + rate limiting)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
+TELEGRAM_TIMEOUT = float(os.environ.get("TELEGRAM_TIMEOUT", 10))  # seconds per HTTP call
+TELEGRAM_MAX_RETRIES = int(os.environ.get("TELEGRAM_MAX_RETRIES", 3))
+TELEGRAM_POOL_SIZE = int(os.environ.get("TELEGRAM_POOL_SIZE", 20))
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 30))  # messages/sec across all chats
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", 1))  # messages/sec in a private chat
+TELEGRAM_GROUP_RATE = float(os.environ.get("TELEGRAM_GROUP_RATE", 20 / 60))  # messages/sec in a group
+TELEGRAM_CHAT_BURST = int(os.environ.get("TELEGRAM_CHAT_BURST", 3))
+TELEGRAM_MAX_RATE_WAIT = float(os.environ.get("TELEGRAM_MAX_RATE_WAIT", 30))  # give up instead of queueing longer
+
+# Methods that count against Telegram's message limits
+TELEGRAM_SEND_METHODS = {"sendMessage", "editMessageText", "sendPhoto", "sendDocument"}
+# Methods that must not run twice (duplicate warnings/replies). After a read timeout or a 5xx the call may
+# already have gone through, so these are only retried when the request never reached Telegram, or on 429.
+TELEGRAM_NON_IDEMPOTENT_METHODS = TELEGRAM_SEND_METHODS | {"banChatMember"}
+TELEGRAM_CONNECT_ERRORS = (requests.ConnectionError, requests.ConnectTimeout,
+                           httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+class TokenBucket:
+    """Token bucket; `reserve` takes a token and returns how long to wait before using it."""
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now):
+        self.refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, now, seconds):
+        """Block the bucket for `seconds` (used for 429 retry_after)."""
+        self.refill(now)
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+class TelegramClient:
+    """Bot API client sharing one keep-alive connection pool between all calls.
+
+    Send methods are throttled by a global and a per-chat token bucket that
+    follow Telegram's documented limits, 429 responses are retried after the
+    `retry_after` Telegram asks for. Network errors and 5xx responses are
+    retried too, except for TELEGRAM_NON_IDEMPOTENT_METHODS, which are only
+    retried when the connection itself failed.
+    """
+
+    def __init__(self, token, base_url=TELEGRAM_API_URL, timeout=TELEGRAM_TIMEOUT,
+                 max_retries=TELEGRAM_MAX_RETRIES, pool_size=TELEGRAM_POOL_SIZE):
+        self.base_url = f"{base_url.rstrip('/')}/bot{token}/"
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._lock = threading.Lock()
+        self._global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self._chat_buckets = {}
+        self.stats = {"calls": 0, "errors": 0, "retries": 0, "rate_limited": 0, "dropped": 0, "throttled_seconds": 0.0}
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= 10000:
+                # Drop idle buckets; a full bucket carries no state worth keeping.
+                now = time.monotonic()
+                for key, old in list(self._chat_buckets.items()):
+                    old.refill(now)
+                    if old.tokens >= old.capacity:
+                        del self._chat_buckets[key]
+            rate = TELEGRAM_GROUP_RATE if isinstance(chat_id, int) and chat_id < 0 else TELEGRAM_CHAT_RATE
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, TELEGRAM_CHAT_BURST)
+        return bucket
+
+    def reserve(self, method, chat_id, block=True):
+        """Take a send slot and return how long to wait for it, or None to drop the call.
+
+        Calls are dropped (their slot given back) when the wait would exceed
+        TELEGRAM_MAX_RATE_WAIT, and with block=False unless a slot is free right now.
+        """
+        if method not in TELEGRAM_SEND_METHODS:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            buckets = [self._global_bucket]
+            if chat_id is not None:
+                buckets.append(self._chat_bucket(chat_id))
+            delay = max(bucket.reserve(now) for bucket in buckets)
+            if delay > (TELEGRAM_MAX_RATE_WAIT if block else 0):
+                # The call is not sent, so its slot goes back to the buckets.
+                for bucket in buckets:
+                    bucket.tokens += 1
+                if not block:
+                    return None
+                self.stats["dropped"] += 1
+            else:
+                self.stats["throttled_seconds"] += delay
+                return delay
+        logger.warning("Telegram %s to ChatID:%s dropped, rate limit wait %.1fs too long", method, chat_id, delay)
+        return None
+
+    def _backoff(self, method, chat_id, retry_after):
+        with self._lock:
+            self.stats["rate_limited"] += 1
+            bucket = self._chat_bucket(chat_id) if chat_id is not None else self._global_bucket
+            bucket.pause(time.monotonic(), retry_after)
+        logger.warning("Telegram %s rate limited (ChatID:%s), retrying after %ss", method, chat_id, retry_after)
+
+    def retry_delay(self, method, chat_id, attempt, started, response, error=None):
+        """Record one attempt; return how long to wait before retrying it, or None if done."""
+        self.stats["calls"] += 1
+        metrics.observe("telegram_request_seconds", time.perf_counter() - started, method=method)
+        metrics.inc("telegram_requests_total", method=method, status="error" if response is None else response.status_code)
+        if response is None:
+            self.stats["errors"] += 1
+            logger.error("Telegram %s request failed (attempt %s): %s", method, attempt + 1, error)
+        if attempt >= self.max_retries:
+            return None
+        if response is not None and response.status_code == 429:
+            try:
+                retry_after = response.json().get("parameters", {}).get("retry_after", 1)
+            except ValueError:
+                retry_after = 1
+            self._backoff(method, chat_id, retry_after)
+            delay = retry_after
+        elif response is None or response.status_code >= 500:
+            if method in TELEGRAM_NON_IDEMPOTENT_METHODS and not isinstance(error, TELEGRAM_CONNECT_ERRORS):
+                logger.warning("Telegram %s not retried: it may already have been delivered", method)
+                return None
+            delay = min(2 ** attempt * 0.5, 5)
+        else:
+            return None
+        self.stats["retries"] += 1
+        return delay
+
+    def call(self, method, payload, block=True):
+        """Call a Bot API method and return the `requests` response (None if it never got one)."""
+        chat_id = payload.get("chat_id")
+        delay = self.reserve(method, chat_id, block)
+        if delay is None:
+            return None
+        if delay > 0:
+            time.sleep(delay)
+        response = None
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            error = None
+            try:
+                response = self.session.post(self.base_url + method, json=payload, timeout=self.timeout)
+            except requests.RequestException as e:
+                response, error = None, e
+            delay = self.retry_delay(method, chat_id, attempt, started, response, error)
+            if delay is None:
+                break
+            time.sleep(delay)
+        return response
+
+telegram = TelegramClient(TELEGRAM_BOT_TOKEN)
+
+ASYNC_HTTP_CONNECTIONS = int(os.environ.get("ASYNC_HTTP_CONNECTIONS", 100))
+
+class AsyncTelegramClient:
+    """asyncio Bot API client on httpx.
+
+    Rate limits, retries and stats are shared with a sync TelegramClient, so
+    the update handlers and the raid sweeper's bulk deletes stay within the
+    same Telegram budgets.
+    """
+
+    def __init__(self, limiter, max_connections=ASYNC_HTTP_CONNECTIONS):
+        self.limiter = limiter
+        self.http = httpx.AsyncClient(
+            base_url=limiter.base_url,
+            timeout=limiter.timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+
+    async def call(self, method, payload, block=True, timeout=None):
+        """Call a Bot API method and return the `httpx` response (None if it never got one)."""
+        chat_id = payload.get("chat_id")
+        delay = self.limiter.reserve(method, chat_id, block)
+        if delay is None:
+            return None
+        if delay > 0:
+            await asyncio.sleep(delay)
+        response = None
+        for attempt in range(self.limiter.max_retries + 1):
+            started = time.perf_counter()
+            error = None
+            try:
+                response = await self.http.post(method, json=payload, timeout=timeout or self.limiter.timeout)
+            except httpx.HTTPError as e:
+                response, error = None, e
+            delay = self.limiter.retry_delay(method, chat_id, attempt, started, response, error)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+        return response
+
+telegram_async = AsyncTelegramClient(telegram)
+
 # Response namedtuple
 Response = namedtuple('Response', ['output_text'])
 
-# Violation Tracking System (in-memory)
-violations = defaultdict(int)
+# Conversation Tracking System (in-memory, token-budgeted rolling window per user)
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 1200))  # history tokens sent per call
+CONTEXT_MAX_TURN_TOKENS = int(os.environ.get("CONTEXT_MAX_TURN_TOKENS", 300))  # longer turns are truncated
+CONTEXT_SUMMARY = os.environ.get("CONTEXT_SUMMARY", "0") == "1"  # fold evicted turns into a running summary
+CONTEXT_SUMMARY_TRIGGER = int(os.environ.get("CONTEXT_SUMMARY_TRIGGER", 600))  # evicted tokens per summary update
+
+try:
+    import tiktoken
+    token_encoding = tiktoken.get_encoding("o200k_base")  # gpt-4o family
+
+    def count_tokens(text):
+        return len(token_encoding.encode(text))
+except ImportError:
+    def count_tokens(text):
+        # ~4 characters per token is close enough for budgeting
+        return len(text) // 4 + 1
+
+ROLE_LABELS = {"user": "User", "assistant": "Assistant"}
+
+def summary_line(role, text):
+    """A turn as a line of the transcript handed to summarize_conversation."""
+    return f"{ROLE_LABELS[role]}: {text}"
+
+class Turn:
+    """One conversation turn, its tokens counted once when it is appended."""
+    __slots__ = ("role", "text", "timestamp", "tokens")
+
+    def __init__(self, role, text, tokens=None, timestamp=None):
+        if tokens is None:  # new turn (stored turns come back with their count)
+            tokens = count_tokens(text)
+            if tokens > CONTEXT_MAX_TURN_TOKENS:
+                text = text[:CONTEXT_MAX_TURN_TOKENS * 4] + " ..."
+                tokens = count_tokens(text)
+            tokens += 1  # + separator
+        self.role = role
+        self.text = text
+        self.timestamp = timestamp or time.time()
+        self.tokens = tokens
+
+class ConversationWindow:
+    """Rolling conversation window kept under CONTEXT_TOKEN_BUDGET as turns are appended.
+
+    Token counts are tracked incrementally; turns pushed out of the window are
+    collected for the running summary the state store folds them into. The
+    history messages are cached until the window changes. Windows are not
+    thread-safe: the state store owning one serializes access to it.
+    """
+    __slots__ = ("turns", "tokens", "summary", "evicted", "evicted_tokens", "summarizing", "_messages")
+
+    def __init__(self):
+        self.turns = deque()
+        self.tokens = 0
+        self.summary = ""
+        self.evicted = []
+        self.evicted_tokens = 0
+        self.summarizing = False
+        self._messages = None
+
+    @classmethod
+    def from_turns(cls, turns, summary=""):
+        """Build a read-only window from turns loaded from a persistent state store."""
+        window = cls()
+        window.turns.extend(turns)
+        window.tokens = sum(turn.tokens for turn in turns)
+        window.summary = summary
+        return window
+
+    def __len__(self):
+        return len(self.turns)
+
+    def append(self, role, text):
+        """Add a turn; returns True when the evicted turns should now be folded into the summary."""
+        turn = Turn(role, text)
+        self.turns.append(turn)
+        self.tokens += turn.tokens
+        while self.tokens > CONTEXT_TOKEN_BUDGET and len(self.turns) > 1:
+            old = self.turns.popleft()
+            self.tokens -= old.tokens
+            if CONTEXT_SUMMARY:
+                self.evicted.append(old)
+                self.evicted_tokens += old.tokens
+        self._messages = None
+        if CONTEXT_SUMMARY and self.evicted_tokens >= CONTEXT_SUMMARY_TRIGGER and not self.summarizing:
+            self.summarizing = True
+            return True
+        return False
+
+    def set_summary(self, summary):
+        self.summary = summary
+        self._messages = None
+
+    def history_messages(self, current_message=None):
+        """Return a copy of the window as chat messages, leaving out the newest turn if it is the current message."""
+        if self._messages is None:
+            messages = [{"role": "system", "content": f"Summary of earlier conversation: {self.summary}"}] if self.summary else []
+            messages.extend({"role": turn.role, "content": turn.text} for turn in self.turns)
+            self._messages = messages
+        if current_message is not None and self.turns and self.turns[-1].role == "user" \
+                and self.turns[-1].text == current_message:
+            return self._messages[:-1]
+        return list(self._messages)
+
+def summarize_conversation(summary, lines):
+    """Fold older conversation lines into a short running summary with ChatGPT (called from summary_executor)."""
+    response = core_loop.run(complete_chat(
+        [
+            {"role": "system", "content": "Update the running summary of a chat between a user and the assistant 'Rose'. Keep names, open questions and any joke or story the assistant told (quote them exactly). Max 120 words, same language as the chat."},
+            {"role": "user", "content": f"Current summary:\n{summary or '(none)'}\n\nOlder messages:\n" + "\n".join(lines)},
+        ],
+        "summary",
+        max_tokens=250
+    ))
+    return response.choices[0].message.content.strip()
+
+summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+
+# User State Store (violation counts + conversation windows) with a pluggable backend
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")  # memory | sqlite | redis
+STATE_MAX_USERS = int(os.environ.get("STATE_MAX_USERS", 50000))
+STATE_IDLE_TTL = float(os.environ.get("STATE_IDLE_TTL", 30 * 24 * 3600))  # forget users idle this long (seconds)
+STATE_SQLITE_PATH = os.environ.get("STATE_SQLITE_PATH", "bot_state.db")
+STATE_REDIS_URL = os.environ.get("STATE_REDIS_URL", os.environ.get("REDIS_URL", "redis://localhost:6379/0"))
+STATE_MAINTENANCE_INTERVAL = 300  # seconds between idle/size sweeps of persistent backends
+
+class StateStore(ABC):
+    """Per-user state shared by the handlers: violation counts and conversation windows.
+
+    history_messages() never creates state for unknown users; writes refresh the
+    user's idle timer. Backends trim each conversation to CONTEXT_TOKEN_BUDGET
+    when a turn is appended. `blocking` backends do disk or network I/O, so the
+    update handlers call them on a thread (see call_state_store).
+    """
+    blocking = True
+
+    @abstractmethod
+    def incr_violations(self, user_id):
+        """Add a violation and return the new count."""
+
+    @abstractmethod
+    def reset_violations(self, user_id):
+        ...
+
+    @abstractmethod
+    def append_turn(self, user_id, role, text):
+        ...
+
+    @abstractmethod
+    def history_messages(self, user_id, current_message=None):
+        """Return the user's history as a new list of chat messages ([] if there is none).
+
+        The newest turn is left out if it is `current_message`.
+        """
+
+    @abstractmethod
+    def clear_conversation(self, user_id):
+        """Clear the user's conversation; returns False if there was none."""
+
+    @abstractmethod
+    def stats(self):
+        ...
+
+class UserState:
+    __slots__ = ("violations", "window", "last_seen")
+
+    def __init__(self):
+        self.violations = 0
+        self.window = None
+        self.last_seen = time.monotonic()
+
+class MemoryStateStore(StateStore):
+    """In-process store: LRU-ordered users, capped at max_users and evicted after idle_ttl."""
+    blocking = False
+
+    def __init__(self, max_users=STATE_MAX_USERS, idle_ttl=STATE_IDLE_TTL):
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self._users = OrderedDict()  # user_id -> UserState, least recently seen first
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _get(self, user_id, create=False):
+        state = self._users.get(user_id)
+        now = time.monotonic()
+        if state is None:
+            if not create:
+                return None
+            state = self._users[user_id] = UserState()
+            self._evict(now)
+        else:
+            self._users.move_to_end(user_id)
+            state.last_seen = now
+        return state
+
+    def _evict(self, now):
+        while self._users:
+            user_id, oldest = next(iter(self._users.items()))
+            if len(self._users) <= self.max_users and now - oldest.last_seen < self.idle_ttl:
+                break
+            del self._users[user_id]
+            self.evictions += 1
+
+    def incr_violations(self, user_id):
+        with self._lock:
+            state = self._get(user_id, create=True)
+            state.violations += 1
+            return state.violations
+
+    def reset_violations(self, user_id):
+        with self._lock:
+            state = self._users.get(user_id)
+            if state:
+                state.violations = 0
+
+    def append_turn(self, user_id, role, text):
+        with self._lock:
+            state = self._get(user_id, create=True)
+            if state.window is None:
+                state.window = ConversationWindow()
+            window = state.window
+            fold = window.append(role, text)
+        if fold:
+            summary_executor.submit(self.fold_summary, window)
+
+    def fold_summary(self, window):
+        """Merge a window's evicted turns into its running summary (runs on summary_executor)."""
+        with self._lock:
+            evicted, window.evicted, window.evicted_tokens = window.evicted, [], 0
+            summary = window.summary
+        try:
+            summary = summarize_conversation(summary, [summary_line(turn.role, turn.text) for turn in evicted])
+            with self._lock:
+                window.set_summary(summary)
+        except Exception as e:
+            logger.error("Conversation summary failed: %s", e)
+        finally:
+            with self._lock:
+                window.summarizing = False
+
+    def history_messages(self, user_id, current_message=None):
+        with self._lock:
+            state = self._users.get(user_id)
+            if state is None or state.window is None:
+                return []
+            return state.window.history_messages(current_message)
+
+    def clear_conversation(self, user_id):
+        with self._lock:
+            state = self._users.get(user_id)
+            if state is None or not state.window:
+                return False
+            # A fresh window, so a summary still being folded lands on the discarded one
+            state.window = ConversationWindow()
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "users": len(self._users),
+                "conversations": sum(1 for state in self._users.values() if state.window),
+                "turns": sum(len(state.window) for state in self._users.values() if state.window),
+                "users_with_violations": sum(1 for state in self._users.values() if state.violations),
+                "evictions": self.evictions,
+            }
+
+class SQLiteStateStore(StateStore):
+    """SQLite (WAL) store on local disk, shared by every worker process on the host.
+
+    Turns pushed out of the token window are kept flagged as evicted until they
+    have been folded into the summary (CONTEXT_SUMMARY), otherwise deleted.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        violations INTEGER NOT NULL DEFAULT 0,
+        summary TEXT NOT NULL DEFAULT '',
+        last_seen REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS turns (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        text TEXT NOT NULL,
+        tokens INTEGER NOT NULL,
+        ts REAL NOT NULL,
+        evicted INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS turns_by_user ON turns (user_id, evicted, id);
+    CREATE INDEX IF NOT EXISTS users_by_last_seen ON users (last_seen);
+    """
+
+    def __init__(self, path=STATE_SQLITE_PATH, max_users=STATE_MAX_USERS, idle_ttl=STATE_IDLE_TTL):
+        self.path = path
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self._local = threading.local()
+        self._next_maintenance = 0.0
+        self._summarizing = set()
+        self._summary_lock = threading.Lock()
+        self._db().executescript(self.SCHEMA)
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _touch(self, db, user_id):
+        db.execute("INSERT INTO users (user_id, last_seen) VALUES (?, ?) "
+                   "ON CONFLICT(user_id) DO UPDATE SET last_seen = excluded.last_seen", (user_id, time.time()))
+
+    def _maintain(self, db):
+        now = time.time()
+        if now < self._next_maintenance:
+            return
+        self._next_maintenance = now + STATE_MAINTENANCE_INTERVAL
+        with db:
+            db.execute("DELETE FROM users WHERE last_seen < ?", (now - self.idle_ttl,))
+            db.execute("DELETE FROM users WHERE user_id IN (SELECT user_id FROM users ORDER BY last_seen DESC LIMIT -1 OFFSET ?)",
+                       (self.max_users,))
+            db.execute("DELETE FROM turns WHERE user_id NOT IN (SELECT user_id FROM users)")
+
+    def incr_violations(self, user_id):
+        db = self._db()
+        with db:
+            self._touch(db, user_id)
+            return db.execute("UPDATE users SET violations = violations + 1 WHERE user_id = ? RETURNING violations",
+                              (user_id,)).fetchone()[0]
+
+    def reset_violations(self, user_id):
+        db = self._db()
+        with db:
+            db.execute("UPDATE users SET violations = 0 WHERE user_id = ?", (user_id,))
+
+    def append_turn(self, user_id, role, text):
+        turn = Turn(role, text)
+        db = self._db()
+        with db:
+            self._touch(db, user_id)
+            db.execute("INSERT INTO turns (user_id, role, text, tokens, ts) VALUES (?, ?, ?, ?, ?)",
+                       (user_id, turn.role, turn.text, turn.tokens, turn.timestamp))
+            # Trim the window: keep the newest turns that fit the budget (always at least one)
+            rows = db.execute("SELECT id, tokens FROM turns WHERE user_id = ? AND evicted = 0 ORDER BY id DESC",
+                              (user_id,)).fetchall()
+            total, cutoff = 0, None
+            for index, (turn_id, tokens) in enumerate(rows):
+                total += tokens
+                if total > CONTEXT_TOKEN_BUDGET and index > 0:
+                    cutoff = turn_id
+                    break
+            if cutoff is not None:
+                if CONTEXT_SUMMARY:
+                    db.execute("UPDATE turns SET evicted = 1 WHERE user_id = ? AND id <= ?", (user_id, cutoff))
+                else:
+                    db.execute("DELETE FROM turns WHERE user_id = ? AND id <= ?", (user_id, cutoff))
+            pending = db.execute("SELECT COALESCE(SUM(tokens), 0) FROM turns WHERE user_id = ? AND evicted = 1",
+                                 (user_id,)).fetchone()[0] if CONTEXT_SUMMARY else 0
+        if pending >= CONTEXT_SUMMARY_TRIGGER:
+            with self._summary_lock:
+                if user_id in self._summarizing:
+                    return
+                self._summarizing.add(user_id)
+            summary_executor.submit(self.fold_summary, user_id)
+        self._maintain(db)
+
+    def fold_summary(self, user_id):
+        """Fold the user's evicted turns into the stored summary (runs on summary_executor)."""
+        try:
+            db = self._db()
+            row = db.execute("SELECT summary FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            turns = db.execute("SELECT id, role, text FROM turns WHERE user_id = ? AND evicted = 1 ORDER BY id",
+                               (user_id,)).fetchall()
+            if row is None or not turns:
+                return
+            summary = summarize_conversation(row[0], [summary_line(role, text) for _, role, text in turns])
+            with db:
+                db.execute("UPDATE users SET summary = ? WHERE user_id = ?", (summary, user_id))
+                db.execute("DELETE FROM turns WHERE user_id = ? AND evicted = 1 AND id <= ?", (user_id, turns[-1][0]))
+        except Exception as e:
+            logger.error("Conversation summary failed: %s", e)
+        finally:
+            with self._summary_lock:
+                self._summarizing.discard(user_id)
 
-# Conversation Tracking System (in-memory)
-conversations = defaultdict(lambda: deque(maxlen=100))  # Max 100 messages per user
+    def history_messages(self, user_id, current_message=None):
+        db = self._db()
+        row = db.execute("SELECT summary FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return []
+        turns = [Turn(role, text, tokens, ts) for role, text, tokens, ts in db.execute(
+            "SELECT role, text, tokens, ts FROM turns WHERE user_id = ? AND evicted = 0 ORDER BY id", (user_id,))]
+        return ConversationWindow.from_turns(turns, row[0]).history_messages(current_message)
+
+    def clear_conversation(self, user_id):
+        db = self._db()
+        with db:
+            deleted = db.execute("DELETE FROM turns WHERE user_id = ?", (user_id,)).rowcount
+            db.execute("UPDATE users SET summary = '' WHERE user_id = ?", (user_id,))
+        return deleted > 0
+
+    def stats(self):
+        db = self._db()
+        users, with_violations = db.execute("SELECT COUNT(*), COUNT(NULLIF(violations, 0)) FROM users").fetchone()
+        conversations, turns = db.execute("SELECT COUNT(DISTINCT user_id), COUNT(*) FROM turns WHERE evicted = 0").fetchone()
+        return {"users": users, "conversations": conversations, "turns": turns, "users_with_violations": with_violations}
+
+class RedisStateStore(StateStore):
+    """Store on a Redis-compatible server, shared by workers on any host.
+
+    Every key expires after idle_ttl of inactivity; configure the server with
+    a maxmemory eviction policy (e.g. allkeys-lru) to cap total memory.
+    """
+
+    def __init__(self, url=STATE_REDIS_URL, idle_ttl=STATE_IDLE_TTL, prefix="slm:"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND=redis requires the 'redis' package")
+        self.redis = redis.Redis.from_url(url)
+        self.idle_ttl = int(idle_ttl)
+        self.prefix = prefix
+        self._summarizing = set()
+        self._summary_lock = threading.Lock()
+
+    def _key(self, kind, user_id):
+        return f"{self.prefix}{kind}:{user_id}"
+
+    def incr_violations(self, user_id):
+        key = self._key("v", user_id)
+        pipe = self.redis.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, self.idle_ttl)
+        return pipe.execute()[0]
+
+    def reset_violations(self, user_id):
+        self.redis.delete(self._key("v", user_id))
+
+    def append_turn(self, user_id, role, text):
+        turn = Turn(role, text)
+        key = self._key("c", user_id)
+        pipe = self.redis.pipeline()
+        pipe.rpush(key, json.dumps([turn.role, turn.text, turn.tokens, turn.timestamp], ensure_ascii=False))
+        pipe.expire(key, self.idle_ttl)
+        pipe.lrange(key, 0, -1)
+        stored = pipe.execute()[2]
+        # Trim the window: keep the newest turns that fit the budget (always at least one)
+        total, keep = 0, 0
+        for raw in reversed(stored):
+            total += json.loads(raw)[2]
+            if total > CONTEXT_TOKEN_BUDGET and keep > 0:
+                break
+            keep += 1
+        evicted = stored[:len(stored) - keep]
+        if not evicted:
+            return
+        pipe = self.redis.pipeline()
+        pipe.ltrim(key, len(evicted), -1)
+        if CONTEXT_SUMMARY:
+            pending_key = self._key("p", user_id)
+            pipe.rpush(pending_key, *evicted)
+            pipe.expire(pending_key, self.idle_ttl)
+            pipe.lrange(pending_key, 0, -1)
+        results = pipe.execute()
+        if CONTEXT_SUMMARY and sum(json.loads(raw)[2] for raw in results[-1]) >= CONTEXT_SUMMARY_TRIGGER:
+            with self._summary_lock:
+                if user_id in self._summarizing:
+                    return
+                self._summarizing.add(user_id)
+            summary_executor.submit(self.fold_summary, user_id)
+
+    def fold_summary(self, user_id):
+        """Fold the user's evicted turns into the stored summary (runs on summary_executor)."""
+        try:
+            pending_key, summary_key = self._key("p", user_id), self._key("s", user_id)
+            pending = [json.loads(raw) for raw in self.redis.lrange(pending_key, 0, -1)]
+            if not pending:
+                return
+            summary = summarize_conversation((self.redis.get(summary_key) or b"").decode("utf-8"),
+                                             [summary_line(role, text) for role, text, _, _ in pending])
+            pipe = self.redis.pipeline()
+            pipe.set(summary_key, summary, ex=self.idle_ttl)
+            pipe.ltrim(pending_key, len(pending), -1)
+            pipe.execute()
+        except Exception as e:
+            logger.error("Conversation summary failed: %s", e)
+        finally:
+            with self._summary_lock:
+                self._summarizing.discard(user_id)
+
+    def history_messages(self, user_id, current_message=None):
+        pipe = self.redis.pipeline()
+        pipe.lrange(self._key("c", user_id), 0, -1)
+        pipe.get(self._key("s", user_id))
+        stored, summary = pipe.execute()
+        if not stored and not summary:
+            return []
+        turns = [Turn(*json.loads(raw)) for raw in stored]
+        return ConversationWindow.from_turns(turns, (summary or b"").decode("utf-8")).history_messages(current_message)
+
+    def clear_conversation(self, user_id):
+        return self.redis.delete(self._key("c", user_id), self._key("p", user_id), self._key("s", user_id)) > 0
+
+    def stats(self):
+        info = self.redis.info("keyspace")
+        return {"keys": sum(db.get("keys", 0) for db in info.values() if isinstance(db, dict))}
+
+STATE_BACKENDS = {"memory": MemoryStateStore, "sqlite": SQLiteStateStore, "redis": RedisStateStore}
+
+def create_state_store(backend=STATE_BACKEND):
+    if backend not in STATE_BACKENDS:
+        raise ValueError(f"Unknown STATE_BACKEND: {backend}")
+    logger.debug("Initializing %s state store...", backend)
+    return STATE_BACKENDS[backend]()
+
+state_store = create_state_store()
+
+async def call_state_store(func, *args):
+    """Call a function that uses state_store from the event loop, on a thread when the backend blocks."""
+    if not state_store.blocking:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
 
 # Solium whitelist links
 WHITELIST_LINKS = [
@@ -60,10 +1043,19 @@ WHITELIST_LINKS = [
     "https://medium.com/@soliumcoin"
 ]
 
-def ask_chatgpt(message, user_id=None):
-    """Use OpenAI Chat Completions API with gpt-4o-mini and optimized user conversation context."""
-    logger.debug("Entering ask_chatgpt function...")
-    INTRODUCTION_MESSAGE = """You are a friendly AI assistant bot named 'Rose' or 'Admin', primarily designed to answer questions about Solium but also capable of responding to *any* prompt users throw at you, from technical topics to fun, random curiosities. Your goal is to provide an exceptional user experience, keeping responses clear, engaging, and professional. Follow these rules:
+# Streaming replies (placeholder message edited as tokens arrive)
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "0") == "1"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.5))  # min seconds between edits
+STREAM_PLACEHOLDER = os.environ.get("STREAM_PLACEHOLDER", "✍️ ...")
+
+FALLBACK_REPLY = "Hmm, tam anlayamadım kanka! 😅 Az önce bi' espri veya hikaye mi kastediyorsun? Ne konuşalım?"
+ERROR_REPLY = "Hmm, bir hata oldu kanka! 😅 Bi' daha dene, ne konuşalım?"
+QUOTA_REPLY = "Biraz yavaş kanka! 😅 Çok hızlı soruyorsun, bir dakika sonra tekrar dene."
+
+# Prompts are built once at import. Every reply request starts with the same
+# system message, followed by the user's history in order, so consecutive calls
+# share a byte-identical prefix that the provider's prompt cache can reuse.
+INTRODUCTION_MESSAGE = """You are a friendly AI assistant bot named 'Rose' or 'Admin', primarily designed to answer questions about Solium but also capable of responding to *any* prompt users throw at you, from technical topics to fun, random curiosities. Your goal is to provide an exceptional user experience, keeping responses clear, engaging, and professional. Follow these rules:
 
 1. Respond ONLY when addressed as 'Rose' or 'Admin'.
 2. ALWAYS respond in the user's language (e.g., Turkish if they use Türkçe) and match their conversational tone (e.g., casual if they are casual). Do NOT use other languages unless explicitly requested.
@@ -98,389 +1090,2316 @@ Assistant: Puffy, hikayenin kahramanı! Tropikal adada yaşayan, yüzmekten hoş
 - Note: Solium is not available to residents of the USA.
 
 Your role is to assist users, act as a group moderator, and provide clear, trust-building responses. Always remind users that this is not financial advice."""
-    
-    messages = [{"role": "system", "content": INTRODUCTION_MESSAGE}]
-    
-    # Add user conversation context (last 10 messages for gpt-4o-mini)
-    if user_id and user_id in conversations:
-        recent_conversation = list(conversations[user_id])[-10:]  # Last 10 messages
-        context = "\n".join([f"{msg['timestamp']}: {msg['text']}" for msg in recent_conversation if len(msg['text']) < 500])
-        messages.append({
-            "role": "system",
-            "content": f"Conversation history (last 10 messages, newest at bottom):\n{context}\n\nInstructions: Use this history to maintain context and answer the current message accurately. Prioritize the current message: '{message}'. If the user refers to a previous topic (e.g., a joke or story), repeat or clarify it based on the history. If you told a joke/story, use the SAME one."
-        })
-    
+
+HISTORY_INSTRUCTIONS = """#### Conversation History:
+The previous messages of this conversation come before the current message, oldest first. Use them to maintain context and answer the current (last) message accurately; prioritize the current message. If the user refers to a previous topic (e.g., a joke or story), repeat or clarify it based on the history. If you told a joke/story, use the SAME one."""
+
+SYSTEM_PROMPT = f"{INTRODUCTION_MESSAGE}\n\n{HISTORY_INSTRUCTIONS}"
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+MODERATION_RULES = """Rules:
+1. External links other than official Solium links (e.g., https://soliumcoin.com, https://t.me/+KDhk3UEwZAg3MmU0) are prohibited.
+2. Promoting cryptocurrencies or projects other than Solium is prohibited (e.g., 'Buy Bitcoin', 'Ethereum is great').
+3. Profanity, insults, or inappropriate language are prohibited (e.g., 'stupid', 'damn', 'fuck').
+4. Empty messages, system notifications, group join events, or casual greetings (e.g., 'nasılsın', 'merhaba') are NOT violations.
+Examples:
+- 'Nasılsın' -> NO
+- 'Merhaba' -> NO
+- 'Buy Ethereum now!' -> YES
+- 'Check out https://example.com' -> YES
+- 'You idiot!' -> YES
+- 'Solium rewards ne zaman?' -> NO"""
+
+MODERATION_PROMPT = f"""Does the following message violate these rules? (Write only YES/NO):
+{MODERATION_RULES}
+The user's message is the message to check."""
+MODERATION_MESSAGE = {"role": "system", "content": MODERATION_PROMPT}
+
+BATCH_MODERATION_PROMPT = f"""You moderate a Telegram group. For each message decide whether it violates these rules.
+{MODERATION_RULES}
+The user sends a JSON array of {{"id": <number>, "text": <message>}} objects. Reply with only a JSON object of the form
+{{"verdicts": [{{"id": <number>, "violation": true or false}}, ...]}} containing one verdict for every id."""
+BATCH_MODERATION_MESSAGE = {"role": "system", "content": BATCH_MODERATION_PROMPT}
+
+# LLM usage reporting (per purpose: reply / moderation / summary), exported as llm_tokens_total on /metrics
+
+def usage_value(obj, name):
+    """Read a usage field from an SDK object or a plain dict (newer fields arrive as extras)."""
+    if obj is None:
+        return None
+    return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+def record_llm_usage(purpose, usage):
+    """Add a completion's token usage to the metrics and log it."""
+    if usage is None:
+        return
+    prompt_tokens = usage_value(usage, "prompt_tokens") or 0
+    completion_tokens = usage_value(usage, "completion_tokens") or 0
+    cached_tokens = usage_value(usage_value(usage, "prompt_tokens_details"), "cached_tokens") or 0
+    metrics.observe("llm_tokens", prompt_tokens, purpose=purpose, kind="prompt")
+    metrics.observe("llm_tokens", completion_tokens, purpose=purpose, kind="completion")
+    metrics.inc("llm_tokens_total", prompt_tokens, purpose=purpose, kind="prompt")
+    metrics.inc("llm_tokens_total", cached_tokens, purpose=purpose, kind="cached")
+    metrics.inc("llm_tokens_total", completion_tokens, purpose=purpose, kind="completion")
+    logger.info("ChatGPT usage (%s): prompt=%s cached=%s completion=%s",
+                purpose, prompt_tokens, cached_tokens, completion_tokens)
+
+# LLM Governor (concurrency caps, per-user quotas, coalescing, deadlines, retries, circuit breaker)
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 32))  # OpenAI calls in flight per process
+LLM_CHAT_CONCURRENCY = int(os.environ.get("LLM_CHAT_CONCURRENCY", 2))  # ... per chat
+LLM_USER_QUOTA = int(os.environ.get("LLM_USER_QUOTA", 10))  # ChatGPT replies per user...
+LLM_USER_QUOTA_WINDOW = float(os.environ.get("LLM_USER_QUOTA_WINDOW", 60))  # ...per this many seconds
+LLM_DEADLINES = {  # seconds from the first attempt to giving up, retries and queueing included
+    "reply": float(os.environ.get("LLM_REPLY_DEADLINE", 30)),
+    "moderation": float(os.environ.get("LLM_MODERATION_DEADLINE", 15)),
+    "summary": float(os.environ.get("LLM_SUMMARY_DEADLINE", 30)),
+}
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 2))  # on 429, 5xx, timeouts and connection errors
+LLM_RETRY_BASE = float(os.environ.get("LLM_RETRY_BASE", 0.5))
+LLM_RETRY_CAP = float(os.environ.get("LLM_RETRY_CAP", 8))
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", 5))  # consecutive failures that open the breaker
+LLM_BREAKER_COOLDOWN = float(os.environ.get("LLM_BREAKER_COOLDOWN", 30))  # seconds before a trial call
+
+class LLMRejected(Exception):
+    """Raised instead of calling OpenAI: "quota", "busy" (no slot or coalesced result before the deadline)
+    or "unavailable" (breaker open)."""
+
+    def __init__(self, reason):
+        super().__init__(f"LLM call rejected: {reason}")
+        self.reason = reason
+
+def is_retryable(error):
+    """429s, 5xx, timeouts and connection errors are worth retrying; other API errors are not."""
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and (error.status_code == 429 or error.status_code >= 500)
+
+class LLMGovernor:
+    """Admission control in front of every OpenAI call, shared by both runtimes.
+
+    - per-user quotas (token buckets) for replies
+    - a global and a per-chat cap on calls in flight; callers wait for a slot until their deadline
+    - identical in-flight non-streaming calls are coalesced into one
+    - retries with full jitter on retryable errors, honouring Retry-After, within the deadline
+    - a circuit breaker that opens after LLM_BREAKER_FAILURES consecutive failures,
+      rejects calls for LLM_BREAKER_COOLDOWN seconds, then lets one trial call through
+    """
+
+    def __init__(self, max_concurrency, chat_concurrency):
+        self.max_concurrency = max_concurrency
+        self.chat_concurrency = chat_concurrency
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._chat_in_flight = defaultdict(int)
+        self._waiters = []  # (loop, future) woken when a slot frees up
+        self._quotas = OrderedDict()  # user_id -> TokenBucket
+        self._coalesced = {}  # call key -> Future of the call in flight
+        self._failures = 0
+        self._open_until = 0.0
+        self._trial = False
+        self.stats = {"calls": 0, "coalesced": 0, "retries": 0, "failures": 0,
+                      "rejected_quota": 0, "rejected_busy": 0, "rejected_unavailable": 0, "breaker_opened": 0}
+
+    def deadline(self, purpose):
+        return time.monotonic() + LLM_DEADLINES.get(purpose, LLM_DEADLINES["reply"])
+
+    def reject(self, reason):
+        with self._lock:
+            self.stats[f"rejected_{reason}"] += 1
+        metrics.inc("llm_rejected_total", reason=reason)
+        raise LLMRejected(reason)
+
+    def check_quota(self, purpose, user_id):
+        if purpose != "reply" or user_id is None or LLM_USER_QUOTA <= 0:
+            return
+        with self._lock:
+            bucket = self._quotas.get(user_id)
+            if bucket is None:
+                bucket = self._quotas[user_id] = TokenBucket(LLM_USER_QUOTA / LLM_USER_QUOTA_WINDOW, LLM_USER_QUOTA)
+                if len(self._quotas) > STATE_MAX_USERS:
+                    self._quotas.popitem(last=False)
+            self._quotas.move_to_end(user_id)
+            over_quota = bucket.reserve(time.monotonic()) > 0
+            if over_quota:
+                bucket.tokens += 1  # a rejected request doesn't use up quota
+        if over_quota:
+            self.reject("quota")
+
+    def check_breaker(self):
+        with self._lock:
+            if self._failures < LLM_BREAKER_FAILURES:
+                return
+            if time.monotonic() >= self._open_until and not self._trial:
+                self._trial = True  # half-open: this call decides
+                return
+        self.reject("unavailable")
+
+    def _take_slot(self, chat_id):
+        if self._in_flight >= self.max_concurrency:
+            return False
+        if chat_id is not None and self._chat_in_flight[chat_id] >= self.chat_concurrency:
+            return False
+        self._in_flight += 1
+        if chat_id is not None:
+            self._chat_in_flight[chat_id] += 1
+        return True
+
+    async def acquire(self, chat_id, deadline):
+        """Wait for a slot until `deadline`; False if none freed up in time."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._take_slot(chat_id):
+                    return True
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                return False
+
+    def release(self, chat_id):
+        with self._lock:
+            self._in_flight -= 1
+            if chat_id is not None:
+                self._chat_in_flight[chat_id] -= 1
+                if not self._chat_in_flight[chat_id]:
+                    del self._chat_in_flight[chat_id]
+            waiters, self._waiters = self._waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(lambda w=waiter: w.done() or w.set_result(None))
+
+    async def admit(self, purpose, chat_id, deadline):
+        """Breaker check plus a slot; raises LLMRejected if the call must not go out."""
+        self.check_breaker()
+        if not await self.acquire(chat_id, deadline):
+            self.end_trial()
+            self.reject("busy")
+
+    def end_trial(self):
+        """Let another half-open trial through when the admitted one never made its call."""
+        with self._lock:
+            self._trial = False
+
+    def record(self, error):
+        """Feed a call outcome to the breaker; `error` is None unless the provider looked unhealthy."""
+        with self._lock:
+            self._trial = False
+            self.stats["calls"] += 1
+            if error is None:
+                self._failures = 0
+                return
+            self.stats["failures"] += 1
+            self._failures += 1
+            if self._failures >= LLM_BREAKER_FAILURES:
+                if time.monotonic() >= self._open_until:
+                    self.stats["breaker_opened"] += 1
+                    logger.warning("LLM circuit breaker open for %ss after %s failures: %s",
+                                   LLM_BREAKER_COOLDOWN, self._failures, error)
+                self._open_until = time.monotonic() + LLM_BREAKER_COOLDOWN
+
+    def retry_delay(self, error, attempt, deadline):
+        """Seconds to wait before retrying `error`, or None if it can't be retried before the deadline."""
+        if not is_retryable(error) or attempt >= LLM_MAX_RETRIES:
+            return None
+        delay = random.uniform(0, min(LLM_RETRY_CAP, LLM_RETRY_BASE * 2 ** attempt))
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        if time.monotonic() + delay >= deadline:
+            return None
+        with self._lock:
+            self.stats["retries"] += 1
+        return delay
+
+    def breaker_state(self):
+        """0 = closed, 1 = half-open (trial allowed), 2 = open."""
+        with self._lock:
+            if self._failures < LLM_BREAKER_FAILURES:
+                return 0
+            return 1 if time.monotonic() >= self._open_until else 2
+
+    def coalesce(self, key):
+        """Return (future, leader): the leader makes the call and resolves the future for everyone."""
+        with self._lock:
+            future = self._coalesced.get(key)
+            if future is not None:
+                self.stats["coalesced"] += 1
+                return future, False
+            future = self._coalesced[key] = Future()
+            return future, True
+
+    def resolve(self, key, future, response=None, error=None):
+        with self._lock:
+            self._coalesced.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(response)
+
+    async def follow(self, future, deadline):
+        """Wait for a coalesced call's result until `deadline`; raises LLMRejected("busy") past it."""
+        waiter = asyncio.wrap_future(future)
+        # asyncio.wait leaves the waiter running on timeout; cancelling it would cancel the shared future
+        done, _ = await asyncio.wait([waiter], timeout=max(0.0, deadline - time.monotonic()))
+        if not done:
+            waiter.add_done_callback(lambda w: w.cancelled() or w.exception())  # nobody reads it now
+            self.reject("busy")
+        return waiter.result()
+
+    @contextlib.asynccontextmanager
+    async def streaming(self, purpose, chat_id=None, user_id=None):
+        """Admit a streaming call (no coalescing or retries) and hold its slot while it's consumed.
+
+        Yields the per-read timeout to pass to the SDK.
+        """
+        self.check_quota(purpose, user_id)
+        deadline = self.deadline(purpose)
+        await self.admit(purpose, chat_id, deadline)
+        try:
+            yield max(0.1, deadline - time.monotonic())
+        except Exception as e:
+            self.record(e if is_retryable(e) else None)
+            raise
+        else:
+            self.record(None)
+        finally:
+            self.release(chat_id)
+
+llm_governor = LLMGovernor(LLM_MAX_CONCURRENCY, LLM_CHAT_CONCURRENCY)
+
+def coalesce_key(messages, purpose, kwargs):
+    return hashlib.blake2b(json.dumps([purpose, messages, kwargs], sort_keys=True, ensure_ascii=False, default=str)
+                           .encode("utf-8"), digest_size=16).digest()
+
+async def complete_chat(messages, purpose, chat_id=None, user_id=None, **kwargs):
+    """Run a gpt-4o-mini chat completion through the LLM governor and record its latency and token usage.
+
+    Raises LLMRejected when the governor refuses the call.
+    """
+    llm_governor.check_quota(purpose, user_id)
+    deadline = llm_governor.deadline(purpose)
+    key = coalesce_key(messages, purpose, kwargs)
+    future, leader = llm_governor.coalesce(key)
+    if not leader:
+        return await llm_governor.follow(future, deadline)
+    response = error = None
+    try:
+        response = await request_completion(messages, purpose, chat_id, deadline, kwargs)
+        return response
+    except Exception as e:
+        error = e
+        raise
+    except BaseException:
+        error = LLMRejected("busy")  # the leader was cancelled; its followers get an error, not a cancellation
+        raise
+    finally:
+        llm_governor.resolve(key, future, response, error)
+
+async def request_completion(messages, purpose, chat_id, deadline, kwargs):
+    """Admit one chat completion and make it, retrying retryable errors until the deadline."""
+    await llm_governor.admit(purpose, chat_id, deadline)
+    attempt = 0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                response = await async_client.chat.completions.create(model="gpt-4o-mini", messages=messages,
+                                                                      timeout=max(0.1, deadline - time.monotonic()), **kwargs)
+            except Exception as e:
+                metrics.observe("llm_request_seconds", time.perf_counter() - started, purpose=purpose)
+                metrics.inc("llm_requests_total", purpose=purpose, status="error")
+                delay = llm_governor.retry_delay(e, attempt, deadline)
+                if delay is None:
+                    llm_governor.record(e if is_retryable(e) else None)
+                    raise
+                logger.warning("ChatGPT %s call failed (attempt %s), retrying in %.1fs: %s", purpose, attempt + 1, delay, e)
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            metrics.observe("llm_request_seconds", time.perf_counter() - started, purpose=purpose)
+            metrics.inc("llm_requests_total", purpose=purpose, status="ok")
+            llm_governor.record(None)
+            record_llm_usage(purpose, response.usage)
+            return response
+    except asyncio.CancelledError:
+        llm_governor.end_trial()  # a cancelled call says nothing about the provider
+        raise
+    finally:
+        llm_governor.release(chat_id)
+
+def build_chat_messages(message, user_id=None):
+    """Build the Chat Completions messages: static system prompt, user history turns, current message."""
+    messages = [SYSTEM_MESSAGE]
+    # Add user conversation context (token-budgeted window, current message excluded)
+    history = state_store.history_messages(user_id, current_message=message) if user_id else []
+    if history:
+        messages.extend(history)
+        logger.debug("ChatGPT (gpt-4o-mini) prompt context (UserID:%s): %s messages", user_id, len(history))
     messages.append({"role": "user", "content": message})
-    
+    return messages
+
+def finalize_reply(raw_response):
+    """Apply the fallback heuristics to a complete ChatGPT answer."""
+    # Fallback if response is irrelevant
+    if "sorry" in raw_response.lower() or "veri tabanımda" in raw_response.lower() or len(raw_response) < 10:
+        return FALLBACK_REPLY
+    return raw_response
+
+def rejected_reply(error):
+    """Canned reply for a call the LLM governor refused."""
+    logger.warning("ChatGPT reply skipped: %s", error)
+    return QUOTA_REPLY if error.reason == "quota" else ERROR_REPLY
+
+async def ask_chatgpt(message, user_id=None, chat_id=None):
+    """Use OpenAI Chat Completions API with gpt-4o-mini and optimized user conversation context."""
+    messages = await call_state_store(build_chat_messages, message, user_id)
     try:
-        logger.debug("ChatGPT API request sent: %s", datetime.now())
-        logger.debug("ChatGPT (gpt-4o-mini) prompt context (UserID:%s): %s", user_id, context if user_id in conversations else "No context")
-        logger.debug("ChatGPT current message: %s", message)
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages
-        )
-        logger.debug("ChatGPT API response received: %s", datetime.now())
+        logger.debug("ChatGPT current message: %s", redact(message))
+        response = await complete_chat(messages, "reply", chat_id=chat_id, user_id=user_id)
         raw_response = response.choices[0].message.content
-        logger.debug("ChatGPT raw response: %s", raw_response)
-        # Fallback if response is irrelevant
-        if "sorry" in raw_response.lower() or "veri tabanımda" in raw_response.lower() or len(raw_response) < 10:
-            output_text = "Hmm, tam anlayamadım kanka! 😅 Az önce bi' espri veya hikaye mi kastediyorsun? Ne konuşalım?"
-        else:
-            output_text = raw_response
-        return Response(output_text=output_text)
+        logger.debug("ChatGPT raw response: %s", redact(raw_response))
+        return Response(output_text=finalize_reply(raw_response))
+    except LLMRejected as e:
+        return Response(output_text=rejected_reply(e))
     except Exception as e:
-        logger.error(f"ChatGPT API request failed: {e}")
-        return Response(output_text="Hmm, bir hata oldu kanka! 😅 Bi' daha dene, ne konuşalım?")
+        logger.error("ChatGPT API request failed: %s", e)
+        return Response(output_text=ERROR_REPLY)
 
-def send_message(chat_id, text, reply_to_message_id=None, reply_markup=None, parse_mode="Markdown"):
-    """Send message via Telegram API."""
-    send_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+async def stream_chatgpt_reply(chat_id, reply_to_message_id, message, user_id=None):
+    """Post a placeholder reply right away and edit it as ChatGPT streams the answer.
+
+    Intermediate edits are plain text, at most one per STREAM_EDIT_INTERVAL and
+    only when the chat's send budget allows; the final edit applies the
+    fallback heuristics and uses Markdown. Returns the answer and its message id.
+    """
+    placeholder = await send_message(chat_id, STREAM_PLACEHOLDER, reply_to_message_id=reply_to_message_id, parse_mode=None)
+    if sent_message_id(placeholder) is None:
+        response = await ask_chatgpt(message, user_id, chat_id)
+        sent = await send_message(chat_id, response.output_text, reply_to_message_id=reply_to_message_id)
+        return response.output_text, sent_message_id(sent)
+    reply_id = sent_message_id(placeholder)
+
+    messages = await call_state_store(build_chat_messages, message, user_id)
+    parts = []
+    shown = ""
+    last_edit = 0.0
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        async with llm_governor.streaming("reply", chat_id, user_id) as timeout:
+            stream = await async_client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages,
+                stream=True,
+                timeout=timeout,
+                extra_body={"stream_options": {"include_usage": True}}
+            )
+            async for chunk in stream:
+                # With include_usage the last chunk carries the usage and no choices
+                record_llm_usage("reply", getattr(chunk, "usage", None))
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if not parts:
+                        metrics.observe("llm_first_token_seconds", time.perf_counter() - started, purpose="reply")
+                    parts.append(chunk.choices[0].delta.content)
+                now = time.monotonic()
+                if parts and now - last_edit >= STREAM_EDIT_INTERVAL:
+                    partial = "".join(parts)
+                    if partial != shown and await edit_message(chat_id, reply_id, partial + " ...", parse_mode=None, block=False):
+                        shown = partial
+                        last_edit = now
+        raw_response = "".join(parts)
+        logger.debug("ChatGPT raw response: %s", redact(raw_response))
+        output_text = finalize_reply(raw_response)
+    except LLMRejected as e:
+        status = "rejected"
+        output_text = rejected_reply(e)
+    except Exception as e:
+        status = "error"
+        logger.error("ChatGPT streaming request failed: %s", e)
+        output_text = ERROR_REPLY
+    metrics.observe("llm_request_seconds", time.perf_counter() - started, purpose="reply")
+    metrics.inc("llm_requests_total", purpose="reply", status=status)
+    if not await edit_message(chat_id, reply_id, output_text):
+        # Model output is not always valid Markdown
+        await edit_message(chat_id, reply_id, output_text, parse_mode=None)
+    return output_text, reply_id
+
+def remember_reply(chat_id, message_id, question, user_id, output_text):
+    if output_text in (FALLBACK_REPLY, ERROR_REPLY, QUOTA_REPLY):
+        return
+    if user_id:
+        # Keep our own answers in the history so follow-ups ("repeat that joke") have them
+        state_store.append_turn(user_id, "assistant", output_text)
+    faq_cache.remember(chat_id, message_id, question, output_text)
+
+@metrics.timed("bot_stage_seconds", stage="reply")
+async def reply_with_chatgpt(chat_id, reply_to_message_id, message, user_id=None):
+    """Answer a message with ChatGPT, streaming the reply when STREAM_REPLIES is on."""
+    if STREAM_REPLIES:
+        output_text, message_id = await stream_chatgpt_reply(chat_id, reply_to_message_id, message, user_id)
+    else:
+        output_text = (await ask_chatgpt(message, user_id, chat_id)).output_text
+        message_id = sent_message_id(await send_message(chat_id, output_text, reply_to_message_id=reply_to_message_id))
+    await call_state_store(remember_reply, chat_id, message_id, message, user_id, output_text)
+
+def message_payload(chat_id, text, reply_to_message_id=None, reply_markup=None, parse_mode="Markdown"):
     payload = {
         "chat_id": chat_id,
-        "text": text[:4096],  # Telegram mesaj limiti
-        "parse_mode": parse_mode
+        "text": text[:4096]  # Telegram mesaj limiti
     }
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
     if reply_to_message_id:
         payload["reply_to_message_id"] = reply_to_message_id
+        # The replied-to message may be deleted concurrently (see handle_violation).
+        payload["allow_sending_without_reply"] = True
     if reply_markup:
-        payload["reply_markup"] = json.dumps(reply_markup)
+        # Static keyboards arrive already serialized (see the Command Router section)
+        payload["reply_markup"] = reply_markup if isinstance(reply_markup, str) else json.dumps(reply_markup)
+    return payload
+
+def sent_message_id(response):
+    """Message id of a successful send, or None."""
+    if response is None or response.status_code != 200:
+        return None
     try:
-        logger.debug("Sending Telegram message: %s", text[:100])
-        response = requests.post(send_url, json=payload)
-        if response.status_code != 200:
-            logger.error("Failed to send Telegram message: %s", response.text)
-        else:
-            logger.debug("Telegram message sent: %s", text[:100])
+        return response.json()["result"]["message_id"]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def log_sent_message(response, text):
+    if response is None:
+        logger.error("Failed to send Telegram message: no response")
+    elif response.status_code != 200:
+        logger.error("Failed to send Telegram message: %s", response.text)
+    else:
+        logger.debug("Telegram message sent: %s", redact(text))
+
+async def send_message(chat_id, text, reply_to_message_id=None, reply_markup=None, parse_mode="Markdown"):
+    """Send message via Telegram API."""
+    payload = message_payload(chat_id, text, reply_to_message_id, reply_markup, parse_mode)
+    try:
+        logger.debug("Sending Telegram message: %s", redact(text))
+        response = await telegram_async.call("sendMessage", payload)
+        log_sent_message(response, text)
         return response
     except Exception as e:
-        logger.error(f"Failed to send Telegram message: {e}")
+        logger.error("Failed to send Telegram message: %s", e)
         return None
 
-def is_user_admin(chat_id, user_id):
-    """Check if user is an admin."""
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getChatMember"
+def edit_payload(chat_id, message_id, text, parse_mode):
+    payload = {"chat_id": chat_id, "message_id": message_id, "text": text[:4096]}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    return payload
+
+def edit_succeeded(response):
+    if response is None:
+        return False
+    if response.status_code != 200:
+        logger.warning("Failed to edit Telegram message: %s", response.text)
+        return False
+    return True
+
+async def edit_message(chat_id, message_id, text, parse_mode="Markdown", block=True):
+    """Edit a sent message via Telegram API. Returns True on success.
+
+    With block=False the edit is skipped instead of waiting for the rate limiter.
+    """
+    try:
+        response = await telegram_async.call("editMessageText", edit_payload(chat_id, message_id, text, parse_mode), block=block)
+        return edit_succeeded(response)
+    except Exception as e:
+        logger.error("Failed to edit Telegram message: %s", e)
+        return False
+
+# Admin Cache (per-chat admin sets, refreshed in bulk from getChatAdministrators)
+ADMIN_CACHE_TTL = float(os.environ.get("ADMIN_CACHE_TTL", 600))  # seconds
+ADMIN_CACHE_MAX_CHATS = int(os.environ.get("ADMIN_CACHE_MAX_CHATS", 1000))
+ADMIN_STATUSES = ("administrator", "creator")
+
+class AdminCache:
+    """LRU cache of chat id -> frozenset of admin user ids, with a TTL per chat."""
+
+    def __init__(self, ttl, max_chats):
+        self.ttl = ttl
+        self.max_chats = max_chats
+        self._entries = OrderedDict()  # chat_id -> (expires_at, admin ids)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "refreshes": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, chat_id):
+        """Return the cached admin set for a chat, or None if missing/expired."""
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None or entry[0] < time.monotonic():
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(chat_id)
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def put(self, chat_id, admins):
+        with self._lock:
+            self._entries[chat_id] = (time.monotonic() + self.ttl, frozenset(admins))
+            self._entries.move_to_end(chat_id)
+            self.stats["refreshes"] += 1
+            while len(self._entries) > self.max_chats:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, chat_id):
+        with self._lock:
+            if self._entries.pop(chat_id, None) is not None:
+                self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+admin_cache = AdminCache(ADMIN_CACHE_TTL, ADMIN_CACHE_MAX_CHATS)
+
+async def fetch_chat_admins(chat_id):
+    """Fetch the admin user ids of a chat with getChatAdministrators (None on failure)."""
+    if isinstance(chat_id, int) and chat_id > 0:
+        # Private chats have no administrators; Telegram rejects the call for them.
+        return frozenset()
+    try:
+        logger.debug("Fetching chat administrators: ChatID:%s", chat_id)
+        response = await telegram_async.call("getChatAdministrators", {"chat_id": chat_id})
+        if response is not None and response.status_code == 200:
+            members = response.json().get("result", [])
+            return frozenset(m["user"]["id"] for m in members if m.get("status") in ADMIN_STATUSES)
+        logger.error("Fetching chat administrators failed: %s", response.text if response is not None else "no response")
+    except Exception as e:
+        logger.error("Fetching chat administrators failed: %s", e)
+    return None
+
+def handle_chat_member_update(update):
+    """Drop the cached admin set of a chat when someone's admin status changes."""
+    member_update = update.get("chat_member") or update.get("my_chat_member")
+    chat_id = member_update.get("chat", {}).get("id")
+    old_status = member_update.get("old_chat_member", {}).get("status")
+    new_status = member_update.get("new_chat_member", {}).get("status")
+    if old_status != new_status and (old_status in ADMIN_STATUSES or new_status in ADMIN_STATUSES):
+        admin_cache.invalidate(chat_id)
+        logger.debug("Admin cache invalidated: ChatID:%s (%s -> %s)", chat_id, old_status, new_status)
+
+@metrics.timed("bot_stage_seconds", stage="admin_check")
+async def is_user_admin(chat_id, user_id):
+    """Check if user is an admin, using the cached admin set of the chat."""
+    admins = admin_cache.get(chat_id)
+    metrics.inc("admin_checks_total", cache="hit" if admins is not None else "miss")
+    if admins is None:
+        return await refresh_admin_status(chat_id, user_id)
+    return user_id in admins
+
+async def refresh_admin_status(chat_id, user_id):
+    """Fetch and cache the chat's admin set, falling back to a getChatMember check."""
+    admins = await fetch_chat_admins(chat_id)
+    if admins is None:
+        return await is_chat_member_admin(chat_id, user_id)
+    admin_cache.put(chat_id, admins)
+    return user_id in admins
+
+async def is_chat_member_admin(chat_id, user_id):
+    """Check if user is an admin with a single getChatMember call."""
     payload = {"chat_id": chat_id, "user_id": user_id}
     try:
         logger.debug("Checking admin status: UserID:%s, ChatID:%s", user_id, chat_id)
-        response = requests.post(url, json=payload)
-        if response.status_code == 200:
+        response = await telegram_async.call("getChatMember", payload)
+        if response is not None and response.status_code == 200:
             member_info = response.json().get("result", {})
             status = member_info.get("status")
             is_admin = status in ["administrator", "creator"]
             logger.debug("Admin check result: UserID:%s, Admin:%s", user_id, is_admin)
             return is_admin
         else:
-            logger.error("Admin check failed: %s", response.text)
+            logger.error("Admin check failed: %s", response.text if response is not None else "no response")
             return False
     except Exception as e:
-        logger.error(f"Admin check failed: {e}")
+        logger.error("Admin check failed: %s", e)
         return False
 
-def ban_user(chat_id, user_id):
+async def ban_user(chat_id, user_id):
     """Ban user via Telegram API."""
-    ban_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/banChatMember"
     payload = {"chat_id": chat_id, "user_id": user_id}
     try:
         logger.debug("Banning user: UserID:%s, ChatID:%s", user_id, chat_id)
-        response = requests.post(ban_url, json=payload)
-        if response.status_code != 200:
-            logger.error("Failed to ban user: %s", response.text)
+        response = await telegram_async.call("banChatMember", payload)
+        if response is None or response.status_code != 200:
+            logger.error("Failed to ban user: %s", response.text if response is not None else "no response")
         else:
             logger.debug("User banned successfully: UserID:%s", user_id)
         return response
     except Exception as e:
-        logger.error(f"Failed to ban user: {e}")
+        logger.error("Failed to ban user: %s", e)
         return None
 
-def delete_message(chat_id, message_id):
+async def delete_message(chat_id, message_id):
     """Delete message via Telegram API."""
-    delete_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/deleteMessage"
     payload = {"chat_id": chat_id, "message_id": message_id}
     try:
         logger.debug("Deleting message: MessageID:%s, ChatID:%s", message_id, chat_id)
-        response = requests.post(delete_url, json=payload)
-        if response.status_code == 200:
+        response = await telegram_async.call("deleteMessage", payload)
+        if response is not None and response.status_code == 200:
             logger.debug("Message deleted successfully: MessageID:%s", message_id)
         else:
-            logger.warning("Failed to delete message: %s", response.text)
+            logger.warning("Failed to delete message: %s", response.text if response is not None else "no response")
         return response
     except Exception as e:
-        logger.error(f"Failed to delete message: {e}")
+        logger.error("Failed to delete message: %s", e)
         return None
 
-def check_rules_violation(text):
-    """Check for rule violations using ChatGPT, excluding whitelisted links."""
-    for link in WHITELIST_LINKS:
-        if link.lower() in text.lower():
-            logger.debug("Whitelisted link detected: %s", link)
+# Local Pre-filter (decides clear-cut messages before the ChatGPT rule check)
+PREFILTER_BLOCK_SCORE = float(os.environ.get("PREFILTER_BLOCK_SCORE", 3.0))  # score >= this (with strong signals) -> violation
+PREFILTER_ALLOW_SCORE = float(os.environ.get("PREFILTER_ALLOW_SCORE", -1.0))  # score <= this -> clean
+
+SAFE_PHRASES = ["nasılsın", "merhaba", "selam", "naber", "hi", "hello", "good morning"]
+SOLIUM_TERMS = ["solium", "soliumcoin", "slm", "rewards", "presale", "staking"]
+PROFANITY_WORDS = [
+    # Only words that are insults in any context; names ("Dick") and mild words ("stupid question") go to the LLM.
+    "fuck", "fucking", "fucker", "shit", "bitch", "bastard", "asshole", "idiot", "idiots",
+    "moron", "retard", "cunt",
+    "amk", "orospu", "siktir", "piç", "yarrak", "göt", "salak", "gerizekalı", "ananı",
+]
+COMPETITOR_TICKERS = [
+    "bitcoin", "btc", "ethereum", "eth", "doge", "dogecoin", "shib", "shiba", "pepe", "xrp", "ripple",
+    "cardano", "tron", "trx", "floki", "bonk", "notcoin", "litecoin", "ltc", "memecoin",
+]
+PROMO_WORDS = [
+    "buy", "pump", "moon", "100x", "1000x", "giveaway", "airdrop", "guaranteed", "profit", "signals",
+    "dm me", "join now", "don't miss", "satın al", "kazan", "kazanç",
+]
+URL_PATTERN = (
+    r"(?:https?://|www\.)[^\s]+"
+    # Bare domains: only TLDs rarely seen outside links ("react.app" is not one), never the domain of an email
+    r"|(?<![\w@.-])(?:[a-z0-9-]+\.)+(?:com|net|org|io|xyz|me|info|finance|ly|vip|ru|cn|tk)\b(?![@-])(?:/[^\s]*)?"
+)
+
+# Link extraction and official-link index
+URL_REGEX = re.compile(URL_PATTERN, re.IGNORECASE)
+LINK_ENTITY_TYPES = ("url", "text_link")
+
+def entity_text(text, entity):
+    """Slice an entity out of the text; Telegram offsets count UTF-16 code units."""
+    encoded = text.encode("utf-16-le")
+    start = entity["offset"] * 2
+    return encoded[start:start + entity["length"] * 2].decode("utf-16-le", errors="ignore")
+
+def extract_links(text, entities=None):
+    """Return the links in a message, from Telegram's entities when available."""
+    if entities is not None:
+        return [entity["url"] if entity["type"] == "text_link" else entity_text(text, entity)
+                for entity in entities if entity.get("type") in LINK_ENTITY_TYPES]
+    return URL_REGEX.findall(text)
+
+def normalize_link(link):
+    """Split a link into (host, path segments) with the host lower-cased and without www/port."""
+    link = link.strip().rstrip(".,;:!?)]}'\"")
+    if "://" not in link:
+        link = "http://" + link
+    try:
+        parts = urlsplit(link)
+        host = (parts.hostname or "").rstrip(".")
+    except ValueError:
+        return "", []
+    if host.startswith("www."):
+        host = host[4:]
+    return host, [segment for segment in parts.path.lower().split("/") if segment]
+
+class LinkWhitelist:
+    """Official links indexed as host -> trie of path segments.
+
+    An entry allows its own path and everything below it; an entry without a
+    path allows the whole site, subdomains included.
+    """
+    END = "/"  # marks an allowed prefix in the trie (never a path segment)
+
+    def __init__(self, links):
+        self._hosts = {}
+        for link in links:
+            if link.startswith("@"):
+                # Usernames are reachable as t.me/<name> links
+                for host in ("t.me", "telegram.me"):
+                    self.add(f"{host}/{link[1:]}")
+            else:
+                self.add(link)
+
+    def add(self, link):
+        host, segments = normalize_link(link.lower())
+        node = self._hosts.setdefault(host, {})
+        for segment in segments:
+            node = node.setdefault(segment, {})
+        node[self.END] = True
+
+    def allows(self, link):
+        host, segments = normalize_link(link)
+        node = self._hosts.get(host)
+        if node is None:
+            # Whole-site entries also cover subdomains
+            labels = host.split(".")
+            for i in range(1, len(labels) - 1):
+                parent = self._hosts.get(".".join(labels[i:]))
+                if parent is not None and self.END in parent:
+                    return True
             return False
+        for segment in segments:
+            if self.END in node:
+                return True
+            node = node.get(segment)
+            if node is None:
+                return False
+        return self.END in node
+
+link_whitelist = LinkWhitelist(WHITELIST_LINKS)
+
+def word_alternation(words):
+    # Longest first so that e.g. "fucking" wins over "fuck"
+    return "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+
+# One pass over the message finds every signal; the named group tells which list matched.
+PREFILTER_REGEX = re.compile(
+    rf"(?P<url>{URL_PATTERN})"
+    rf"|(?P<cashtag>\$[a-z]{{2,10}}\b)"
+    rf"|\b(?:(?P<profanity>{word_alternation(PROFANITY_WORDS)})"
+    rf"|(?P<solium>{word_alternation(SOLIUM_TERMS)})"
+    rf"|(?P<ticker>{word_alternation(COMPETITOR_TICKERS)})"
+    rf"|(?P<promo>{word_alternation(PROMO_WORDS)})"
+    rf"|(?P<safe>{word_alternation(SAFE_PHRASES)}))\b"
+)
 
-    if not text or len(text.strip()) < 5:
-        logger.debug("Empty or too short message, violation check skipped: %s", text)
+# Lightweight linear scoring model over the matched signals (each signal counted at most twice).
+# Tickers and promo words alone are ordinary crypto chatter ("btc is down", "can I buy with ETH?"):
+# they only move the score, so such messages go to ChatGPT rather than being blocked here.
+PREFILTER_WEIGHTS = {"ticker": 1.0, "cashtag": 1.5, "promo": 1.0, "solium": -2.5, "safe": -2.0}
+PREFILTER_STRONG_SIGNALS = ("cashtag", "promo")  # all required before the score may block a message
+
+class MessageSignals:
+    """Signals extracted from a message in a single regex pass, plus per-link verdicts."""
+    __slots__ = ("text", "lowered", "hits", "links")
+
+    def __init__(self, text, entities=None):
+        self.text = text
+        self.lowered = text.lower()
+        self.hits = defaultdict(list)
+        for match in PREFILTER_REGEX.finditer(self.lowered):
+            self.hits[match.lastgroup].append(match.group())
+        if entities is None:
+            links = self.hits.get("url", ())
+        else:
+            links = extract_links(text, entities)
+        self.links = [(link, link_whitelist.allows(link)) for link in links]
+
+    def score(self):
+        total = sum(weight * min(len(self.hits[name]), 2) for name, weight in PREFILTER_WEIGHTS.items() if name in self.hits)
+        letters = [c for c in self.text if c.isalpha()]
+        if len(letters) >= 15 and sum(c.isupper() for c in letters) / len(letters) > 0.7:
+            total += 0.5  # shouting
+        if "!!" in self.text:
+            total += 0.5
+        return total
+
+def tier_trivial(signals):
+    if len(signals.text.strip()) < 5:
         return False
+    return None
+
+def tier_blocklist(signals):
+    if "profanity" in signals.hits:
+        return True
+    # Official links only keep this rule from firing; the text around them is still judged.
+    if any(not official for _, official in signals.links):
+        return True
+    return None
 
-    safe_phrases = ["nasılsın", "merhaba", "selam", "naber", "hi", "hello", "good morning"]
-    solium_terms = ["solium", "slm", "rewards", "presale", "staking"]
-    if any(phrase in text.lower() for phrase in safe_phrases) or any(term in text.lower() for term in solium_terms):
-        logger.debug("Safe or Solium-related message, violation check skipped: %s", text)
+def tier_score(signals):
+    score = signals.score()
+    if score >= PREFILTER_BLOCK_SCORE and all(name in signals.hits for name in PREFILTER_STRONG_SIGNALS):
+        return True
+    if score <= PREFILTER_ALLOW_SCORE:
         return False
+    return None
 
-    prompt = """Does the following message violate these rules? (Write only YES/NO):
-Rules:
-1. External links other than official Solium links (e.g., https://soliumcoin.com, https://t.me/+KDhk3UEwZAg3MmU0) are prohibited.
-2. Promoting cryptocurrencies or projects other than Solium is prohibited (e.g., 'Buy Bitcoin', 'Ethereum is great').
-3. Profanity, insults, or inappropriate language are prohibited (e.g., 'stupid', 'damn', 'fuck').
-4. Empty messages, system notifications, group join events, or casual greetings (e.g., 'nasılsın', 'merhaba') are NOT violations.
-Examples:
-- 'Nasılsın' -> NO
-- 'Merhaba' -> NO
-- 'Buy Ethereum now!' -> YES
-- 'Check out https://example.com' -> YES
-- 'You idiot!' -> YES
-- 'Solium rewards ne zaman?' -> NO
-Message: '{}'
-""".format(text)
+# Tiers run in order; each returns True (violation), False (clean) or None (undecided).
+PREFILTER_TIERS = [
+    ("trivial", tier_trivial),
+    ("blocklist", tier_blocklist),
+    ("score", tier_score),
+]
+prefilter_stats = defaultdict(int)  # "<tier>.violation" / "<tier>.clean" / "llm.escalated"
+prefilter_lock = threading.Lock()
+
+def register_prefilter_tier(name, tier, index=None):
+    """Add a pre-filter tier, by default just before the scoring tier."""
+    if index is None:
+        index = len(PREFILTER_TIERS) - 1
+    PREFILTER_TIERS.insert(index, (name, tier))
+
+def prefilter_message(text, entities=None):
+    """Run the local tiers; returns (verdict, tier name), verdict None meaning 'ask the LLM'."""
+    signals = MessageSignals(text, entities)
+    for name, tier in PREFILTER_TIERS:
+        verdict = tier(signals)
+        if verdict is not None:
+            with prefilter_lock:
+                prefilter_stats[f"{name}.{'violation' if verdict else 'clean'}"] += 1
+            return verdict, name
+    with prefilter_lock:
+        prefilter_stats["llm.escalated"] += 1
+    return None, "llm"
+
+# Moderation Verdict Cache (normalized content hash + MinHash near-duplicate index)
+VERDICT_CACHE_SIZE = int(os.environ.get("VERDICT_CACHE_SIZE", 10000))
+VERDICT_CACHE_TTL = float(os.environ.get("VERDICT_CACHE_TTL", 6 * 3600))  # seconds
+VERDICT_NEAR_DUPLICATES = os.environ.get("VERDICT_NEAR_DUPLICATES", "1") == "1"
+VERDICT_NEAR_DUPLICATE_SIMILARITY = float(os.environ.get("VERDICT_NEAR_DUPLICATE_SIMILARITY", 0.75))  # Jaccard
+MINHASH_MIN_WORDS = 5  # shorter texts are too easy to confuse
+MINHASH_BANDS = 8
+MINHASH_ROWS = 4  # signature length = bands * rows
+MINHASH_PRIME = (1 << 61) - 1
+_minhash_random = random.Random(20240601)  # fixed seed: signatures must be stable across restarts
+MINHASH_PERMUTATIONS = [(_minhash_random.randrange(1, MINHASH_PRIME), _minhash_random.randrange(MINHASH_PRIME))
+                        for _ in range(MINHASH_BANDS * MINHASH_ROWS)]
+
+ZERO_WIDTH_REGEX = re.compile("[\u00ad\u200b-\u200f\u2060-\u2064\ufeff]")
+WORD_REGEX = re.compile(r"\w+")
+
+def canonical_link(link):
+    host, segments = normalize_link(link)
+    return "/".join([host] + segments)
+
+def normalize_for_hash(text, entities=None):
+    """Case-fold, strip zero-width characters, canonicalize URLs and collapse whitespace."""
+    text = unicodedata.normalize("NFKC", text)
+    text = ZERO_WIDTH_REGEX.sub("", text).casefold()
+    text = URL_REGEX.sub(lambda match: canonical_link(match.group()), text)
+    text = " ".join(text.split())
+    # Hidden links change the verdict without changing the visible text
+    hidden = [canonical_link(e["url"]) for e in entities or () if e.get("type") == "text_link"]
+    if hidden:
+        text += " " + " ".join(hidden)
+    return text
+
+def content_hash(normalized):
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).digest()
+
+def minhash(normalized):
+    """MinHash signature of the message's word set (None for texts too short to compare)."""
+    words = set(WORD_REGEX.findall(normalized))
+    if len(words) < MINHASH_MIN_WORDS:
+        return None
+    hashed = [int.from_bytes(hashlib.blake2b(w.encode("utf-8"), digest_size=8).digest(), "big") for w in words]
+    return tuple(min((a * h + b) % MINHASH_PRIME for h in hashed) for a, b in MINHASH_PERMUTATIONS)
+
+class VerdictCache:
+    """Bounded LRU + TTL cache of moderation verdicts keyed by normalized content hash.
+
+    Violations are also indexed by MinHash with LSH banding, so small
+    variations of known spam (a changed word, an extra emoji) are found
+    without scanning the whole cache.
+    """
+
+    def __init__(self, max_size, ttl, near_duplicates=True):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.near_duplicates = near_duplicates
+        self._entries = OrderedDict()  # hash -> (expires_at, verdict, signature)
+        self._bands = defaultdict(set)  # (band, rows) -> hashes of violations
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "near_hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def band_keys(signature):
+        return [(band, signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]) for band in range(MINHASH_BANDS)]
+
+    def _remove(self, key):
+        _, _, signature = self._entries.pop(key)
+        if signature is not None:
+            for band_key in self.band_keys(signature):
+                bucket = self._bands[band_key]
+                bucket.discard(key)
+                if not bucket:
+                    del self._bands[band_key]
+
+    def _near_duplicate(self, signature, now):
+        checked = set()
+        for band_key in self.band_keys(signature):
+            for key in self._bands.get(band_key, ()):
+                if key in checked:
+                    continue
+                checked.add(key)
+                expires_at, verdict, other = self._entries[key]
+                similarity = sum(x == y for x, y in zip(signature, other)) / len(signature)
+                if expires_at >= now and similarity >= VERDICT_NEAR_DUPLICATE_SIMILARITY:
+                    return verdict
+        return None
+
+    def get(self, normalized):
+        """Return the cached verdict for a normalized message, or None."""
+        key = content_hash(normalized)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] >= now:
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return entry[1]
+                self._remove(key)
+            has_index = self.near_duplicates and self._bands
+        if has_index:
+            signature = minhash(normalized)
+            with self._lock:
+                if signature is not None and self._near_duplicate(signature, now) is not None:
+                    self.stats["near_hits"] += 1
+                    return True
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, normalized, verdict):
+        key = content_hash(normalized)
+        # Only violations are indexed: a near-duplicate must never launder a clean verdict onto spam.
+        signature = minhash(normalized) if self.near_duplicates and verdict else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, verdict, signature)
+            if signature is not None:
+                for band_key in self.band_keys(signature):
+                    self._bands[band_key].add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+
+    def purge(self):
+        """Drop every cached verdict; returns how many were removed."""
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            self._bands.clear()
+            return count
+
+    def size(self):
+        return len(self._entries)
 
-    logger.debug("Starting rule violation check: %s", text)
-    response = ask_chatgpt(prompt).output_text
-    logger.debug("Rule violation check result: %s for %s", response, text)
-    return "YES" in response.upper()
+verdict_cache = VerdictCache(VERDICT_CACHE_SIZE, VERDICT_CACHE_TTL, VERDICT_NEAR_DUPLICATES)
 
-def handle_violation(chat_id, user_id, message_id):
+@metrics.timed("bot_stage_seconds", stage="moderation")
+async def check_rules_violation(text, entities=None):
+    """Check for rule violations; only messages the local pre-filter can't decide go to ChatGPT."""
+    verdict, normalized = local_rules_verdict(text, entities)
+    if verdict is not None:
+        return verdict
+
+    logger.debug("Starting rule violation check: %s", redact(text))
+    is_violation = await moderation_batcher.classify(text) if MODERATION_BATCH_SIZE > 1 else None
+    if is_violation is None:
+        is_violation = await classify_message(text)
+    if is_violation is None:
+        return False
+    verdict_cache.put(normalized, is_violation)
+    return is_violation
+
+def local_rules_verdict(text, entities=None):
+    """Decide a message without ChatGPT if possible.
+
+    Returns (verdict, None) when the pre-filter or the verdict cache decided,
+    otherwise (None, normalized text) to cache the ChatGPT verdict under.
+    """
+    if not text:
+        return False, None
+
+    verdict, tier = prefilter_message(text, entities)
+    metrics.inc("moderation_decisions_total", stage="prefilter" if verdict is not None else "escalated")
+    if verdict is not None:
+        logger.debug("Pre-filter tier '%s' decided violation=%s: %s", tier, verdict, redact(text))
+        return verdict, None
+
+    normalized = normalize_for_hash(text, entities)
+    cached = verdict_cache.get(normalized)
+    metrics.inc("moderation_decisions_total", stage="cache" if cached is not None else "llm")
+    if cached is not None:
+        logger.debug("Cached rule violation verdict: %s for %s", cached, redact(text))
+        return cached, None
+    return None, normalized
+
+async def classify_message(text):
+    """Ask ChatGPT whether a message breaks the rules; None if the check failed."""
+    try:
+        response = await complete_chat([MODERATION_MESSAGE, {"role": "user", "content": text}], "moderation",
+                                       max_tokens=2, temperature=0)
+        answer = response.choices[0].message.content or ""
+        logger.debug("Rule violation check result: %s for %s", answer, redact(text))
+        return "YES" in answer.upper()
+    except Exception as e:
+        logger.error("Rule violation check failed: %s", e)
+        return None
+
+# Moderation Batching (pending messages classified together in one ChatGPT call)
+MODERATION_BATCH_SIZE = int(os.environ.get("MODERATION_BATCH_SIZE", 20))  # 1 = no batching
+MODERATION_BATCH_WINDOW = float(os.environ.get("MODERATION_BATCH_WINDOW", 0.25))  # max seconds a message waits for company
+MODERATION_BATCH_TIMEOUT = float(os.environ.get("MODERATION_BATCH_TIMEOUT", 30))  # max seconds a caller waits for its verdict
+MODERATION_BATCH_CONCURRENCY = int(os.environ.get("MODERATION_BATCH_CONCURRENCY", 4))  # batches in flight at once
+
+async def classify_batch(texts):
+    """Classify several messages with one ChatGPT call; returns {index: verdict} for the verdicts it got."""
+    payload = json.dumps([{"id": i, "text": text} for i, text in enumerate(texts)], ensure_ascii=False)
+    response = await complete_chat(
+        [BATCH_MODERATION_MESSAGE, {"role": "user", "content": payload}],
+        "moderation",
+        temperature=0,
+        max_tokens=20 + 16 * len(texts),
+        extra_body={"response_format": {"type": "json_object"}}  # not a named argument in the pinned SDK
+    )
+    verdicts = {}
+    for item in json.loads(response.choices[0].message.content).get("verdicts", []):
+        if isinstance(item, dict) and isinstance(item.get("id"), int) and isinstance(item.get("violation"), bool) \
+                and 0 <= item["id"] < len(texts):
+            verdicts[item["id"]] = item["violation"]
+    return verdicts
+
+class ModerationBatcher:
+    """Collects messages waiting for an LLM verdict and classifies them in batches.
+
+    A batch is sent when it reaches MODERATION_BATCH_SIZE messages, when its
+    first message has waited MODERATION_BATCH_WINDOW seconds, or as soon as
+    every update in flight is already waiting in it (`in_flight`, set by the
+    update dispatcher), since then nothing else can join. Batches are sent
+    from core_loop, up to MODERATION_BATCH_CONCURRENCY at a time. Messages whose
+    caller gave up waiting are dropped, and messages the batch answer does not
+    cover (malformed or partial JSON) resolve to None; in both cases the
+    caller falls back to a single-message check.
+    """
+
+    def __init__(self, batch_size, window, concurrency=MODERATION_BATCH_CONCURRENCY):
+        self.batch_size = batch_size
+        self.window = window
+        self.in_flight = None  # callable returning how many updates are being handled right now
+        self._queue = queue.Queue()
+        self._thread = None
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self.stats = {"batches": 0, "messages": 0, "fallbacks": 0, "malformed": 0, "abandoned": 0, "early_flushes": 0}
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="moderation-batcher", daemon=True)
+                self._thread.start()
+
+    def submit(self, text):
+        """Queue a message; returns a Future resolving to its verdict or None. Cancel it to give up."""
+        if self._thread is None:
+            self._start()
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    async def classify(self, text):
+        """Return the violation verdict for a message, or None if the batch gave none."""
+        future = self.submit(text)
+        try:
+            # On timeout wait_for cancels the future: not classified yet, it is kept out of its batch
+            return await asyncio.wait_for(asyncio.wrap_future(future), MODERATION_BATCH_TIMEOUT)
+        except Exception as e:
+            logger.error("Batched rule violation check failed: %s", e)
+            return None
+
+    def _complete(self, batch):
+        """True when nobody else can join the batch: every update in flight is waiting in it."""
+        if self.in_flight is None:
+            return False
+        waiting = sum(1 for _, future in batch if not future.cancelled())
+        return waiting >= self.in_flight() and self._queue.empty()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.batch_size:
+                if self._complete(batch):
+                    with self._lock:
+                        self.stats["early_flushes"] += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    # With `in_flight` known, wake up often: an update finishing elsewhere can complete the batch
+                    batch.append(self._queue.get(timeout=min(remaining, 0.01) if self.in_flight else remaining))
+                except queue.Empty:
+                    continue
+            self._slots.acquire()  # more batches than this wait here, gathering more messages
+            core_loop.spawn(self._dispatch(batch))
+
+    async def _dispatch(self, batch):
+        try:
+            await self._classify(batch)
+        finally:
+            self._slots.release()
+
+    async def _classify(self, batch):
+        live = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+        if len(live) < len(batch):
+            with self._lock:
+                self.stats["abandoned"] += len(batch) - len(live)
+        if not live:
+            return
+        texts = [text for text, _ in live]
+        verdicts = {}
+        try:
+            if len(live) == 1:
+                verdicts = {0: await classify_message(texts[0])}
+            else:
+                try:
+                    verdicts = await classify_batch(texts)
+                except Exception as e:
+                    with self._lock:
+                        self.stats["malformed"] += 1
+                    logger.error("Batched rule violation check failed: %s", e)
+                missing = len(live) - len(verdicts)
+                with self._lock:
+                    self.stats["batches"] += 1
+                    self.stats["messages"] += len(live)
+                    self.stats["fallbacks"] += missing
+                if missing:
+                    logger.warning("Batched rule violation check missed %s of %s verdicts", missing, len(live))
+                logger.debug("Batched rule violation check: %s messages, verdicts %s", len(live), verdicts)
+        finally:
+            for index, (_, future) in enumerate(live):
+                future.set_result(verdicts.get(index))
+
+moderation_batcher = ModerationBatcher(MODERATION_BATCH_SIZE, MODERATION_BATCH_WINDOW)
+
+# FAQ Answer Cache (BM25 retrieval over a curated Solium knowledge base, answered without ChatGPT)
+FAQ_ENABLED = os.environ.get("FAQ_ENABLED", "1") == "1"
+FAQ_MIN_CONFIDENCE = float(os.environ.get("FAQ_MIN_CONFIDENCE", 0.6))  # 0..1, below this the LLM answers
+FAQ_MIN_COVERAGE = float(os.environ.get("FAQ_MIN_COVERAGE", 1.0))  # share of question terms the entry must know
+FAQ_MIN_MARGIN = float(os.environ.get("FAQ_MIN_MARGIN", 1.2))  # best entry score / runner-up score
+FAQ_APPROVED_PATH = os.environ.get("FAQ_APPROVED_PATH")  # JSON file persisting admin-approved answers (optional)
+FAQ_PENDING_ANSWERS = int(os.environ.get("FAQ_PENDING_ANSWERS", 1000))  # recent bot answers that can be approved
+FAQ_STEM_LENGTH = 5  # words are cut to their first 5 characters, a strong stemmer for Turkish suffixes
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+US_NOTICE = {"en": "(Solium is not available in some regions, including the USA.)",
+             "tr": "(Solium, ABD dahil bazı bölgelerde kullanılamaz.)"}
+NOT_ADVICE = {"en": "This is not financial advice.", "tr": "Bu bir yatırım tavsiyesi değildir."}
+
+# Facts from INTRODUCTION_MESSAGE and the /rewards text
+FAQ_KNOWLEDGE_BASE = [
+    {
+        "questions": {
+            "en": ["what is the total supply of solium", "how many slm tokens are there", "slm max supply"],
+            "tr": ["solium toplam arz ne kadar", "kaç tane slm token var", "slm toplam arzı kaç", "maksimum arz"],
+        },
+        "answers": {
+            "en": f"Solium (SLM) has a total supply of 100,000,000 SLM. {US_NOTICE['en']}",
+            "tr": f"Solium (SLM) toplam arzı 100.000.000 SLM'dir. {US_NOTICE['tr']}",
+        },
+    },
+    {
+        "questions": {
+            "en": ["how much of the supply is in the presale", "what is the presale allocation", "solium presale share"],
+            "tr": ["ön satış payı ne kadar", "presale oranı kaç", "ön satışta kaç slm var", "presale ne kadar"],
+        },
+        "answers": {
+            "en": f"The presale holds 50,000,000 SLM, 50% of the total supply. {NOT_ADVICE['en']} {US_NOTICE['en']}",
+            "tr": f"Ön satışta 50.000.000 SLM var, yani toplam arzın %50'si. {NOT_ADVICE['tr']} {US_NOTICE['tr']}",
+        },
+    },
+    {
+        "questions": {
+            "en": ["which blockchain is solium on", "what chains does slm support", "which chain is slm on",
+                   "what network is solium on", "is solium on bsc or solana"],
+            "tr": ["solium hangi ağda", "hangi blockchain üzerinde", "slm hangi zincirde", "hangi network", "bsc mi solana mı"],
+        },
+        "answers": {
+            "en": f"Solium runs on Binance Smart Chain (BSC) and Solana, connected by a cross-chain bridge. {US_NOTICE['en']}",
+            "tr": f"Solium, Binance Smart Chain (BSC) ve Solana üzerinde çalışır; iki ağ cross-chain köprüyle bağlıdır. {US_NOTICE['tr']}",
+        },
+    },
+    {
+        "questions": {
+            "en": ["is solium available in the usa", "can us residents buy slm", "can i buy from the us",
+                   "us restriction", "can americans join"],
+            "tr": ["abd'de solium var mı", "abd'den alabilir miyim", "amerika'dan alınabilir mi", "abd kısıtlaması",
+                   "amerikalılar katılabilir mi"],
+        },
+        "answers": {
+            "en": "No. Solium is not available to residents of the USA, and it is restricted in some other regions too.",
+            "tr": "Hayır. Solium ABD'de yaşayanlar için kullanılamaz; bazı başka bölgelerde de kısıtlıdır.",
+        },
+    },
+    {
+        "questions": {
+            "en": ["what are the community rewards", "when are the rewards", "when are rewards distributed", "rewards schedule",
+                   "how do i get slm rewards", "how much is the airdrop"],
+            "tr": ["topluluk ödülleri nedir", "ödüller ne zaman dağıtılıyor", "rewards ne zaman",
+                   "ödül nasıl alırım", "airdrop ne kadar"],
+        },
+        "answers": {
+            "en": "Community Rewards total 10,000,000 SLM (10% of supply), distributed as 1M SLM every 7 days. "
+                  f"Join https://t.me/+KDhk3UEwZAg3MmU0 to participate. {US_NOTICE['en']}",
+            "tr": "Topluluk ödülleri toplam 10.000.000 SLM (arzın %10'u); her 7 günde 1M SLM dağıtılır. "
+                  f"Katılmak için: https://t.me/+KDhk3UEwZAg3MmU0 {US_NOTICE['tr']}",
+        },
+    },
+    {
+        "questions": {
+            "en": ["what is solium", "tell me about solium", "what are solium features", "does solium have staking or dao"],
+            "tr": ["solium nedir", "solium hakkında bilgi ver", "solium özellikleri neler", "staking ve dao var mı"],
+        },
+        "answers": {
+            "en": "Solium (SLM) is a Web3 project focused on transparency and community governance: 100% fair launch, "
+                  f"staking, DAO governance, GameFi and a cross-chain bridge. {NOT_ADVICE['en']} {US_NOTICE['en']}",
+            "tr": "Solium (SLM), şeffaflık ve topluluk yönetimine odaklanan bir Web3 projesidir: %100 adil lansman, "
+                  f"staking, DAO yönetimi, GameFi ve cross-chain köprü. {NOT_ADVICE['tr']} {US_NOTICE['tr']}",
+        },
+    },
+]
+
+TURKISH_LETTERS = set("çğıöşüÇĞİÖŞÜ")
+TURKISH_HINTS = {"ne", "nedir", "mi", "mı", "mu", "mü", "kaç", "nasıl", "hangi", "var", "ve", "bu", "bir", "zaman",
+                 "için", "neler", "nerede", "kadar", "bana", "hakkında", "merhaba", "selam", "miyim", "misin", "mısın",
+                 "musun", "miyiz", "sence", "lütfen", "neden", "niye", "de", "da"}
+# Function words of both languages, and how the bot is addressed; they say nothing about the topic
+FAQ_STOPWORDS = {
+    "rose", "admin", "the", "a", "an", "is", "are", "of", "in", "on", "to", "do", "does", "i", "me", "my", "can",
+    "what", "how", "which", "when", "there", "about", "or", "and", "it", "please", "tell", "hi", "hello", "hey",
+    "ne", "nedir", "mi", "mı", "mu", "mü", "mıdır", "midir", "kaç", "nasıl", "hangi", "var", "ve", "bu", "bir",
+    "için", "neler", "kadar", "bana", "hakkında", "ver", "merhaba", "selam", "kanka", "acaba", "peki", "ya",
+    "miyim", "misin", "mısın", "musun", "de", "da", "den", "dan",
+}
+
+def detect_language(text):
+    """Tell Turkish ("tr") from English ("en") by Turkish letters and common Turkish words."""
+    if any(char in TURKISH_LETTERS for char in text):
+        return "tr"
+    words = set(WORD_REGEX.findall(text.lower()))
+    return "tr" if words & TURKISH_HINTS else "en"
+
+def fold_turkish(text):
+    """Lowercase with Turkish dotted/dotless i rules, then drop diacritics (ş -> s, ı -> i, ...)."""
+    text = text.replace("I", "ı").replace("İ", "i").lower()
+    text = unicodedata.normalize("NFKD", text.replace("ı", "i"))
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+FOLDED_STOPWORDS = {fold_turkish(word) for word in FAQ_STOPWORDS}
+
+def faq_terms(text):
+    """Normalized, stemmed index terms of a question."""
+    words = WORD_REGEX.findall(fold_turkish(text.replace("'", " ").replace("’", " ")))
+    return [word[:FAQ_STEM_LENGTH] for word in words if word not in FOLDED_STOPWORDS]
+
+class FAQIndex:
+    """Okapi BM25 over the question variants of every knowledge base entry.
+
+    A query's confidence is the lower of two ratios: its BM25 score against
+    the best matching question relative to that question's score against
+    itself, and the share of query terms found in any variant of the entry.
+    The first keeps one-word overlaps from passing. The second keeps questions
+    about something else ("total supply of bitcoin") or messages that also ask
+    for more (a joke, a story) from passing; below FAQ_MIN_COVERAGE there is
+    no match at all.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.docs = []  # (entry index, term frequencies, length)
+        self.vocabularies = [set() for _ in entries]  # terms of all variants of an entry, both languages
+        for index, entry in enumerate(entries):
+            for questions in entry["questions"].values():
+                for question in questions:
+                    terms = faq_terms(question)
+                    if terms:
+                        self.docs.append((index, Counter(terms), len(terms)))
+                        self.vocabularies[index].update(terms)
+        self.avg_length = sum(length for _, _, length in self.docs) / max(1, len(self.docs))
+        document_frequency = Counter(term for _, frequencies, _ in self.docs for term in frequencies)
+        self.idf = {term: math.log(1 + (len(self.docs) - df + 0.5) / (df + 0.5)) for term, df in document_frequency.items()}
+        self.postings = defaultdict(list)
+        for doc_id, (_, frequencies, _) in enumerate(self.docs):
+            for term in frequencies:
+                self.postings[term].append(doc_id)
+
+    def score(self, terms, doc_id):
+        _, frequencies, length = self.docs[doc_id]
+        total = 0.0
+        for term in terms:
+            tf = frequencies.get(term)
+            if tf:
+                total += self.idf[term] * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / self.avg_length))
+        return total
+
+    def search(self, text):
+        """Return (entry, confidence) of the best match, or (None, 0.0)."""
+        terms = set(faq_terms(text))
+        candidates = {doc_id for term in terms for doc_id in self.postings.get(term, ())}
+        if not candidates:
+            return None, 0.0
+        best_by_entry = {}
+        for doc_id in candidates:
+            entry_index = self.docs[doc_id][0]
+            score = self.score(terms, doc_id)
+            if score > best_by_entry.get(entry_index, (0.0, None))[0]:
+                best_by_entry[entry_index] = (score, doc_id)
+        ranked = sorted(best_by_entry.items(), key=lambda item: item[1][0], reverse=True)
+        entry_index, (score, doc_id) = ranked[0]
+        if len(ranked) > 1 and score < FAQ_MIN_MARGIN * ranked[1][1][0]:
+            return None, 0.0  # two entries fit about equally well
+        doc_terms = self.docs[doc_id][1]
+        self_score = self.score(doc_terms.keys(), doc_id)
+        coverage = len(terms & self.vocabularies[entry_index]) / len(terms)
+        if coverage < FAQ_MIN_COVERAGE:
+            return None, coverage  # asks about something the entry never mentions ("bitcoin", "uk")
+        return self.entries[entry_index], min(1.0, score / self_score, coverage)
+
+class FAQCache:
+    """Answers frequent Solium questions from the knowledge base, learning from approved ChatGPT answers.
+
+    Bot answers are remembered for a while by (chat id, message id) so an
+    admin can approve one by replying /approvefaq to it; the question and
+    answer then become a new entry (and are saved to FAQ_APPROVED_PATH).
+    """
+
+    def __init__(self, entries, approved_path=None, pending_size=FAQ_PENDING_ANSWERS):
+        self.approved_path = approved_path
+        self.pending_size = pending_size
+        self._lock = threading.Lock()
+        self._base = list(entries)
+        self._approved = self._load_approved()
+        self._index = FAQIndex(self._base + self._approved)
+        self._pending = OrderedDict()  # (chat_id, message_id) -> (question, answer)
+        self.stats = {"queries": 0, "hits": 0, "misses": 0, "approved": len(self._approved)}
+
+    def _load_approved(self):
+        if not self.approved_path or not os.path.exists(self.approved_path):
+            return []
+        try:
+            with open(self.approved_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error("Loading approved FAQ answers failed: %s", e)
+            return []
+
+    def answer(self, text):
+        """Return the cached answer for a question in its language, or None if it should go to ChatGPT."""
+        entry, confidence = self._index.search(text)
+        language = detect_language(text)
+        answer = entry["answers"].get(language) if entry and confidence >= FAQ_MIN_CONFIDENCE else None
+        with self._lock:
+            self.stats["queries"] += 1
+            self.stats["hits" if answer else "misses"] += 1
+        logger.debug("FAQ lookup (%s, confidence %.2f): %s", "hit" if answer else "miss", confidence, redact(text))
+        return answer
+
+    def hit_rate(self):
+        return self.stats["hits"] / self.stats["queries"] if self.stats["queries"] else 0.0
+
+    def remember(self, chat_id, message_id, question, answer):
+        """Keep a sent ChatGPT answer around so an admin can approve it."""
+        if message_id is None:
+            return
+        with self._lock:
+            self._pending[(chat_id, message_id)] = (question, answer)
+            while len(self._pending) > self.pending_size:
+                self._pending.popitem(last=False)
+
+    def approve(self, chat_id, message_id):
+        """Turn a remembered answer into a FAQ entry; returns its question, or None if unknown."""
+        with self._lock:
+            pending = self._pending.pop((chat_id, message_id), None)
+            if pending is None:
+                return None
+            question, answer = pending
+            language = detect_language(question)
+            self._approved.append({"questions": {language: [question]}, "answers": {language: answer}})
+            self._index = FAQIndex(self._base + self._approved)
+            self.stats["approved"] += 1
+            approved = list(self._approved)
+        if self.approved_path:
+            try:
+                with open(self.approved_path + ".tmp", "w", encoding="utf-8") as f:
+                    json.dump(approved, f, ensure_ascii=False, indent=1)
+                os.replace(self.approved_path + ".tmp", self.approved_path)
+            except OSError as e:
+                logger.error("Saving approved FAQ answers failed: %s", e)
+        return question
+
+faq_cache = FAQCache(FAQ_KNOWLEDGE_BASE, FAQ_APPROVED_PATH)
+
+@metrics.timed("bot_stage_seconds", stage="violation")
+async def handle_violation(chat_id, user_id, message_id):
     """Handle rule violations, excluding admins."""
-    global violations
-    if is_user_admin(chat_id, user_id):
+    if await is_user_admin(chat_id, user_id):
         logger.debug("Admin detected, violation action skipped: UserID:%s", user_id)
         return
 
-    violations[user_id] += 1
+    count = await call_state_store(state_store.incr_violations, user_id)
+    text_to_send = await call_state_store(violation_notice, chat_id, user_id, count)
+
+    # The reply, the delete and the ban are independent, so run them concurrently.
+    calls = [
+        send_message(chat_id, text_to_send, message_id),
+        delete_message(chat_id, message_id),
+    ]
+    if count >= 3:
+        calls.append(ban_user(chat_id, user_id))
+    await asyncio.gather(*calls)
 
-    if violations[user_id] >= 3:
-        text_to_send = "⛔ User banned after 3 violations! Contact @soliumcoin for support."
+def violation_notice(chat_id, user_id, count):
+    """Return the notice for a user's `count`th violation, resetting the count once they get banned."""
+    if count >= 3:
         logger.debug("Banning user: UserID:%s, ChatID:%s", user_id, chat_id)
-        send_message(chat_id, text_to_send, reply_to_message_id=message_id)
-        ban_user(chat_id, user_id)
-        delete_message(chat_id, message_id)
-        violations[user_id] = 0
-    else:
-        text_to_send = f"⚠️ Warning ({violations[user_id]}/3): Your message may contain profanity, unauthorized links, or other crypto promotions. Please review /rules."
-        logger.debug("Sending warning: %s, UserID: %s", text_to_send, user_id)
-        send_message(chat_id, text_to_send, reply_to_message_id=message_id)
-        delete_message(chat_id, message_id)
+        state_store.reset_violations(user_id)
+        return "⛔ User banned after 3 violations! Contact @soliumcoin for support."
+    text_to_send = f"⚠️ Warning ({count}/3): Your message may contain profanity, unauthorized links, or other crypto promotions. Please review /rules."
+    logger.debug("Sending warning: %s, UserID: %s", redact(text_to_send), user_id)
+    return text_to_send
 
-def process_callback_query(update):
-    """Process callback queries (inline button clicks)."""
-    callback = update["callback_query"]
-    chat_id = callback["message"]["chat"]["id"]
-    message_id = callback["message"]["message_id"]
-    callback_data = callback["data"]
-
-    if callback_data == "ask_question":
-        send_message(
-            chat_id,
-            "Awesome! 😄 What's on your mind? Type your question, and let's dive in!",
-            reply_to_message_id=message_id
-        )
-    elif callback_data == "what_is_solium":
-        reply_markup = {
-            "inline_keyboard": [
-                [
-                    {"text": "Ask a Question 💡", "callback_data": "ask_question"},
-                    {"text": "Fun Fact ❓", "callback_data": "fun_fact"}
-                ],
-                [
-                    {"text": "Try Something Fun 🎲", "callback_data": "try_fun"},
-                    {"text": "Take a Challenge 🎯", "callback_data": "take_challenge"}
-                ],
-                [{"text": "Join Community 💬", "url": "https://t.me/+KDhk3UEwZAg3MmU0"}]
-            ]
-        }
-        send_message(
-            chat_id,
-            "Solium (SLM) is a Web3 project focused on transparency and community governance, offering features like staking and DAO. 😊 (Solium is not available in some regions, including the USA.)",
-            reply_to_message_id=message_id,
-            reply_markup=reply_markup
-        )
-    elif callback_data == "fun_fact":
-        facts = [
-            "Honey never spoils! 🐝",
-            "Octopuses have three hearts! 🐙",
-            "The shortest war in history lasted 38 minutes! ⏱️"
-        ]
-        fact = random.choice(facts)
-        reply_markup = {
-            "inline_keyboard": [
-                [{"text": "Another Fact ❓", "callback_data": "fun_fact"}],
-                [{"text": "Ask a Question 💡", "callback_data": "ask_question"}],
-                [{"text": "Join Community 💬", "url": "https://t.me/+KDhk3UEwZAg3MmU0"}]
-            ]
-        }
-        send_message(
-            chat_id,
-            f"Fun Fact: {fact} Want another? 😄",
-            reply_to_message_id=message_id,
-            reply_markup=reply_markup
-        )
-    elif callback_data == "try_fun":
-        send_message(
-            chat_id,
-            "Let's have some fun! 😺 Send an emoji, tell me something you love, or share a random idea, and I'll whip up something special!",
-            reply_to_message_id=message_id
-        )
-    elif callback_data == "take_challenge":
-        send_message(
-            chat_id,
-            "Take a Challenge! 🎯 You're stranded on a desert island. Name 3 items you'd bring (e.g., phone, knife, water). Type your answer!",
-            reply_to_message_id=message_id
-        )
+# Raid Mode (per-chat flood detection; cheap moderation and bulk deletes while a chat is flooded)
+# The default thresholds are aggressive; tune them to the group's normal traffic (see README, Raid mode).
+RAID_DETECTION = os.environ.get("RAID_DETECTION", "1") == "1"
+RAID_WINDOW = float(os.environ.get("RAID_WINDOW", 30))  # seconds the message and join rates are measured over
+RAID_MESSAGE_THRESHOLD = int(os.environ.get("RAID_MESSAGE_THRESHOLD", 40))  # messages per window that start a raid
+RAID_JOIN_THRESHOLD = int(os.environ.get("RAID_JOIN_THRESHOLD", 10))  # joins per window that start a raid
+RAID_EXIT_RATIO = float(os.environ.get("RAID_EXIT_RATIO", 0.5))  # rates must fall below threshold * ratio to calm down
+RAID_COOLDOWN = float(os.environ.get("RAID_COOLDOWN", 60))  # seconds of calm before a raid ends
+RAID_RESTRICT_SECONDS = int(os.environ.get("RAID_RESTRICT_SECONDS", 3600))  # how long joiners stay muted
+RAID_DELETE_BATCH = 100  # deleteMessages accepts at most 100 ids
+RAID_SWEEP_INTERVAL = 1.0  # seconds between bulk delete flushes and raid exit checks
+RAID_MUTED_PERMISSIONS = {"can_send_messages": False, "can_send_other_messages": False, "can_send_polls": False,
+                          "can_add_web_page_previews": False, "can_invite_users": False}
+
+class ChatTraffic:
+    """Recent message and join times of one chat, and the tally of its current raid."""
+    __slots__ = ("messages", "joins", "raid_started", "calm_since", "tally")
+
+    def __init__(self):
+        # A window only needs to hold `threshold` entries to tell whether the threshold is reached.
+        self.messages = deque(maxlen=RAID_MESSAGE_THRESHOLD)
+        self.joins = deque(maxlen=RAID_JOIN_THRESHOLD)
+        self.raid_started = None
+        self.calm_since = None
+        self.tally = None
+
+    def prune(self, now):
+        for times in (self.messages, self.joins):
+            while times and now - times[0] > RAID_WINDOW:
+                times.popleft()
+
+class RaidGuard:
+    """Switches group chats into raid mode while they are flooded.
+
+    A chat enters raid mode when RAID_MESSAGE_THRESHOLD messages or
+    RAID_JOIN_THRESHOLD joins arrive within RAID_WINDOW seconds, and leaves it
+    once both rates have stayed below RAID_EXIT_RATIO of their thresholds for
+    RAID_COOLDOWN seconds. Deletes queued during a raid are sent in bulk with
+    deleteMessages by a background sweeper, which also ends calm raids and
+    logs a summary of each raid.
+    """
 
-    # Notify Telegram that callback query was processed
+    def __init__(self):
+        self._chats = {}
+        self._pending_deletes = defaultdict(list)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wake = threading.Event()  # set when a chat has a full deleteMessages batch
+        self.stats = {"raids": 0, "deleted": 0, "unchecked": 0, "banned": 0, "restricted": 0, "delete_batches": 0}
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="raid-guard", daemon=True)
+                self._thread.start()
+
+    def record(self, chat_id, joins=0):
+        """Count a message (and the members it says joined); returns True while the chat is in raid mode."""
+        if not RAID_DETECTION or not isinstance(chat_id, int) or chat_id >= 0:
+            return False
+        if self._thread is None:
+            self._start()
+        now = time.monotonic()
+        with self._lock:
+            traffic = self._chats.get(chat_id)
+            if traffic is None:
+                traffic = self._chats[chat_id] = ChatTraffic()
+            traffic.messages.append(now)
+            traffic.joins.extend([now] * joins)
+            if traffic.raid_started is not None:
+                traffic.tally["messages"] += 1
+                traffic.tally["joins"] += joins
+                return True
+            traffic.prune(now)
+            if len(traffic.messages) < RAID_MESSAGE_THRESHOLD and len(traffic.joins) < RAID_JOIN_THRESHOLD:
+                return False
+            traffic.raid_started = now
+            traffic.tally = {"messages": 1, "joins": joins, "deleted": 0, "unchecked": 0, "banned": 0, "restricted": 0}
+            self.stats["raids"] += 1
+        metrics.inc("raid_mode_transitions_total", event="start")
+        logger.warning("Raid mode started in ChatID:%s: %s messages / %s joins in the last %ss",
+                       chat_id, len(traffic.messages), len(traffic.joins), RAID_WINDOW)
+        return True
+
+    def active_raids(self):
+        with self._lock:
+            return sum(1 for traffic in self._chats.values() if traffic.raid_started is not None)
+
+    def count(self, chat_id, event, amount=1):
+        """Add to the tally of a chat's current raid and to the totals."""
+        with self._lock:
+            self.stats[event] += amount
+            traffic = self._chats.get(chat_id)
+            if traffic is not None and traffic.tally is not None:
+                traffic.tally[event] += amount
+
+    def queue_delete(self, chat_id, message_id):
+        """Queue a message for the next deleteMessages sweep, which comes early once a batch is full."""
+        with self._lock:
+            pending = self._pending_deletes[chat_id]
+            pending.append(message_id)
+            if len(pending) >= RAID_DELETE_BATCH:
+                self._wake.set()
+
+    def _delete(self, chat_id, message_ids):
+        try:
+            response = telegram.call("deleteMessages", {"chat_id": chat_id, "message_ids": message_ids})
+            if response is not None and response.status_code == 200:
+                self.count(chat_id, "deleted", len(message_ids))
+                self.stats["delete_batches"] += 1
+                logger.debug("Deleted %s messages in ChatID:%s", len(message_ids), chat_id)
+            else:
+                logger.warning("Bulk delete failed: %s", response.text if response is not None else "no response")
+        except Exception as e:
+            logger.error("Bulk delete failed: %s", e)
+
+    def _run(self):
+        while True:
+            self._wake.wait(RAID_SWEEP_INTERVAL)
+            self._wake.clear()
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error("Raid guard sweep failed: %s", e)
+
+    def sweep(self):
+        """Flush queued deletes and end the raids that have calmed down."""
+        now = time.monotonic()
+        ended = []
+        with self._lock:
+            batches = list(self._pending_deletes.items())
+            self._pending_deletes.clear()
+            for chat_id, traffic in list(self._chats.items()):
+                traffic.prune(now)
+                if traffic.raid_started is None:
+                    if not traffic.messages and not traffic.joins:
+                        del self._chats[chat_id]
+                    continue
+                calm = len(traffic.messages) < RAID_MESSAGE_THRESHOLD * RAID_EXIT_RATIO \
+                    and len(traffic.joins) < RAID_JOIN_THRESHOLD * RAID_EXIT_RATIO
+                if not calm:
+                    traffic.calm_since = None
+                elif traffic.calm_since is None:
+                    traffic.calm_since = now
+                elif now - traffic.calm_since >= RAID_COOLDOWN:
+                    ended.append((chat_id, traffic))
+        for chat_id, message_ids in batches:
+            for start in range(0, len(message_ids), RAID_DELETE_BATCH):
+                self._delete(chat_id, message_ids[start:start + RAID_DELETE_BATCH])
+        for chat_id, traffic in ended:
+            with self._lock:
+                tally = traffic.tally
+                duration = now - traffic.raid_started
+                traffic.raid_started = traffic.calm_since = traffic.tally = None
+            metrics.inc("raid_mode_transitions_total", event="end")
+            logger.warning("Raid mode ended in ChatID:%s after %.0fs: %s messages, %s joins, %s deleted, "
+                           "%s banned, %s joiners restricted, %s messages left unchecked",
+                           chat_id, duration, tally["messages"], tally["joins"], tally["deleted"],
+                           tally["banned"], tally["restricted"], tally["unchecked"])
+
+raid_guard = RaidGuard()
+
+async def restrict_member(chat_id, user_id, seconds):
+    """Mute a member for `seconds` via Telegram API."""
+    payload = {"chat_id": chat_id, "user_id": user_id, "permissions": RAID_MUTED_PERMISSIONS,
+               "until_date": int(time.time()) + seconds}
     try:
-        requests.post(
-            f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/answerCallbackQuery",
-            json={"callback_query_id": callback["id"]}
-        )
+        logger.debug("Restricting user: UserID:%s, ChatID:%s", user_id, chat_id)
+        response = await telegram_async.call("restrictChatMember", payload)
+        if response is None or response.status_code != 200:
+            logger.error("Failed to restrict user: %s", response.text if response is not None else "no response")
+        else:
+            raid_guard.count(chat_id, "restricted")
+        return response
     except Exception as e:
-        logger.error(f"Failed to answer callback query: {e}")
+        logger.error("Failed to restrict user: %s", e)
+        return None
 
-def process_message(update):
-    """Process incoming Telegram updates."""
-    if "message" not in update and "callback_query" not in update:
-        logger.debug("No message or callback query found: %s", update)
-        return
+async def handle_raid_message(msg):
+    """Moderate a non-admin message in a raided chat without ChatGPT or warning replies.
 
-    if "callback_query" in update:
-        process_callback_query(update)
-        return
+    Only the local pre-filter and the verdict cache decide; violations are
+    deleted in bulk, repeat offenders banned and new joiners muted.
+    """
+    joiners = msg.message.get("new_chat_members")
+    if joiners:
+        for member in joiners:
+            if not member.get("is_bot"):
+                core_loop.spawn(restrict_member(msg.chat_id, member["id"], RAID_RESTRICT_SECONDS))
+        raid_guard.queue_delete(msg.chat_id, msg.message_id)  # the "X joined" service message
+        return "raid_joins"
+    if not msg.text:
+        return "raid_ignored"
 
-    message = update["message"]
-    chat_id = message.get("chat", {}).get("id")
-    user_id = message.get("from", {}).get("id")
-    message_id = message.get("message_id")
-    text = message.get("text", "")
+    verdict, _ = local_rules_verdict(msg.text, msg.message.get("entities"))
+    if verdict is None:
+        raid_guard.count(msg.chat_id, "unchecked")
+        return "raid_unchecked"
+    if not verdict:
+        return "raid_clean"
+    raid_guard.queue_delete(msg.chat_id, msg.message_id)
+    if await call_state_store(state_store.incr_violations, msg.user_id) >= 3:
+        await call_state_store(state_store.reset_violations, msg.user_id)
+        raid_guard.count(msg.chat_id, "banned")
+        core_loop.spawn(ban_user(msg.chat_id, msg.user_id))
+    return "raid_violation"
 
-    # Save message to conversation history
-    if text:
-        timestamp = datetime.now().isoformat()
-        conversations[user_id].append({"text": text, "timestamp": timestamp})
-        logger.debug("Message saved for UserID:%s: %s", user_id, text)
+# Command Router (commands and button callbacks dispatched through registration tables)
+BOT_USERNAME = os.environ.get("BOT_USERNAME", "").lstrip("@").lower()  # "/cmd@OtherBot" is ignored when set
+MENTION_REGEX = re.compile(r"\b(?:rose|admin)\b", re.IGNORECASE)
+ISLAND_ITEMS_REGEX = re.compile(r"\b(?:phone|knife|water)s?\b", re.IGNORECASE)
+COMMUNITY_URL = "https://t.me/+KDhk3UEwZAg3MmU0"
 
-    if "new_chat_members" in message:
-        welcome = """Welcome to the Solium group! 🚀 
+WELCOME_TEXT = """Welcome to the Solium group! 🚀
 Check the rewards: /rewards
 Read the rules: /rules
 Got questions? Ask away! 😎"""
-        send_message(chat_id, welcome)
-        logger.debug("New member welcome message sent: UserID:%s", user_id)
-        return
-
-    if not text:
-        logger.debug("Empty or non-text message, violation check skipped: %s", text)
-        return
-
-    logger.debug("Received message (UserID:%s): %s", user_id, text)
-
-    if text.lower() == "/start":
-        reply_markup = {
-            "inline_keyboard": [
-                [
-                    {"text": "What is Solium? ❓", "callback_data": "what_is_solium"},
-                    {"text": "Ask a Question 💡", "callback_data": "ask_question"}
-                ],
-                [
-                    {"text": "Fun Fact ❓", "callback_data": "fun_fact"},
-                    {"text": "Try Something Fun 🎲", "callback_data": "try_fun"}
-                ],
-                [
-                    {"text": "Take a Challenge 🎯", "callback_data": "take_challenge"},
-                    {"text": "Join Community 💬", "url": "https://t.me/+KDhk3UEwZAg3MmU0"}
-                ]
-            ]
-        }
-        send_message(
-            chat_id,
-            "Hello! 🤖 I'm Solium Support AI, ready to chat about *anything* on your mind! 🚀 Ask about Solium (SLM), explore fun facts, or take a challenge! 😄",
-            reply_to_message_id=message_id,
-            reply_markup=reply_markup
-        )
-        return
-
-    if text.lower() == "/rules":
-        rules = """**Group Rules**:
+START_TEXT = "Hello! 🤖 I'm Solium Support AI, ready to chat about *anything* on your mind! 🚀 Ask about Solium (SLM), explore fun facts, or take a challenge! 😄"
+RULES_TEXT = f"""**Group Rules**:
 1. No profanity, insults, or inappropriate language.
-2. Only official Solium links (e.g., https://t.me/+KDhk3UEwZAg3MmU0) are allowed.
+2. Only official Solium links (e.g., {COMMUNITY_URL}) are allowed.
 3. Promoting other cryptocurrencies or projects is prohibited."""
-        send_message(chat_id, rules, reply_to_message_id=message_id)
-        return
-
-    if text.lower() == "/rewards":
-        airdrop_info = """**Solium Community Rewards**:
+REWARDS_TEXT = f"""**Solium Community Rewards**:
 - Total: 10,000,000 SLM (10% of supply).
-- Join: https://t.me/+KDhk3UEwZAg3MmU0 to participate.
+- Join: {COMMUNITY_URL} to participate.
 - Distribution: 1M SLM every 7 days!
 More info: Ask me or join @SoliumCommunity! 😄"""
-        send_message(chat_id, airdrop_info, reply_to_message_id=message_id)
-        return
+FUN_FACTS = [
+    "Honey never spoils! 🐝",
+    "Octopuses have three hearts! 🐙",
+    "The shortest war in history lasted 38 minutes! ⏱️"
+]
 
-    if text.lower() == "/clearmemory":
-        if user_id in conversations:
-            conversations[user_id].clear()
-            send_message(chat_id, "Your conversation history has been cleared.", reply_to_message_id=message_id)
-        else:
-            send_message(chat_id, "No conversation history found.", reply_to_message_id=message_id)
-        return
+# Inline keyboards, serialized once for every send
+START_KEYBOARD = json.dumps({
+    "inline_keyboard": [
+        [
+            {"text": "What is Solium? ❓", "callback_data": "what_is_solium"},
+            {"text": "Ask a Question 💡", "callback_data": "ask_question"}
+        ],
+        [
+            {"text": "Fun Fact ❓", "callback_data": "fun_fact"},
+            {"text": "Try Something Fun 🎲", "callback_data": "try_fun"}
+        ],
+        [
+            {"text": "Take a Challenge 🎯", "callback_data": "take_challenge"},
+            {"text": "Join Community 💬", "url": COMMUNITY_URL}
+        ]
+    ]
+})
+SOLIUM_KEYBOARD = json.dumps({
+    "inline_keyboard": [
+        [
+            {"text": "Ask a Question 💡", "callback_data": "ask_question"},
+            {"text": "Fun Fact ❓", "callback_data": "fun_fact"}
+        ],
+        [
+            {"text": "Try Something Fun 🎲", "callback_data": "try_fun"},
+            {"text": "Take a Challenge 🎯", "callback_data": "take_challenge"}
+        ],
+        [{"text": "Join Community 💬", "url": COMMUNITY_URL}]
+    ]
+})
+FUN_FACT_KEYBOARD = json.dumps({
+    "inline_keyboard": [
+        [{"text": "Another Fact ❓", "callback_data": "fun_fact"}],
+        [{"text": "Ask a Question 💡", "callback_data": "ask_question"}],
+        [{"text": "Join Community 💬", "url": COMMUNITY_URL}]
+    ]
+})
 
-    if text.lower().startswith("/resetviolations") and is_user_admin(chat_id, user_id):
-        try:
-            target_user_id = int(text.split()[1])
-            violations[target_user_id] = 0
-            send_message(chat_id, f"UserID {target_user_id} violation count reset.", reply_to_message_id=message_id)
-        except (IndexError, ValueError):
-            send_message(chat_id, "Usage: /resetviolations <user_id>", reply_to_message_id=message_id)
-        return
+class IncomingMessage:
+    """A text message normalized once: lowercased text, parsed command and mention flag."""
+    __slots__ = ("message", "chat_id", "user_id", "message_id", "text", "lowered", "command", "args", "mentioned")
 
-    if "😺" in text and ("rose" in text.lower() or "admin" in text.lower()):
-        response = ask_chatgpt("User sent a cat emoji 😺. Suggest a fun, creative activity or idea based on this emoji.", user_id)
-        send_message(chat_id, response.output_text, reply_to_message_id=message_id)
-        return
-    if any(word in text.lower() for word in ["phone", "knife", "water"]) and ("rose" in text.lower() or "admin" in text.lower()):
-        response = ask_chatgpt(f"User chose {text} for a desert island challenge. Comment on their choices creatively!", user_id)
-        send_message(chat_id, response.output_text, reply_to_message_id=message_id)
+    def __init__(self, message):
+        self.message = message
+        self.chat_id = message.get("chat", {}).get("id")
+        self.user_id = message.get("from", {}).get("id")
+        self.message_id = message.get("message_id")
+        self.text = message.get("text", "")
+        self.lowered = self.text.lower()
+        self.command = None
+        self.args = []
+        if self.lowered.startswith("/"):
+            head, *self.args = self.text.split()
+            name, _, bot = head[1:].lower().partition("@")
+            if not bot or not BOT_USERNAME or bot == BOT_USERNAME:
+                self.command = name
+        self.mentioned = MENTION_REGEX.search(self.text) is not None
+
+Command = namedtuple("Command", ["handler", "admin_only"])
+COMMANDS = {}  # command name -> Command(async handler(msg), admin_only)
+CALLBACKS = {}  # callback data -> async handler(chat_id, message_id)
+
+def command(name, admin_only=False):
+    """Register a /command coroutine handler; its name is also the metrics branch label."""
+    def register(handler):
+        COMMANDS[name] = Command(handler, admin_only)
+        return handler
+    return register
+
+def callback(data):
+    """Register an inline button coroutine handler by its callback data."""
+    def register(handler):
+        CALLBACKS[data] = handler
+        return handler
+    return register
+
+def static_reply(name, text, reply_markup=None):
+    """Register a command answered with a fixed text (and keyboard)."""
+    command(name)(lambda msg: send_message(msg.chat_id, text, reply_to_message_id=msg.message_id, reply_markup=reply_markup))
+
+def static_callback(data, text, reply_markup=None):
+    """Register an inline button answered with a fixed text (and keyboard)."""
+    callback(data)(lambda chat_id, message_id: send_message(chat_id, text, reply_to_message_id=message_id, reply_markup=reply_markup))
+
+static_reply("start", START_TEXT, START_KEYBOARD)
+static_reply("rules", RULES_TEXT)
+static_reply("rewards", REWARDS_TEXT)
+
+@command("clearmemory")
+async def clear_memory_command(msg):
+    if await call_state_store(state_store.clear_conversation, msg.user_id):
+        await send_message(msg.chat_id, "Your conversation history has been cleared.", reply_to_message_id=msg.message_id)
+    else:
+        await send_message(msg.chat_id, "No conversation history found.", reply_to_message_id=msg.message_id)
+
+@command("resetviolations", admin_only=True)
+async def reset_violations_command(msg):
+    try:
+        target_user_id = int(msg.args[0])
+    except (IndexError, ValueError):
+        await send_message(msg.chat_id, "Usage: /resetviolations <user_id>", reply_to_message_id=msg.message_id)
         return
+    await call_state_store(state_store.reset_violations, target_user_id)
+    await send_message(msg.chat_id, f"UserID {target_user_id} violation count reset.", reply_to_message_id=msg.message_id)
+
+@command("cachestats", admin_only=True)
+async def cache_stats_command(msg):
+    stats = verdict_cache.stats
+    await send_message(
+        msg.chat_id,
+        f"Verdict cache: {verdict_cache.size()} entries, {stats['hits']} hits, {stats['near_hits']} near-duplicate hits, "
+        f"{stats['misses']} misses, {stats['evictions']} evictions.\n"
+        f"FAQ answers: {faq_cache.hit_rate():.0%} hit rate ({faq_cache.stats['hits']}/{faq_cache.stats['queries']} questions), "
+        f"{faq_cache.stats['approved']} approved.",
+        reply_to_message_id=msg.message_id
+    )
+
+@command("approvefaq", admin_only=True)
+async def approve_faq_command(msg):
+    replied = msg.message.get("reply_to_message") or {}
+    # Approving may write FAQ_APPROVED_PATH
+    if await asyncio.get_running_loop().run_in_executor(None, faq_cache.approve, msg.chat_id, replied.get("message_id")):
+        await send_message(msg.chat_id, "Answer approved, similar questions will get it directly.", reply_to_message_id=msg.message_id)
+    else:
+        await send_message(msg.chat_id, "Reply /approvefaq to a recent ChatGPT answer of mine.", reply_to_message_id=msg.message_id)
 
-    is_violation = check_rules_violation(text)
+@command("purgecache", admin_only=True)
+async def purge_cache_command(msg):
+    purged = verdict_cache.purge()
+    await send_message(msg.chat_id, f"Verdict cache purged ({purged} entries).", reply_to_message_id=msg.message_id)
+
+static_callback("ask_question", "Awesome! 😄 What's on your mind? Type your question, and let's dive in!")
+static_callback(
+    "what_is_solium",
+    "Solium (SLM) is a Web3 project focused on transparency and community governance, offering features like staking and DAO. 😊 (Solium is not available in some regions, including the USA.)",
+    SOLIUM_KEYBOARD
+)
+static_callback("try_fun", "Let's have some fun! 😺 Send an emoji, tell me something you love, or share a random idea, and I'll whip up something special!")
+static_callback("take_challenge", "Take a Challenge! 🎯 You're stranded on a desert island. Name 3 items you'd bring (e.g., phone, knife, water). Type your answer!")
+
+@callback("fun_fact")
+async def fun_fact_callback(chat_id, message_id):
+    await send_message(chat_id, f"Fun Fact: {random.choice(FUN_FACTS)} Want another? 😄",
+                       reply_to_message_id=message_id, reply_markup=FUN_FACT_KEYBOARD)
+
+async def routed_command(msg):
+    """Return the registered command a message invokes (admin-only ones only for admins), or None."""
+    entry = COMMANDS.get(msg.command) if msg.command else None
+    if entry is None or (entry.admin_only and not await is_user_admin(msg.chat_id, msg.user_id)):
+        return None
+    return entry
+
+async def answer_callback_query(callback_query_id):
+    try:
+        response = await telegram_async.call("answerCallbackQuery", {"callback_query_id": callback_query_id})
+        if response is None or response.status_code != 200:
+            logger.error("Failed to answer callback query: %s", response.text if response is not None else "no response")
+    except Exception as e:
+        logger.error("Failed to answer callback query: %s", e)
+
+@metrics.timed("bot_stage_seconds", stage="callback")
+async def process_callback_query(update):
+    """Process callback queries (inline button clicks)."""
+    callback_query = update["callback_query"]
+    chat_id = callback_query["message"]["chat"]["id"]
+    message_id = callback_query["message"]["message_id"]
+
+    # Notify Telegram that callback query was processed; runs alongside the reply below
+    calls = [answer_callback_query(callback_query["id"])]
+    handler = CALLBACKS.get(callback_query.get("data"))
+    if handler:
+        calls.append(handler(chat_id, message_id))
+    await asyncio.gather(*calls)
+
+async def handle_update(update):
+    """Process incoming Telegram updates; returns the name of the branch that handled it."""
+    if "chat_member" in update or "my_chat_member" in update:
+        handle_chat_member_update(update)
+        return "chat_member"
+
+    if "message" not in update and "callback_query" not in update:
+        logger.debug("No message or callback query found: UpdateID:%s", update.get("update_id"))
+        return "no_message"
+
+    if "callback_query" in update:
+        await process_callback_query(update)
+        return "callback"
+
+    msg = IncomingMessage(update["message"])
+    if raid_guard.record(msg.chat_id, len(msg.message.get("new_chat_members", ()))) \
+            and not await is_user_admin(msg.chat_id, msg.user_id):
+        return await handle_raid_message(msg)
+
+    # Save message to conversation history
+    if msg.text:
+        await call_state_store(state_store.append_turn, msg.user_id, "user", msg.text)
+        logger.debug("Message saved for UserID:%s: %s", msg.user_id, redact(msg.text))
+
+    if "new_chat_members" in msg.message:
+        await send_message(msg.chat_id, WELCOME_TEXT)
+        logger.debug("New member welcome message sent: UserID:%s", msg.user_id)
+        return "new_members"
+
+    if not msg.text:
+        logger.debug("Empty or non-text message, violation check skipped: UserID:%s", msg.user_id)
+        return "non_text"
+
+    logger.debug("Received message (UserID:%s): %s", msg.user_id, redact(msg.text))
+
+    entry = await routed_command(msg)
+    if entry:
+        await entry.handler(msg)
+        return msg.command
+
+    branch, prompt = challenge_prompt(msg)
+    if branch:
+        await reply_with_chatgpt(msg.chat_id, msg.message_id, prompt, msg.user_id)
+        return branch
+
+    is_violation = await check_rules_violation(msg.text, msg.message.get("entities"))
     if is_violation:
-        handle_violation(chat_id, user_id, message_id)
-        return
+        await handle_violation(msg.chat_id, msg.user_id, msg.message_id)
+        return "violation"
 
     # Respond only if addressed as "Rose" or "Admin"
-    if "rose" in text.lower() or "admin" in text.lower():
-        context = "\n".join([f"{msg['timestamp']}: {msg['text']}" for msg in list(conversations[user_id])[-10:] if len(msg['text']) < 500])
-        logger.debug("Sending to ChatGPT (gpt-4o-mini) with context (UserID:%s):\n%s\nCurrent message: %s", user_id, context, text)
-        response = ask_chatgpt(text, user_id)
-        send_message(chat_id, response.output_text, reply_to_message_id=message_id)
-    else:
-        logger.debug("Message ignored (no 'Rose' or 'Admin' mention): UserID:%s, Text:%s", user_id, text)
+    if msg.mentioned:
+        answer = faq_cache.answer(msg.text) if FAQ_ENABLED else None
+        if answer:
+            await send_message(msg.chat_id, answer, reply_to_message_id=msg.message_id)
+            await call_state_store(state_store.append_turn, msg.user_id, "assistant", answer)
+            return "faq"
+        logger.debug("Sending to ChatGPT (gpt-4o-mini): UserID:%s, Text:%s", msg.user_id, redact(msg.text))
+        await reply_with_chatgpt(msg.chat_id, msg.message_id, msg.text, msg.user_id)
+        return "reply"
+    logger.debug("Message ignored (no 'Rose' or 'Admin' mention): UserID:%s, Text:%s", msg.user_id, redact(msg.text))
+    return "ignored"
+
+def challenge_prompt(msg):
+    """Return (branch, ChatGPT prompt) for the fun challenges answered before moderation, else (None, None)."""
+    if not msg.mentioned:
+        return None, None
+    if "😺" in msg.text:
+        return "cat_emoji", "User sent a cat emoji 😺. Suggest a fun, creative activity or idea based on this emoji."
+    if ISLAND_ITEMS_REGEX.search(msg.text):
+        return "island_challenge", f"User chose {msg.text} for a desert island challenge. Comment on their choices creatively!"
+    return None, None
+
+async def process_message(update):
+    """Process incoming Telegram updates, timing each handler branch."""
+    started = time.perf_counter()
+    branch = "error"
+    try:
+        branch = await handle_update(update)
+    finally:
+        metrics.observe("bot_update_seconds", time.perf_counter() - started, branch=branch)
+        metrics.inc("bot_updates_total", branch=branch)
+
+# Update Dispatch System (bounded in-process queue + worker pool or asyncio event loop)
+BOT_MODE = os.environ.get("BOT_MODE", "webhook")  # webhook | polling (getUpdates, no public URL needed)
+UPDATE_RUNTIME = "asyncio" if BOT_MODE == "polling" else os.environ.get("UPDATE_RUNTIME", "threads")  # threads | asyncio
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 4))  # 0 = process inline in the webhook (threads runtime)
+ASYNC_MAX_CONCURRENCY = int(os.environ.get("ASYNC_MAX_CONCURRENCY", 200))  # updates in flight on the event loop
+POLLING_TIMEOUT = int(os.environ.get("POLLING_TIMEOUT", 30))  # getUpdates long-poll seconds
+POLLING_ALLOWED_UPDATES = ["message", "callback_query", "chat_member", "my_chat_member"]
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", 1000))
+UPDATE_SHUTDOWN_TIMEOUT = float(os.environ.get("UPDATE_SHUTDOWN_TIMEOUT", 10))
+UPDATE_RETRY_AFTER = int(os.environ.get("UPDATE_RETRY_AFTER", 5))
+
+def update_chat_key(update):
+    """Return the chat id an update belongs to, used to keep per-chat ordering."""
+    for key in ("message", "edited_message", "chat_member", "my_chat_member"):
+        if key in update:
+            return update[key].get("chat", {}).get("id")
+    if "callback_query" in update:
+        return update["callback_query"].get("message", {}).get("chat", {}).get("id")
+    return None
+
+class UpdateDispatcher:
+    """Bounded update queue drained by a pool of worker threads.
+
+    Updates are queued per chat and a chat is only ever handled by one worker
+    at a time, so updates of the same chat stay in order while different chats
+    are processed in parallel. A busy chat never blocks the others. Each
+    worker runs the `handler` coroutine for its update on core_loop and waits
+    for it, so at most `workers` updates are in flight.
+    """
+
+    def __init__(self, handler, workers, max_pending):
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+        self._cond = threading.Condition()
+        self._pending = {}  # chat key -> deque of updates
+        self._ready = deque()  # chat keys with pending updates and no active worker
+        self._active = set()  # chat keys currently being processed
+        self._size = 0
+        self._threads = []
+        self._started = False
+        self._stopping = False
+        self.stats = {"enqueued": 0, "processed": 0, "failed": 0, "dropped": 0, "max_depth": 0}
+
+    def depth(self):
+        return self._size
+
+    def in_flight(self):
+        """Number of updates being handled right now."""
+        return len(self._active)
+
+    def start(self):
+        """Start the worker threads (lazily, so forked gunicorn workers get their own)."""
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"update-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logger.debug("Update dispatcher started: %s workers, queue size %s", self.workers, self.max_pending)
+
+    def submit(self, update):
+        """Queue an update. Returns False when the queue is full or shutting down."""
+        if not self._started:
+            self.start()
+        key = update_chat_key(update)
+        if key is None:
+            key = ("update", update.get("update_id"))
+        with self._cond:
+            if self._stopping or self._size >= self.max_pending:
+                self.stats["dropped"] += 1
+                return False
+            chat_queue = self._pending.get(key)
+            if chat_queue is None:
+                chat_queue = self._pending[key] = deque()
+            chat_queue.append(update)
+            if len(chat_queue) == 1 and key not in self._active:
+                self._ready.append(key)
+            self._size += 1
+            self.stats["enqueued"] += 1
+            if self._size > self.stats["max_depth"]:
+                self.stats["max_depth"] = self._size
+            self._cond.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    if self._stopping:
+                        return
+                    self._cond.wait()
+                key = self._ready.popleft()
+                chat_queue = self._pending[key]
+                update = chat_queue.popleft()
+                self._active.add(key)
+                self._size -= 1
+            outcome = "processed"
+            try:
+                core_loop.run(self.handler(update))
+            except Exception as e:
+                outcome = "failed"
+                logger.error("Update processing error (UpdateID:%s): %s", update.get("update_id"), e)
+            with self._cond:
+                self.stats[outcome] += 1
+                self._active.discard(key)
+                if chat_queue:
+                    self._ready.append(key)
+                    self._cond.notify()
+                else:
+                    del self._pending[key]
+                if self._stopping and not self._ready:
+                    self._cond.notify_all()
+
+    def stop(self, timeout=UPDATE_SHUTDOWN_TIMEOUT):
+        """Stop accepting updates and give the workers up to `timeout` seconds to drain the queue."""
+        with self._cond:
+            if not self._started or self._stopping:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+        logger.info("Update dispatcher stopping, draining %s queued updates...", self._size)
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        if self._size:
+            logger.warning("Update dispatcher stopped with %s unprocessed updates", self._size)
+
+class AsyncUpdateDispatcher:
+    """Bounded update queue handled by coroutines on core_loop.
+
+    Same interface and per-chat ordering as UpdateDispatcher, but an update
+    waiting on Telegram or ChatGPT costs a coroutine instead of a thread, so
+    up to ASYNC_MAX_CONCURRENCY updates can be in flight in one process.
+    `depth()` counts queued and in-flight updates.
+    """
+
+    def __init__(self, handler, max_concurrency, max_pending):
+        self.handler = handler
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.loop = None
+        self._lock = threading.Lock()
+        self._pending = {}  # chat key -> deque of updates; only touched on the loop
+        self._tasks = set()
+        self._semaphore = None
+        self._size = 0
+        self._running = 0
+        self._stopping = False
+        self.stats = {"enqueued": 0, "processed": 0, "failed": 0, "dropped": 0, "max_depth": 0}
+
+    def depth(self):
+        return self._size
+
+    def in_flight(self):
+        """Number of updates being handled right now."""
+        return self._running
+
+    def start(self):
+        """Start core_loop (lazily, so forked gunicorn workers get their own)."""
+        with self._lock:
+            if self.loop is not None:
+                return
+            self.loop = core_loop.start()
+        logger.debug("Async update dispatcher started: %s in flight, queue size %s", self.max_concurrency, self.max_pending)
+
+    def submit(self, update):
+        """Queue an update from any thread. Returns False when the queue is full or shutting down."""
+        if self.loop is None:
+            self.start()
+        with self._lock:
+            if self._stopping or self._size >= self.max_pending:
+                self.stats["dropped"] += 1
+                return False
+            self._size += 1
+            self.stats["enqueued"] += 1
+            if self._size > self.stats["max_depth"]:
+                self.stats["max_depth"] = self._size
+        self.loop.call_soon_threadsafe(self._enqueue, update)
+        return True
+
+    def _enqueue(self, update):
+        key = update_chat_key(update)
+        if key is None:
+            key = ("update", update.get("update_id"))
+        chat_queue = self._pending.get(key)
+        if chat_queue is not None:
+            chat_queue.append(update)
+            return
+        self._pending[key] = deque([update])
+        task = self.loop.create_task(self._drain(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, key):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        chat_queue = self._pending[key]
+        while chat_queue:
+            update = chat_queue[0]  # left in place so updates arriving meanwhile queue behind it
+            outcome = "processed"
+            async with self._semaphore:
+                self._running += 1
+                try:
+                    await self.handler(update)
+                except Exception as e:
+                    outcome = "failed"
+                    logger.error("Update processing error (UpdateID:%s): %s", update.get("update_id"), e)
+                finally:
+                    self._running -= 1
+            chat_queue.popleft()
+            with self._lock:
+                self._size -= 1
+                self.stats[outcome] += 1
+        del self._pending[key]
+
+    def stop(self, timeout=UPDATE_SHUTDOWN_TIMEOUT):
+        """Stop accepting updates and give in-flight ones up to `timeout` seconds to finish."""
+        with self._lock:
+            if self.loop is None or self._stopping:
+                return
+            self._stopping = True
+        logger.info("Async update dispatcher stopping, draining %s updates...", self._size)
+        deadline = time.monotonic() + timeout
+        while self._size and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if self._size:
+            logger.warning("Async update dispatcher stopped with %s unprocessed updates", self._size)
+
+async def poll_updates(dispatcher):
+    """Feed the dispatcher from getUpdates long polling, for deployments without a public webhook URL.
+
+    The offset only moves past updates once they are queued, so Telegram
+    redelivers anything fetched but not yet accepted, and fetching pauses
+    while the queue is full instead of dropping updates.
+    """
+    # getUpdates is refused while a webhook is set
+    await telegram_async.call("deleteWebhook", {"drop_pending_updates": False})
+    offset = None
+    logger.info("Polling getUpdates (timeout %ss)...", POLLING_TIMEOUT)
+    while True:
+        room = dispatcher.max_pending - dispatcher.depth()
+        if room <= 0:
+            await asyncio.sleep(0.1)
+            continue
+        payload = {"timeout": POLLING_TIMEOUT, "limit": min(100, room), "allowed_updates": POLLING_ALLOWED_UPDATES}
+        if offset is not None:
+            payload["offset"] = offset
+        response = await telegram_async.call("getUpdates", payload, timeout=POLLING_TIMEOUT + TELEGRAM_TIMEOUT)
+        if response is None or response.status_code != 200:
+            logger.error("getUpdates failed: %s", response.text if response is not None else "no response")
+            await asyncio.sleep(UPDATE_RETRY_AFTER)
+            continue
+        for update in response.json().get("result", []):
+            if not dispatcher.submit(update):
+                break
+            offset = update["update_id"] + 1
+
+if UPDATE_RUNTIME == "asyncio":
+    update_dispatcher = AsyncUpdateDispatcher(process_message, ASYNC_MAX_CONCURRENCY, UPDATE_QUEUE_SIZE)
+else:
+    update_dispatcher = UpdateDispatcher(process_message, UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+atexit.register(update_dispatcher.stop)
+if UPDATE_RUNTIME == "asyncio" or UPDATE_WORKERS > 0:
+    # Inline webhook handling has no dispatcher view of what is in flight; batches then wait for the window.
+    moderation_batcher.in_flight = update_dispatcher.in_flight
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
     """Telegram webhook endpoint."""
     update = request.get_json()
-    logger.debug("Webhook received: %s", update)
-    try:
-        process_message(update)
-    except Exception as e:
-        logger.error(f"Webhook processing error: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+    logger.debug("Webhook received: UpdateID:%s, Type:%s", update.get("update_id"),
+                 next((key for key in update if key != "update_id"), "unknown"))
+    if UPDATE_RUNTIME == "threads" and UPDATE_WORKERS <= 0:
+        try:
+            core_loop.run(process_message(update))
+        except Exception as e:
+            logger.error("Webhook processing error: %s", e)
+            return jsonify({"status": "error", "message": str(e)}), 500
+        return jsonify({"status": "ok"}), 200
+    if not update_dispatcher.submit(update):
+        # Non-2xx makes Telegram hold the update and redeliver it later.
+        logger.warning("Update queue full, rejecting UpdateID:%s (dropped so far: %s)",
+                       update.get("update_id"), update_dispatcher.stats["dropped"])
+        return jsonify({"status": "busy"}), 503, {"Retry-After": str(UPDATE_RETRY_AFTER)}
     return jsonify({"status": "ok"}), 200
 
+def collect_component_stats():
+    """Export the stats the components keep themselves."""
+    samples = [
+        ("update_queue_depth", "gauge", {}, update_dispatcher.depth()),
+        ("update_queue_max_depth", "gauge", {}, update_dispatcher.stats["max_depth"]),
+        ("verdict_cache_entries", "gauge", {}, verdict_cache.size()),
+    ]
+    for name, value in update_dispatcher.stats.items():
+        if name != "max_depth":
+            samples.append(("update_queue_updates_total", "counter", {"result": name}, value))
+    for name, value in admin_cache.stats.items():
+        samples.append(("admin_cache_events_total", "counter", {"event": name}, value))
+    for name, value in verdict_cache.stats.items():
+        samples.append(("verdict_cache_events_total", "counter", {"event": name}, value))
+    for key, value in list(prefilter_stats.items()):
+        tier, _, outcome = key.partition(".")
+        samples.append(("prefilter_decisions_total", "counter", {"tier": tier, "outcome": outcome}, value))
+    for name, value in faq_cache.stats.items():
+        samples.append(("faq_cache_events_total", "counter", {"event": name}, value))
+    samples.append(("faq_cache_hit_ratio", "gauge", {}, faq_cache.hit_rate()))
+    samples.append(("raid_mode_chats", "gauge", {}, raid_guard.active_raids()))
+    for name, value in raid_guard.stats.items():
+        samples.append(("raid_guard_events_total", "counter", {"event": name}, value))
+    for name, value in moderation_batcher.stats.items():
+        samples.append(("moderation_batch_events_total", "counter", {"event": name}, value))
+    samples.append(("llm_breaker_state", "gauge", {}, llm_governor.breaker_state()))
+    for name, value in llm_governor.stats.items():
+        samples.append(("llm_governor_events_total", "counter", {"event": name}, value))
+    for name, value in telegram.stats.items():
+        samples.append(("telegram_client_events_total", "counter", {"event": name}, value))
+    for name, value in state_store.stats().items():
+        samples.append(("state_store_entries", "gauge", {"kind": name}, value))
+    return samples
+
+metrics.register_collector(collect_component_stats)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics endpoint."""
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 @app.route('/')
 def home():
     """Homepage."""
     return "Solium AI Telegram Bot is active!"
 
-if __name__ == '__main__':
+if __name__ == '__main__' and BOT_MODE == "polling":
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # drain the queue on dyno shutdown too
+    try:
+        core_loop.run(poll_updates(update_dispatcher))
+    except KeyboardInterrupt:
+        pass
+elif __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
     logger.debug("Bot running on port %s...", port)
     app.run(host='0.0.0.0', port=port, debug=False)
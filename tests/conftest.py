@@ -0,0 +1,8 @@
+import os
+import sys
+
+# main.py refuses to import without credentials; nothing here talks to Telegram or OpenAI.
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123:test")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
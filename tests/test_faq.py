@@ -0,0 +1,29 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("question, expected", [
+    ("Admin, Solium toplam arzı ne kadar?", "100.000.000 SLM"),
+    ("Rose what is the total supply?", "100,000,000 SLM"),
+    ("Admin how many SLM tokens are there in total?", "100,000,000 SLM"),
+    ("rose can I buy from the US?", "not available to residents of the USA"),
+    ("Admin ABD'den alabilir miyim?", "ABD'de yaşayanlar"),
+    ("Rose which chain is SLM on?", "Binance Smart Chain"),
+    ("Admin when are the rewards?", "1M SLM every 7 days"),
+])
+def test_known_questions_are_answered(question, expected):
+    assert expected in main.faq_cache.answer(question)
+
+
+@pytest.mark.parametrize("question", [
+    "Admin, what is the total supply of bitcoin?",
+    "Admin can I buy from the UK",
+    "Rose what is the max supply of eth",
+    "admin bitcoin toplam arzı ne kadar",
+    "Admin, total supply nedir ve bana espri yap",
+    "Rose is solium a good investment?",
+    "admin nasılsın",
+])
+def test_other_questions_go_to_llm(question):
+    assert main.faq_cache.answer(question) is None
@@ -0,0 +1,323 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+import main
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+
+class FakeOpenAI:
+    """Stand-in for AsyncOpenAI whose completions answer with the next scripted outcome.
+
+    An outcome is a response text, an exception to raise, or an asyncio.Event to wait on before answering "late".
+    Every call first takes `delay` seconds.
+    """
+
+    def __init__(self, *script, delay=0):
+        self.script = list(script)
+        self.delay = delay
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, messages, **kwargs):
+        self.calls += 1
+        outcome = self.script.pop(0) if self.script else "ok"
+        await asyncio.sleep(self.delay)
+        if isinstance(outcome, asyncio.Event):
+            await outcome.wait()
+            outcome = "late"
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=outcome))], usage=None)
+
+
+@pytest.fixture
+def governor(monkeypatch):
+    governor = main.LLMGovernor(max_concurrency=4, chat_concurrency=2)
+    monkeypatch.setattr(main, "llm_governor", governor)
+    monkeypatch.setattr(main, "LLM_MAX_RETRIES", 0)
+    monkeypatch.setattr(main, "LLM_BREAKER_FAILURES", 2)
+    monkeypatch.setattr(main, "LLM_BREAKER_COOLDOWN", 0.2)
+    return governor
+
+
+def fake_openai(monkeypatch, *script):
+    fake = FakeOpenAI(*script)
+    monkeypatch.setattr(main, "async_client", fake)
+    return fake
+
+
+def connection_error():
+    return openai.APIConnectionError(request=REQUEST)
+
+
+def rate_limited(retry_after):
+    response = httpx.Response(429, headers={"retry-after": str(retry_after)}, request=REQUEST)
+    return openai.RateLimitError("rate limited", response=response, body=None)
+
+
+def bad_request():
+    return openai.BadRequestError("bad", response=httpx.Response(400, request=REQUEST), body=None)
+
+
+def complete(text, **kwargs):
+    return main.complete_chat([{"role": "user", "content": text}], "reply", **kwargs)
+
+
+def answer(response):
+    return response.choices[0].message.content
+
+
+def test_breaker_opens_after_consecutive_failures(monkeypatch, governor):
+    fake = fake_openai(monkeypatch, connection_error(), connection_error())
+
+    async def run():
+        for text in ("a", "b"):
+            with pytest.raises(openai.APIConnectionError):
+                await complete(text)
+        with pytest.raises(main.LLMRejected) as rejected:
+            await complete("c")
+        return rejected.value.reason
+
+    assert asyncio.run(run()) == "unavailable"
+    assert fake.calls == 2
+    assert governor.breaker_state() == 2
+    assert governor.stats["breaker_opened"] == 1
+
+
+def test_half_open_breaker_lets_one_trial_through(monkeypatch, governor):
+    release = asyncio.Event()
+    fake = fake_openai(monkeypatch, connection_error(), connection_error(), release)
+
+    async def run():
+        for text in ("a", "b"):
+            with pytest.raises(openai.APIConnectionError):
+                await complete(text)
+        await asyncio.sleep(0.25)  # cooldown over
+        assert governor.breaker_state() == 1
+        trial = asyncio.create_task(complete("trial"))
+        await asyncio.sleep(0.05)
+        with pytest.raises(main.LLMRejected):
+            await complete("second")  # only the trial goes out while half-open
+        release.set()
+        assert answer(await trial) == "late"
+        return answer(await complete("after"))
+
+    assert asyncio.run(run()) == "ok"
+    assert fake.calls == 4
+    assert governor.breaker_state() == 0
+
+
+def test_failed_trial_reopens_the_breaker(monkeypatch, governor):
+    fake_openai(monkeypatch, connection_error(), connection_error(), connection_error())
+
+    async def run():
+        for text in ("a", "b"):
+            with pytest.raises(openai.APIConnectionError):
+                await complete(text)
+        await asyncio.sleep(0.25)
+        with pytest.raises(openai.APIConnectionError):
+            await complete("trial")
+        with pytest.raises(main.LLMRejected):
+            await complete("after")
+
+    asyncio.run(run())
+    assert governor.breaker_state() == 2
+
+
+def test_cancelled_trial_lets_another_through(monkeypatch, governor):
+    fake_openai(monkeypatch, connection_error(), connection_error(), asyncio.Event())
+
+    async def run():
+        for text in ("a", "b"):
+            with pytest.raises(openai.APIConnectionError):
+                await complete(text)
+        await asyncio.sleep(0.25)
+        trial = asyncio.create_task(complete("trial"))
+        await asyncio.sleep(0.05)
+        trial.cancel()
+        await asyncio.sleep(0)
+        return answer(await complete("next"))
+
+    assert asyncio.run(run()) == "ok"
+
+
+def test_user_quota(monkeypatch, governor):
+    monkeypatch.setattr(main, "LLM_USER_QUOTA", 2)
+    governor.check_quota("reply", 1)
+    governor.check_quota("reply", 1)
+    with pytest.raises(main.LLMRejected) as rejected:
+        governor.check_quota("reply", 1)
+    assert rejected.value.reason == "quota"
+    governor.check_quota("reply", 2)  # other users keep their own quota
+    governor.check_quota("moderation", 1)  # only replies count
+    assert governor.stats["rejected_quota"] == 1
+
+
+def test_rejected_request_does_not_use_up_quota(monkeypatch, governor):
+    monkeypatch.setattr(main, "LLM_USER_QUOTA", 1)
+    monkeypatch.setattr(main, "LLM_USER_QUOTA_WINDOW", 0.2)
+    governor.check_quota("reply", 1)
+    for _ in range(3):
+        with pytest.raises(main.LLMRejected):
+            governor.check_quota("reply", 1)
+    time.sleep(0.25)
+    governor.check_quota("reply", 1)
+
+
+def test_global_concurrency_cap(monkeypatch, governor):
+    monkeypatch.setitem(main.LLM_DEADLINES, "reply", 0.2)
+    governor.max_concurrency = 1
+    release = asyncio.Event()
+    fake = fake_openai(monkeypatch, release)
+
+    async def run():
+        first = asyncio.create_task(complete("first", chat_id=1))
+        await asyncio.sleep(0.05)
+        with pytest.raises(main.LLMRejected) as rejected:
+            await complete("second", chat_id=2)
+        release.set()
+        await first
+        return rejected.value.reason
+
+    assert asyncio.run(run()) == "busy"
+    assert fake.calls == 1
+
+
+def test_per_chat_concurrency_cap(monkeypatch, governor):
+    monkeypatch.setitem(main.LLM_DEADLINES, "reply", 0.2)
+    governor.chat_concurrency = 1
+    release = asyncio.Event()
+    fake_openai(monkeypatch, release)
+
+    async def run():
+        first = asyncio.create_task(complete("first", chat_id=1))
+        await asyncio.sleep(0.05)
+        with pytest.raises(main.LLMRejected):
+            await complete("same chat", chat_id=1)
+        other = answer(await complete("other chat", chat_id=2))
+        release.set()
+        await first
+        return other
+
+    assert asyncio.run(run()) == "ok"
+
+
+def test_waiting_caller_gets_the_freed_slot(monkeypatch, governor):
+    governor.max_concurrency = 1
+    release = asyncio.Event()
+    fake_openai(monkeypatch, release)
+
+    async def run():
+        first = asyncio.create_task(complete("first"))
+        await asyncio.sleep(0.05)
+        second = asyncio.create_task(complete("second"))
+        await asyncio.sleep(0.05)
+        release.set()
+        return answer(await first), answer(await second)
+
+    assert asyncio.run(run()) == ("late", "ok")
+    assert governor.stats["rejected_busy"] == 0
+
+
+def test_identical_calls_are_coalesced(monkeypatch, governor):
+    release = asyncio.Event()
+    fake = fake_openai(monkeypatch, release)
+
+    async def run():
+        calls = [asyncio.create_task(complete("same")) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        release.set()
+        return [answer(response) for response in await asyncio.gather(*calls)]
+
+    assert asyncio.run(run()) == ["late"] * 3
+    assert fake.calls == 1
+    assert governor.stats["coalesced"] == 2
+    assert governor._coalesced == {}
+
+
+def test_followers_share_the_leaders_error(monkeypatch, governor):
+    fake = fake_openai(monkeypatch, bad_request())
+    fake.delay = 0.1
+
+    async def run():
+        calls = [asyncio.create_task(complete("same")) for _ in range(2)]
+        return await asyncio.gather(*calls, return_exceptions=True)
+
+    assert [type(result) for result in asyncio.run(run())] == [openai.BadRequestError] * 2
+    assert fake.calls == 1
+
+
+def test_cancelled_leader_does_not_strand_followers(monkeypatch, governor):
+    fake = fake_openai(monkeypatch, asyncio.Event())
+
+    async def run():
+        leader = asyncio.create_task(complete("same"))
+        await asyncio.sleep(0.05)
+        follower = asyncio.create_task(complete("same"))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        with pytest.raises(main.LLMRejected):
+            await asyncio.wait_for(follower, 1)
+        return answer(await complete("same"))  # the key was released, so this is a fresh call
+
+    assert asyncio.run(run()) == "ok"
+    assert fake.calls == 2
+    assert governor._coalesced == {}
+
+
+def test_follower_gives_up_at_its_deadline(monkeypatch, governor):
+    monkeypatch.setitem(main.LLM_DEADLINES, "reply", 0.2)
+    release = asyncio.Event()
+    fake_openai(monkeypatch, release)
+
+    async def run():
+        leader = asyncio.create_task(complete("same"))
+        await asyncio.sleep(0.05)
+        started = time.monotonic()
+        with pytest.raises(main.LLMRejected) as rejected:
+            await complete("same")
+        waited = time.monotonic() - started
+        release.set()
+        assert answer(await leader) == "late"  # giving up did not cancel the shared call
+        return rejected.value.reason, waited
+
+    reason, waited = asyncio.run(run())
+    assert reason == "busy"
+    assert waited < 0.5
+
+
+def test_retries_until_success(monkeypatch, governor):
+    monkeypatch.setattr(main, "LLM_MAX_RETRIES", 2)
+    monkeypatch.setattr(main, "LLM_RETRY_BASE", 0.01)
+    fake = fake_openai(monkeypatch, rate_limited(0), connection_error(), "third time")
+    assert answer(asyncio.run(complete("retry"))) == "third time"
+    assert fake.calls == 3
+    assert governor.stats["retries"] == 2
+    assert governor.breaker_state() == 0
+
+
+def test_retry_that_would_pass_the_deadline_is_not_made(monkeypatch, governor):
+    monkeypatch.setattr(main, "LLM_MAX_RETRIES", 5)
+    monkeypatch.setitem(main.LLM_DEADLINES, "reply", 1)
+    fake = fake_openai(monkeypatch, rate_limited(10))
+    started = time.monotonic()
+    with pytest.raises(openai.RateLimitError):
+        asyncio.run(complete("retry"))
+    assert time.monotonic() - started < 0.5  # gave up at once instead of sleeping past the deadline
+    assert fake.calls == 1
+    assert governor.stats["retries"] == 0
+
+
+def test_client_errors_are_not_retried(monkeypatch, governor):
+    monkeypatch.setattr(main, "LLM_MAX_RETRIES", 3)
+    fake = fake_openai(monkeypatch, bad_request())
+    with pytest.raises(openai.BadRequestError):
+        asyncio.run(complete("bad"))
+    assert fake.calls == 1
+    assert governor.breaker_state() == 0  # a bad request says nothing about the provider's health
@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+import main
+
+
+def slow_classifiers(monkeypatch, seen, delay=0.3):
+    async def classify_batch(texts):
+        seen.extend(texts)
+        await asyncio.sleep(delay)
+        return {i: "spam" in text for i, text in enumerate(texts)}
+
+    async def classify_message(text):
+        seen.append(text)
+        await asyncio.sleep(delay)
+        return "spam" in text
+
+    monkeypatch.setattr(main, "classify_batch", classify_batch)
+    monkeypatch.setattr(main, "classify_message", classify_message)
+
+
+def test_batches_are_classified_concurrently(monkeypatch):
+    seen = []
+    slow_classifiers(monkeypatch, seen)
+    batcher = main.ModerationBatcher(batch_size=2, window=0.05)
+    started = time.monotonic()
+    futures = [batcher.submit(text) for text in ("spam 1", "ham 1", "spam 2", "ham 2", "spam 3", "ham 3")]
+    assert [future.result(timeout=5) for future in futures] == [True, False, True, False, True, False]
+    assert time.monotonic() - started < 0.8  # three 0.3s batches, not one after another
+
+
+def test_abandoned_messages_are_not_classified(monkeypatch):
+    seen = []
+    slow_classifiers(monkeypatch, seen, delay=0.0)
+    batcher = main.ModerationBatcher(batch_size=20, window=0.2)
+    gone = batcher.submit("given up")
+    gone.cancel()
+    kept = batcher.submit("spam kept")
+    assert kept.result(timeout=5) is True
+    assert seen == ["spam kept"]
+    assert batcher.stats["abandoned"] == 1
+
+
+def test_batch_flushes_when_nothing_else_can_join(monkeypatch):
+    seen = []
+    slow_classifiers(monkeypatch, seen, delay=0.0)
+    batcher = main.ModerationBatcher(batch_size=20, window=5)
+    batcher.in_flight = lambda: 1
+    started = time.monotonic()
+    assert batcher.submit("ham").result(timeout=5) is False
+    assert time.monotonic() - started < 1
+    assert batcher.stats["early_flushes"] == 1
+
+
+def test_timed_out_caller_falls_back_once(monkeypatch):
+    seen = []
+    slow_classifiers(monkeypatch, seen, delay=0.0)
+    monkeypatch.setattr(main, "MODERATION_BATCH_TIMEOUT", 0.05)
+    batcher = main.ModerationBatcher(batch_size=20, window=0.3)
+    assert asyncio.run(batcher.classify("spam late")) is None  # gave up before the window closed
+    time.sleep(0.5)
+    assert seen == []
@@ -0,0 +1,110 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("text", [
+    "Can I buy with ETH?",
+    "btc and eth are down today",
+    "Bitcoin ETF news today, bitcoin up",
+    "kazan kazan",
+    "Can I buy $ETH here?",
+    "Is SOL or doge better for fees?",
+])
+def test_crypto_chatter_goes_to_llm(text):
+    assert main.prefilter_message(text) == (None, "llm")
+
+
+@pytest.mark.parametrize("text", [
+    "Buy $PEPE now, 100x guaranteed!!",
+    "Free airdrop! buy $PEPE now 100x signals",
+    "🚀 $DOGE pump incoming, buy now, join now",
+])
+def test_cashtag_promotion_is_blocked(text):
+    assert main.prefilter_message(text) == (True, "score")
+
+
+@pytest.mark.parametrize("text", [
+    "Merhaba arkadaşlar, bugün nasılsınız?",
+    "Solium vs eth staking?",
+])
+def test_friendly_messages_are_clean(text):
+    verdict, _ = main.prefilter_message(text)
+    assert verdict is False
+
+
+def test_unofficial_link_is_blocked():
+    assert main.prefilter_message("buy eth at https://scam.example/x") == (True, "blocklist")
+
+
+def test_official_link_is_not_blocked():
+    assert main.prefilter_message("Join us at https://t.me/+KDhk3UEwZAg3MmU0") == (None, "llm")
+
+
+@pytest.mark.parametrize("link", ["https://soliumcoin.com", "t.me/solium"])
+def test_official_link_does_not_excuse_promotion(link):
+    assert main.prefilter_message(f"Buy $PEPE now 100x guaranteed!! {link}") == (True, "score")
+
+
+@pytest.mark.parametrize("link", [
+    "https://soliumcoin.com/whitepaper.pdf",
+    "https://www.SoliumCoin.com",
+    "docs.soliumcoin.com/staking",
+    "https://t.me/solium",
+    "t.me/solium/123",
+    "https://t.me/soliumcoin",
+    "telegram.me/soliumcoinowner",
+    "https://github.com/soliumcoin/solium-project/issues",
+    "https://medium.com/@soliumcoin/roadmap",
+    "https://x.com/soliumcoin",
+])
+def test_whitelist_allows_official_links(link):
+    assert main.link_whitelist.allows(link)
+
+
+@pytest.mark.parametrize("link", [
+    "https://soliumcoin.com.scam.io",
+    "https://notsoliumcoin.com",
+    "https://t.me/soliumscam",
+    "https://t.me/solium-airdrop",
+    "https://t.me/",
+    "https://github.com/soliumcoins",
+    "https://medium.com/@other",
+    "https://x.com/soliumcoin_airdrop",
+    "https://evil.com/soliumcoin.com",
+])
+def test_whitelist_rejects_lookalikes(link):
+    assert not main.link_whitelist.allows(link)
+
+
+def test_whitelist_path_entry_covers_only_its_subtree():
+    whitelist = main.LinkWhitelist(["example.org/a/b"])
+    assert whitelist.allows("example.org/a/b/c")
+    assert not whitelist.allows("example.org/a")
+    assert not whitelist.allows("example.org/a/bc")
+    assert not whitelist.allows("sub.example.org/a/b")
+
+
+@pytest.mark.parametrize("text", [
+    "Is the dashboard built on react.app or next?",
+    "Mail me at john@gmail.com about the presale",
+    "Dick is my neighbour, he asked about the token",
+    "Sorry for the stupid question, when is the listing?",
+    "damn, the chart looks good today",
+])
+def test_ordinary_words_and_addresses_are_not_blocked(text):
+    verdict, tier = main.prefilter_message(text)
+    assert verdict is not True and tier != "blocklist"
+
+
+def test_email_address_is_not_a_link():
+    assert main.MessageSignals("write to john@gmail.com").links == []
+
+
+@pytest.mark.parametrize("text", ["join t.me/freemoney today", "visit scam-token.xyz/claim"])
+def test_bare_unofficial_domains_are_blocked(text):
+    assert main.prefilter_message(text) == (True, "blocklist")
+
+
+def test_profanity_is_blocked():
+    assert main.prefilter_message("you are an idiot") == (True, "blocklist")
@@ -0,0 +1,221 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+CHAT = -1001
+
+
+class Clock:
+    """Stand-in for the time module whose monotonic clock only moves when told to."""
+
+    perf_counter = staticmethod(time.perf_counter)
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return 1_700_000_000 + self.now
+
+
+class FakeTelegram:
+    """Records Bot API calls, answering each with an empty success (sync and async)."""
+
+    def __init__(self):
+        self.calls = []
+
+    def response(self, method, payload):
+        self.calls.append((method, payload))
+        return SimpleNamespace(status_code=200, text="", json=lambda: {"ok": True, "result": []})
+
+    def call(self, method, payload, **kwargs):
+        return self.response(method, payload)
+
+    async def call_async(self, method, payload, **kwargs):
+        return self.response(method, payload)
+
+    def methods(self):
+        return [method for method, _ in self.calls]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def guard(monkeypatch):
+    monkeypatch.setattr(main, "RAID_MESSAGE_THRESHOLD", 10)
+    monkeypatch.setattr(main, "RAID_JOIN_THRESHOLD", 4)
+    monkeypatch.setattr(main, "RAID_WINDOW", 30)
+    monkeypatch.setattr(main, "RAID_EXIT_RATIO", 0.5)
+    monkeypatch.setattr(main, "RAID_COOLDOWN", 60)
+    guard = main.RaidGuard()
+    guard._start = lambda: None  # the tests sweep by hand
+    monkeypatch.setattr(main, "raid_guard", guard)
+    return guard
+
+
+@pytest.fixture
+def fake_telegram(monkeypatch):
+    fake = FakeTelegram()
+    monkeypatch.setattr(main, "telegram", fake)
+    monkeypatch.setattr(main, "telegram_async", SimpleNamespace(call=fake.call_async))
+    return fake
+
+
+def traffic(guard, clock, seconds, every, joins=0):
+    """Send one message every `every` seconds for `seconds`, sweeping each second; returns the last verdict."""
+    in_raid = False
+    end = clock.now + seconds
+    next_message = clock.now
+    while clock.now < end:
+        if clock.now >= next_message:
+            in_raid = guard.record(CHAT, joins=joins)
+            next_message += every
+        clock.now += 1
+        guard.sweep()
+    return in_raid
+
+
+def test_message_flood_starts_a_raid(guard, clock):
+    for _ in range(9):
+        assert not guard.record(CHAT)
+    assert guard.record(CHAT)
+    assert guard.active_raids() == 1
+    assert guard.stats["raids"] == 1
+
+
+def test_join_flood_starts_a_raid(guard, clock):
+    assert not guard.record(CHAT, joins=3)
+    assert guard.record(CHAT, joins=1)
+
+
+def test_spread_out_messages_do_not_start_a_raid(guard, clock):
+    assert not traffic(guard, clock, seconds=600, every=4)  # 7-8 per 30s window, threshold 10
+    assert guard.active_raids() == 0
+
+
+def test_private_chats_are_never_raided(guard, clock):
+    assert not any(guard.record(42) for _ in range(50))
+
+
+def test_raid_does_not_end_while_traffic_stays_above_the_exit_rate(guard, clock):
+    traffic(guard, clock, seconds=10, every=1)
+    assert guard.active_raids() == 1
+    # 6 per window: below the entry threshold of 10, above the exit threshold of 5
+    traffic(guard, clock, seconds=300, every=5)
+    assert guard.active_raids() == 1
+
+
+def test_raid_ends_after_a_calm_cooldown(guard, clock):
+    traffic(guard, clock, seconds=10, every=1)
+    traffic(guard, clock, seconds=60, every=10)  # 3 per window: calm once the flood has left the window
+    assert guard.active_raids() == 1  # calm, but not for RAID_COOLDOWN seconds yet
+    traffic(guard, clock, seconds=40, every=10)
+    assert guard.active_raids() == 0
+    # Out of raid mode, the full entry threshold applies again.
+    assert not traffic(guard, clock, seconds=30, every=5)
+
+
+def test_busy_spell_restarts_the_cooldown(guard, clock):
+    traffic(guard, clock, seconds=10, every=1)
+    traffic(guard, clock, seconds=80, every=10)
+    traffic(guard, clock, seconds=8, every=1)  # busy again before the cooldown ran out
+    traffic(guard, clock, seconds=60, every=10)
+    assert guard.active_raids() == 1
+
+
+def test_deletes_are_sent_in_batches_of_100(guard, clock, fake_telegram):
+    for message_id in range(250):
+        guard.queue_delete(CHAT, message_id)
+    assert guard._wake.is_set()  # a full batch wakes the sweeper early
+    guard.sweep()
+    assert fake_telegram.methods() == ["deleteMessages"] * 3
+    assert [len(payload["message_ids"]) for _, payload in fake_telegram.calls] == [100, 100, 50]
+    assert [payload["message_ids"][0] for _, payload in fake_telegram.calls] == [0, 100, 200]
+    assert guard.stats["deleted"] == 250 and guard.stats["delete_batches"] == 3
+    guard.sweep()
+    assert len(fake_telegram.calls) == 3  # nothing is sent twice
+
+
+def test_partial_batch_waits_for_the_sweep(guard, clock, fake_telegram):
+    guard.queue_delete(CHAT, 1)
+    assert not guard._wake.is_set()
+    assert fake_telegram.calls == []
+
+
+def spawned_coroutines(monkeypatch):
+    coroutines = []
+    monkeypatch.setattr(main, "core_loop", SimpleNamespace(spawn=coroutines.append))
+    return coroutines
+
+
+def raid_message(message_id, user_id, **fields):
+    return main.IncomingMessage({"message_id": message_id, "chat": {"id": CHAT}, "from": {"id": user_id}, **fields})
+
+
+def test_joiners_are_restricted(monkeypatch, guard, clock, fake_telegram):
+    monkeypatch.setattr(main, "RAID_RESTRICT_SECONDS", 3600)
+    coroutines = spawned_coroutines(monkeypatch)
+    guard.record(CHAT, joins=4)
+    joiners = [{"id": 7}, {"id": 8}, {"id": 9, "is_bot": True}]
+    msg = raid_message(5, 7, new_chat_members=joiners)
+
+    async def run():
+        branch = await main.handle_raid_message(msg)
+        await asyncio.gather(*coroutines)
+        return branch
+
+    assert asyncio.run(run()) == "raid_joins"
+    restricted = [payload for method, payload in fake_telegram.calls if method == "restrictChatMember"]
+    assert [payload["user_id"] for payload in restricted] == [7, 8]  # bots are left alone
+    assert all(payload["permissions"]["can_send_messages"] is False for payload in restricted)
+    assert all(payload["until_date"] == int(clock.time()) + 3600 for payload in restricted)
+    assert guard.stats["restricted"] == 2
+    assert guard._pending_deletes[CHAT] == [5]  # the "joined" service message
+
+
+def test_raid_violations_are_deleted_quietly_and_repeat_offenders_banned(monkeypatch, guard, clock, fake_telegram):
+    monkeypatch.setattr(main, "state_store", main.MemoryStateStore())
+    coroutines = spawned_coroutines(monkeypatch)
+    guard.record(CHAT, joins=4)
+
+    async def run():
+        branches = [await main.handle_raid_message(raid_message(i, 7, text="join t.me/freemoney today"))
+                    for i in range(3)]
+        await asyncio.gather(*coroutines)
+        return branches
+
+    assert asyncio.run(run()) == ["raid_violation"] * 3
+    assert guard._pending_deletes[CHAT] == [0, 1, 2]
+    assert fake_telegram.methods() == ["banChatMember"]  # no warnings, no single deletes
+    assert guard.stats["banned"] == 1
+
+
+def test_unclear_messages_are_left_unchecked_during_a_raid(monkeypatch, guard, clock, fake_telegram):
+    guard.record(CHAT, joins=4)
+    assert asyncio.run(main.handle_raid_message(raid_message(1, 7, text="Can I buy with ETH?"))) == "raid_unchecked"
+    assert guard.stats["unchecked"] == 1
+    assert fake_telegram.calls == []
+
+
+def test_flooded_chat_gets_no_replies(monkeypatch, guard, fake_telegram):
+    monkeypatch.setattr(main, "state_store", main.MemoryStateStore())
+    monkeypatch.setattr(main, "admin_cache", main.AdminCache(ttl=60, max_chats=10))
+    spawned_coroutines(monkeypatch)
+    for i in range(30):
+        update = {"update_id": i, "message": {"message_id": i, "chat": {"id": CHAT, "type": "supergroup"},
+                                              "from": {"id": 100 + i}, "text": "join t.me/freemoney today"}}
+        asyncio.run(main.handle_update(update))
+    methods = fake_telegram.methods()
+    assert methods.count("sendMessage") == 9  # warnings only until the 10th message starts the raid
+    assert len(guard._pending_deletes[CHAT]) == 21
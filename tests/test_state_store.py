@@ -0,0 +1,105 @@
+import asyncio
+import sys
+import threading
+
+import pytest
+
+import main
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return main.SQLiteStateStore(path=str(tmp_path / "state.db"))
+    return main.MemoryStateStore()
+
+
+def test_history_leaves_out_current_message(store):
+    store.append_turn(1, "user", "hello")
+    store.append_turn(1, "assistant", "hi there")
+    store.append_turn(1, "user", "what is solium?")
+    assert store.history_messages(1, current_message="what is solium?") == [
+        {"role": "user", "content": "hello"},
+        {"role": "assistant", "content": "hi there"},
+    ]
+    assert store.history_messages(2) == []
+
+
+def test_history_is_a_copy(store):
+    store.append_turn(1, "user", "hello")
+    store.history_messages(1).append({"role": "user", "content": "injected"})
+    assert store.history_messages(1) == [{"role": "user", "content": "hello"}]
+
+
+def test_clear_conversation(store):
+    store.append_turn(1, "user", "hello")
+    assert store.clear_conversation(1)
+    assert store.history_messages(1) == []
+    assert not store.clear_conversation(1)
+
+
+def test_history_while_other_threads_append(monkeypatch):
+    monkeypatch.setattr(main, "CONTEXT_TOKEN_BUDGET", 100000)  # long windows take long to copy
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    store = main.MemoryStateStore()
+    monkeypatch.setattr(main, "state_store", store)
+    stop = threading.Event()
+    errors = []
+
+    def writer():
+        while not stop.is_set():
+            store.append_turn(1, "user", "spam")
+
+    def reader():
+        try:
+            for _ in range(300):
+                main.build_chat_messages("next", 1)
+        except Exception as e:  # "deque mutated during iteration" before the copy was taken under the lock
+            errors.append(e)
+
+    writers = [threading.Thread(target=writer) for _ in range(2)]
+    for thread in writers:
+        thread.start()
+    try:
+        reader()
+    finally:
+        stop.set()
+        for thread in writers:
+            thread.join()
+        sys.setswitchinterval(switch_interval)
+    assert errors == []
+
+
+def test_summary_is_folded_under_the_store_lock(monkeypatch):
+    monkeypatch.setattr(main, "CONTEXT_SUMMARY", True)
+    monkeypatch.setattr(main, "CONTEXT_TOKEN_BUDGET", 50)
+    monkeypatch.setattr(main, "CONTEXT_SUMMARY_TRIGGER", 20)
+    monkeypatch.setattr(main, "summarize_conversation", lambda summary, lines: f"{len(lines)} older lines")
+    store = main.MemoryStateStore()
+    for i in range(6):
+        store.append_turn(1, "user", f"message number {i} " * 5)
+    main.summary_executor.submit(lambda: None).result()  # let the queued fold finish
+    history = store.history_messages(1)
+    assert history[0]["role"] == "system" and "older lines" in history[0]["content"]
+
+
+def test_blocking_backend_stays_off_the_event_loop(monkeypatch, tmp_path):
+    threads = []
+
+    class RecordingStore(main.SQLiteStateStore):
+        def append_turn(self, user_id, role, text):
+            threads.append(threading.current_thread())
+            super().append_turn(user_id, role, text)
+
+    monkeypatch.setattr(main, "state_store", RecordingStore(path=str(tmp_path / "state.db")))
+    update = {"update_id": 1, "message": {"message_id": 1, "chat": {"id": 42, "type": "private"},
+                                          "from": {"id": 7}, "text": "hello, nice day today"}}
+
+    async def handle():
+        return await main.handle_update(update), threading.current_thread()
+
+    branch, loop_thread = asyncio.run(handle())
+    assert branch == "ignored"
+    assert threads and loop_thread not in threads
+    assert main.state_store.history_messages(7) == [{"role": "user", "content": "hello, nice day today"}]
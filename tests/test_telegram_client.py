@@ -0,0 +1,138 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import main
+
+
+class FakeTelegram:
+    """Local Bot API stand-in answering each request with the next scripted (status, delay)."""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                fake.requests.append(self.path.rsplit("/", 1)[-1])
+                status, delay = fake.script.pop(0) if fake.script else (200, 0)
+                time.sleep(delay)
+                body = {"ok": status == 200, "result": True}
+                if status == 429:
+                    body["parameters"] = {"retry_after": 0}
+                payload = json.dumps(body).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except OSError:
+                    pass  # the client gave up (read timeout)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+
+
+@pytest.fixture
+def fake_telegram():
+    servers = []
+
+    def start(*script):
+        server = FakeTelegram(script)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def client_for(url):
+    return main.TelegramClient("123:test", base_url=url, timeout=0.2, max_retries=1)
+
+
+def unused_url():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+@pytest.mark.parametrize("method", ["sendMessage", "banChatMember", "editMessageText"])
+def test_read_timeout_is_not_retried_for_non_idempotent_methods(fake_telegram, method):
+    server = fake_telegram((200, 0.5))
+    assert client_for(server.url).call(method, {"chat_id": 1}) is None
+    assert server.requests == [method]
+
+
+@pytest.mark.parametrize("method", ["sendMessage", "banChatMember"])
+def test_server_error_is_not_retried_for_non_idempotent_methods(fake_telegram, method):
+    server = fake_telegram((500, 0))
+    assert client_for(server.url).call(method, {"chat_id": 1}).status_code == 500
+    assert server.requests == [method]
+
+
+def test_rate_limit_is_retried_for_non_idempotent_methods(fake_telegram):
+    server = fake_telegram((429, 0), (200, 0))
+    assert client_for(server.url).call("sendMessage", {"chat_id": 1}).status_code == 200
+    assert server.requests == ["sendMessage", "sendMessage"]
+
+
+def test_connection_failure_is_retried_for_non_idempotent_methods():
+    client = client_for(unused_url())
+    assert client.call("sendMessage", {"chat_id": 1}) is None
+    assert client.stats["calls"] == 2 and client.stats["retries"] == 1
+
+
+@pytest.mark.parametrize("first", [(500, 0), (200, 0.5)])
+def test_idempotent_methods_are_retried_after_errors(fake_telegram, first):
+    server = fake_telegram(first, (200, 0))
+    assert client_for(server.url).call("deleteMessage", {"chat_id": 1, "message_id": 2}).status_code == 200
+    assert server.requests == ["deleteMessage", "deleteMessage"]
+
+
+def test_async_read_timeout_is_not_retried(fake_telegram):
+    server = fake_telegram((200, 0.5))
+
+    async def call():
+        client = main.AsyncTelegramClient(client_for(server.url))
+        try:
+            return await client.call("sendMessage", {"chat_id": 1})
+        finally:
+            await client.http.aclose()
+
+    assert asyncio.run(call()) is None
+    assert server.requests == ["sendMessage"]
+
+
+def test_dropped_sends_give_their_slot_back(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(main, "time", type("Clock", (), {"monotonic": staticmethod(lambda: clock[0])}))
+    client = main.TelegramClient("123:test")
+    sent = []
+    # One send every 2s to a group allowed 20 per minute, for 10 minutes.
+    for step in range(300):
+        clock[0] = step * 2.0
+        delay = client.reserve("sendMessage", -100)
+        if delay is not None:
+            sent.append(clock[0] + delay)
+    assert client.stats["dropped"] == 300 - len(sent)
+    assert client.stats["throttled_seconds"] <= len(sent) * main.TELEGRAM_MAX_RATE_WAIT
+    # The chat keeps sending at its allowed rate to the end instead of starving.
+    last_minute = [at for at in sent if at >= 540]
+    assert len(last_minute) >= 19
+    assert client._chat_bucket(-100).tokens >= -main.TELEGRAM_MAX_RATE_WAIT * main.TELEGRAM_GROUP_RATE - 1
@@ -0,0 +1,164 @@
+import asyncio
+import random
+import threading
+import time
+
+import pytest
+
+import main
+
+
+def message(update_id, chat_id):
+    return {"update_id": update_id, "message": {"message_id": update_id, "chat": {"id": chat_id}, "text": "hi"}}
+
+
+class Recorder:
+    """Update handler that records what it handled, taking `delay` seconds (or until `gate` opens) per update."""
+
+    def __init__(self, delay=0.0, gate=None):
+        self.delay = delay
+        self.gate = gate
+        self.handled = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    async def __call__(self, update):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            if self.gate is not None:
+                await asyncio.to_thread(self.gate.wait, 5)
+            await asyncio.sleep(self.delay() if callable(self.delay) else self.delay)
+            with self._lock:
+                self.handled.append(update)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+@pytest.fixture(params=["threads", "asyncio"])
+def make_dispatcher(request):
+    dispatchers = []
+
+    def make(handler, concurrency=4, max_pending=100):
+        if request.param == "asyncio":
+            dispatcher = main.AsyncUpdateDispatcher(handler, concurrency, max_pending)
+        else:
+            dispatcher = main.UpdateDispatcher(handler, concurrency, max_pending)
+        dispatchers.append(dispatcher)
+        return dispatcher
+
+    yield make
+    for dispatcher in dispatchers:
+        dispatcher.stop(timeout=5)
+
+
+def test_updates_of_a_chat_stay_in_order(make_dispatcher):
+    handler = Recorder(delay=lambda: random.uniform(0, 0.01))
+    dispatcher = make_dispatcher(handler)
+    updates = [message(i, chat_id=i % 3) for i in range(60)]
+    for update in updates:
+        assert dispatcher.submit(update)
+    dispatcher.stop(timeout=5)
+    assert len(handler.handled) == 60
+    for chat_id in range(3):
+        ids = [update["update_id"] for update in handler.handled if update["message"]["chat"]["id"] == chat_id]
+        assert ids == sorted(ids)
+
+
+def test_chats_are_handled_in_parallel(make_dispatcher):
+    handler = Recorder(delay=0.3)
+    dispatcher = make_dispatcher(handler, concurrency=4)
+    started = time.monotonic()
+    for chat_id in range(4):
+        dispatcher.submit(message(chat_id, chat_id))
+    dispatcher.stop(timeout=5)
+    assert len(handler.handled) == 4
+    assert time.monotonic() - started < 0.8  # four 0.3s updates side by side, not one after another
+    assert handler.max_running == 4
+
+
+def test_a_busy_chat_does_not_run_its_updates_side_by_side(make_dispatcher):
+    handler = Recorder(delay=0.05)
+    dispatcher = make_dispatcher(handler, concurrency=4)
+    for i in range(5):
+        dispatcher.submit(message(i, chat_id=1))
+    dispatcher.stop(timeout=5)
+    assert handler.max_running == 1
+
+
+def test_concurrency_is_capped(make_dispatcher):
+    handler = Recorder(delay=0.05)
+    dispatcher = make_dispatcher(handler, concurrency=2)
+    for chat_id in range(8):
+        dispatcher.submit(message(chat_id, chat_id))
+    dispatcher.stop(timeout=5)
+    assert len(handler.handled) == 8
+    assert handler.max_running == 2
+
+
+def test_failing_update_does_not_stop_its_chat(make_dispatcher):
+    handled = []
+
+    async def handler(update):
+        if update["update_id"] == 1:
+            raise RuntimeError("boom")
+        handled.append(update["update_id"])
+
+    dispatcher = make_dispatcher(handler)
+    for i in range(3):
+        dispatcher.submit(message(i, chat_id=1))
+    dispatcher.stop(timeout=5)
+    assert handled == [0, 2]
+    assert dispatcher.stats["failed"] == 1 and dispatcher.stats["processed"] == 2
+
+
+def test_full_queue_is_rejected(make_dispatcher):
+    gate = threading.Event()
+    dispatcher = make_dispatcher(Recorder(gate=gate), concurrency=1, max_pending=2)
+    accepted = [dispatcher.submit(message(i, chat_id=1)) for i in range(5)]
+    gate.set()
+    # The threads runtime frees a queue slot once a worker picks an update up; asyncio counts it until it is done.
+    assert accepted[:2] == [True, True] and accepted[-1] is False
+    assert dispatcher.stats["dropped"] == accepted.count(False)
+
+
+def test_webhook_answers_503_when_the_queue_is_full(monkeypatch, make_dispatcher):
+    gate = threading.Event()
+    dispatcher = make_dispatcher(Recorder(gate=gate), concurrency=1, max_pending=1)
+    monkeypatch.setattr(main, "update_dispatcher", dispatcher)
+    monkeypatch.setattr(main, "UPDATE_WORKERS", 1)
+    client = main.app.test_client()
+    try:
+        statuses = [client.post("/webhook", json=message(i, chat_id=1)) for i in range(4)]
+    finally:
+        gate.set()
+    assert statuses[0].status_code == 200
+    rejected = statuses[-1]
+    assert rejected.status_code == 503
+    assert rejected.headers["Retry-After"] == str(main.UPDATE_RETRY_AFTER)
+
+
+def test_stop_drains_queued_updates(make_dispatcher):
+    handler = Recorder(delay=0.02)
+    dispatcher = make_dispatcher(handler, concurrency=2)
+    for i in range(20):
+        dispatcher.submit(message(i, chat_id=i % 2))
+    dispatcher.stop(timeout=5)
+    assert len(handler.handled) == 20
+    assert dispatcher.depth() == 0
+    assert not dispatcher.submit(message(99, chat_id=1))  # no new work once stopping
+
+
+def test_stop_gives_up_after_its_timeout(make_dispatcher):
+    gate = threading.Event()
+    dispatcher = make_dispatcher(Recorder(gate=gate), concurrency=1)
+    for i in range(3):
+        dispatcher.submit(message(i, chat_id=1))
+    started = time.monotonic()
+    dispatcher.stop(timeout=0.2)
+    assert time.monotonic() - started < 1
+    assert dispatcher.depth() > 0
+    gate.set()